@@ -1,18 +1,16 @@
 import base64
 import hashlib
-import logging
 
 from django.conf import settings
 from django.contrib.auth import authenticate, login, get_permission_codename
-from django.contrib.auth.models import User, Permission
+from django.contrib.auth.models import Permission
+from django.core.exceptions import PermissionDenied
 from django.core.urlresolvers import reverse
-from django.db import IntegrityError
 
 from django_lti_tool_provider import AbstractApplicationHookManager
 from django_lti_tool_provider.views import LTIView
 
-
-logger = logging.getLogger(__name__)
+from peerinst import routers
 
 
 class LTIRoles(object):
@@ -49,6 +47,21 @@ def get_permissions_for_staff_user():
             yield Permission.objects.get_by_natural_key(codename, app_label, model_name)
 
 
+_staff_permission_ids = None
+
+
+def get_staff_permission_ids():
+    """
+    Returns the ids of the permissions from `get_permissions_for_staff_user`, looked up only once per process.
+
+    :return: frozenset[int]
+    """
+    global _staff_permission_ids
+    if _staff_permission_ids is None:
+        _staff_permission_ids = frozenset(permission.pk for permission in get_permissions_for_staff_user())
+    return _staff_permission_ids
+
+
 class ApplicationHookManager(AbstractApplicationHookManager):
     LTI_KEYS = ['custom_assignment_id', 'custom_question_id']
     ADMIN_ACCESS_ROLES = {LTIRoles.INSTRUCTOR, LTIRoles.STAFF}
@@ -95,31 +108,34 @@ class ApplicationHookManager(AbstractApplicationHookManager):
         if extra_params is None:
             extra_params = {}
 
-        # have no better option than to automatically generate password from user_id
-        password = self._generate_password(user_id, settings.PASSWORD_GENERATOR_NONCE)
-
         # username and email might be empty, depending on how edX LTI module is configured:
         # there are individual settings for that + if it's embedded into an iframe it never sends
         # email and username in any case
         # so, since we want to track user for both iframe and non-iframe LTI blocks, username is completely ignored
         uname = self._compress_user_name(user_id)
         email = email if email else user_id+'@localhost'
-        try:
-            User.objects.get(username=uname)
-        except User.DoesNotExist:
-            try:
-                User.objects.create_user(username=uname, email=email, password=password)
-            except IntegrityError as e:
-                # A result of race condition of multiple simultaneous LTI requests - should be safe to ignore,
-                # as password and uname are stable (i.e. not change for the same user)
-                logger.info("IntegrityError creating user - assuming result of race condition: %s", e.message)
-
-        user = authenticate(username=uname, password=password)
-
-        if user and self.is_user_staff(extra_params):
+
+        # the launch request has been verified by its OAuth signature, so the user is logged in (and created if
+        # necessary) by dalite.backends.LTIBackend without any password; the password derived from the user id is
+        # only checked once for users created before LTI users had unusable passwords
+        password = None
+        if settings.PASSWORD_GENERATOR_NONCE:
+            password = self._generate_password(user_id, settings.PASSWORD_GENERATOR_NONCE)
+        user = authenticate(lti_username=uname, lti_email=email, lti_password=password)
+        if user is None:
+            # e.g. the LTI user id is the username of an admin account
+            raise PermissionDenied
+
+        if self.is_user_staff(extra_params):
             self.update_staff_user(user)
 
         login(request, user)
+
+        # the answers of the course are stored in the database of its tenant, see peerinst.routers
+        custom_key = '{}:{}'.format(extra_params.get('assignment_id'), extra_params.get('question_id'))
+        routers.set_session_tenant(
+            request, custom_key, extra_params.get('consumer_key'), extra_params.get('course_id')
+        )
         
         # LTI sessions are created implicitly, and are not terminated when user logs out of Studio/LMS, which may lead
         # to granting access to unauthorized users in shared computer setting. Students have no way to terminate dalite
@@ -141,13 +157,21 @@ class ApplicationHookManager(AbstractApplicationHookManager):
 
     def update_staff_user(self, user):
         """
-        Updates user to acknowledge he is a staff member
+        Updates user to acknowledge he is a staff member.  Since this runs on every launch, only the flag and the
+        permissions that are missing are written; usually, a single query checks that nothing needs to change.
         :param django.contrib.auth.models.User user:
         :return: None
         """
-        user.is_staff = True
-        user.user_permissions.add(*get_permissions_for_staff_user())
-        user.save()
+        permission_ids = get_staff_permission_ids()
+        granted_ids = user.user_permissions.through.objects.filter(
+            user=user, permission_id__in=permission_ids
+        ).values_list('permission_id', flat=True)
+        missing_ids = permission_ids.difference(granted_ids)
+        if missing_ids:
+            user.user_permissions.add(*missing_ids)
+        if not user.is_staff:
+            user.is_staff = True
+            user.save(update_fields=['is_staff'])
 
     def vary_by_key(self, lti_data):
         return ":".join(str(lti_data[k]) for k in self.LTI_KEYS)
@@ -165,7 +189,10 @@ class ApplicationHookManager(AbstractApplicationHookManager):
             # renames lis_person_name_given -> user_first_name, lis_person_name_family -> user_lat_name
             {'lis_person_name_given': 'user_first_name', 'lis_person_name_family': 'user_lat_name'}
         """
-        return {"roles": "roles"}
+        return {
+            "roles": "roles", "oauth_consumer_key": "consumer_key", "context_id": "course_id",
+            "custom_assignment_id": "assignment_id", "custom_question_id": "question_id",
+        }
 
 
 LTIView.register_authentication_manager(ApplicationHookManager())
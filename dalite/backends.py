@@ -0,0 +1,61 @@
+import logging
+
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+
+
+logger = logging.getLogger(__name__)
+
+
+class LTIBackend(object):
+    """
+    Authenticates users launching dalite from an LMS by their LTI user id alone.
+
+    The LTI launch request has already been verified by its OAuth signature when the authentication
+    hook runs, so there is no need to check a password -- hashing one on every launch was the most
+    expensive part of it.  Users are created with unusable passwords.
+
+    Only the authentication hook passes the `lti_username` keyword argument, so this backend is never
+    used for logins with a username and password.  Since the LTI user id is chosen by the LMS, it
+    must not give access to accounts that weren't created through LTI, e.g. an admin account with
+    the same username:  accounts with a usable password and superusers are refused.  Users created
+    before LTI users had unusable passwords have a password derived from their LTI user id, which
+    is checked once if it is passed as `lti_password`, and then made unusable.
+    """
+
+    def authenticate(self, lti_username=None, lti_email=None, lti_password=None):
+        if not lti_username:
+            return None
+        try:
+            user = User.objects.get(username=lti_username)
+        except User.DoesNotExist:
+            return self.create_user(lti_username, lti_email)
+        if user.is_superuser:
+            logger.warning("Refusing LTI login as the superuser %s.", lti_username)
+            return None
+        if user.has_usable_password():
+            if not lti_password or not user.check_password(lti_password):
+                logger.warning("Refusing LTI login as %s, which has a password.", lti_username)
+                return None
+            user.set_unusable_password()
+            user.save(update_fields=['password'])
+        return user
+
+    def create_user(self, lti_username, lti_email):
+        user = User(username=lti_username, email=lti_email or '')
+        user.set_unusable_password()
+        try:
+            with transaction.atomic():
+                user.save()
+        except IntegrityError as e:
+            # A result of race condition of multiple simultaneous LTI requests - the user has been
+            # created by the other request.
+            logger.info("IntegrityError creating user - assuming result of race condition: %s", e.message)
+            return self.authenticate(lti_username, lti_email)
+        return user
+
+    def get_user(self, user_id):
+        try:
+            return User.objects.get(pk=user_id)
+        except User.DoesNotExist:
+            return None
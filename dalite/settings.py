@@ -35,8 +35,15 @@ INSTALLED_APPS = (
     'django_lti_tool_provider'
 )
 
+AUTHENTICATION_BACKENDS = (
+    # Logs in users launching dalite through LTI without checking a password.
+    'dalite.backends.LTIBackend',
+    'django.contrib.auth.backends.ModelBackend',
+)
+
 MIDDLEWARE_CLASSES = (
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'peerinst.middleware.TenantMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -78,6 +85,29 @@ DATABASES = {
     }
 }
 
+# The student data of each tenant can be stored in its own database, and reports can be read from
+# replicas, see peerinst.routers.
+DATABASE_ROUTERS = ['peerinst.routers.ReplicaRouter']
+
+# Maps LTI consumer keys or course ids (LTI context ids) to the aliases of the databases their
+# answers, votes and LTI user data are stored in.  Tenants that aren't listed use the default
+# database, which always holds the shared tables.  Tenant databases are created with
+# "migrate --database=<alias>", and the data of a tenant is moved with the "move_tenant" management
+# command.  Tenant data references the shared tables across databases, so MySQL tenant databases
+# need the OPTIONS {'init_command': 'SET foreign_key_checks = 0'}.  For local testing, every alias
+# can be a separate SQLite database file.
+TENANT_DATABASES = {}
+
+# Maps database aliases to the aliases of their read replicas.  The admin reports and the answer
+# summary charts read from the replicas, so they don't compete with the submissions of students.
+# Replicas aren't migrated.  In tests, replicas should mirror their primary database with the
+# TEST setting {'MIRROR': '<alias>'}.
+DATABASE_REPLICAS = {}
+
+# The reports are read from the primary database instead of a replica if the latest answer in the
+# replica is older than the latest answer in the primary database by more than this many seconds.
+DATABASE_REPLICA_MAX_LAG = 60
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.8/topics/i18n/
 
@@ -113,10 +143,20 @@ LOGGING = {
             'class': 'logging.FileHandler',
             'filename': os.path.join(BASE_DIR, 'log/debug.log'),
         },
+        # Student events are written by a background thread, so the requests never wait for the
+        # disk.  If the queue is full, new events are dropped.  The log file is rotated daily or
+        # when it reaches 100 MB, and rotated files are compressed.  Each worker process writes its
+        # own shard, e.g. log/student-1234.log; use the merge_event_logs management command to get
+        # all events in order.
         'file_student_log': {
             'level': 'INFO',
-            'class': 'logging.FileHandler',
+            'class': 'peerinst.log_handlers.BufferedEventLogHandler',
             'filename': os.path.join(BASE_DIR, 'log/student.log'),
+            'max_bytes': 100 * 1024 * 1024,
+            'rotate_interval': 24 * 60 * 60,
+            'queue_size': 10000,
+            'overflow': 'drop',
+            'shard_by_pid': True,
         },
     },
     'loggers': {
@@ -130,6 +170,16 @@ LOGGING = {
             'level': 'INFO',
             'propagate': True,
         },
+        'peerinst.log_handlers': {
+            'handlers': ['file_debug_log'],
+            'level': 'WARNING',
+            'propagate': True,
+        },
+        'peerinst.routers': {
+            'handlers': ['file_debug_log'],
+            'level': 'WARNING',
+            'propagate': True,
+        },
         'django_lti_tool_provider.views': {
             'handlers': ['file_debug_log'],
             'level': 'DEBUG',
@@ -146,11 +196,34 @@ LTI_CLIENT_SECRET = os.environ.get('LTI_CLIENT_SECRET', None)
 
 # hint: LTi passport in edX Studio should look like <arbitrary_label>:LTI_CLIENT_KEY:LTI_CLIENT_SECRET
 
-# Used to automatically generate stable passwords from anonymous user ids coming from LTI requests - keep secret as well
-# If compromised, attackers would be able to restore any student passwords knowing his anonymous user ID from LMS
+# Used to generate the passwords of LTI users created before they were given unusable passwords, which are checked
+# once on their next launch - keep secret as well.  If compromised, attackers would be able to restore the passwords
+# of these students knowing their anonymous user ID from LMS
 PASSWORD_GENERATOR_NONCE = os.environ.get('PASSWORD_GENERATOR_NONCE', None)
+
+# Only enqueue grades during student requests instead of sending them to the LMS right away.  The
+# queued grades are sent by the "send_grades" management command, which must be kept running.
+LTI_GRADE_PASSBACK_ASYNC = False
 # LTI Integration end
 
+# Record rationale votes in an append-only buffer instead of updating the vote counters of the
+# answers directly.  The buffer must be folded into the counters periodically by running the
+# "flush_votes" management command, so vote counts become eventually consistent.
+VOTE_COUNTERS_WRITE_BEHIND = False
+
+# Log compact student events:  the question text is replaced by its SHA-256 digest, shown
+# rationales are only listed by answer id, the rationale selection algorithm is only identified by
+# name and version, and the JSON is written without whitespace.
+STUDENT_LOG_COMPACT_EVENTS = False
+
+# How statistics computed from the answers, i.e. aggregates.get_student_counts(), count the
+# distinct students:  "exact" collects their user tokens in memory, which grows with the number of
+# students and questions.  "distinct" counts them with COUNT(DISTINCT) queries in the database.
+# "approximate" estimates the counts with HyperLogLog sketches in constant memory, with a standard
+# error of about 1.6 %.  The assignment results read the sketches stored with the statistics
+# instead.
+STUDENT_COUNT_MODE = 'exact'
+
 # Configureation file for the heartbeat view, should contain json file. See this url for file contents.
 HEARTBEAT_REQUIRED_FREE_SPACE_PERCENTAGE = 20
 
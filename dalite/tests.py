@@ -1,98 +1,46 @@
 import ddt
 import mock
-from django.conf import settings
+from django.contrib.auth import authenticate
 from django.contrib.auth.models import User
-from django.db import IntegrityError
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.exceptions import PermissionDenied
 from django.test import SimpleTestCase, TestCase
+from django.test.utils import override_settings
 
 from dalite import ApplicationHookManager, LTIRoles
+from dalite.backends import LTIBackend
 from dalite.views import admin_index_wrapper
+from peerinst import routers
 
 
 @ddt.ddt
-@mock.patch('dalite.User.objects')
 class ApplicationHookManagerTests(SimpleTestCase):
     def setUp(self):
         self.manager = ApplicationHookManager()
 
-    def _get_uname_and_password(self, user_id):
-        uname = self.manager._compress_user_name(user_id)
-        password = self.manager._generate_password(user_id, settings.PASSWORD_GENERATOR_NONCE)
-        return uname, password
-
-    @staticmethod
-    def user_does_not_exist_side_effect(username="irrelevant"):
-        raise User.DoesNotExist()
-
-    @staticmethod
-    def integrity_error_side_effect(username="irrelevant"):
-        raise IntegrityError()
-
-    @ddt.unpack
-    @ddt.data(
-        ('FN-2187', 'fn-2187@first_order.com', True),
-        ('Kylo Ren', None, False),
-    )
-    def test_authentication_hook_user_exists(self, user_id, email, auth_result, user_objects_manager):
-        user_objects_manager.get.return_value = User()
-        request = mock.Mock()
-        expected_uname, expected_password = self._get_uname_and_password(user_id)
-
-        with mock.patch('dalite.authenticate') as authenticate_mock, mock.patch('dalite.login') as login_mock:
-            authenticate_mock.return_value = auth_result
-            self.manager.authentication_hook(request, user_id, 'irrelevant', email)
-
-            authenticate_mock.assert_called_once_with(username=expected_uname, password=expected_password)
-            login_mock.assert_called_once_with(request, auth_result)
-
-    @ddt.unpack
-    @ddt.data(
-        ('Luke Skywalker', 'luke27@tatooine.com', True),
-        ('Ben Solo', None, False),
-    )
-    def test_authentication_hook_user_missing(self, user_id, email, auth_result, user_objects_manager):
-        user_objects_manager.get.side_effect = self.user_does_not_exist_side_effect
-        request = mock.Mock()
-        expected_uname, expected_password = self._get_uname_and_password(user_id)
-        expected_email = email = email if email else user_id+'@localhost'
-
-        with mock.patch('dalite.authenticate') as authenticate_mock, mock.patch('dalite.login') as login_mock:
-            authenticate_mock.return_value = auth_result
-            self.manager.authentication_hook(request, user_id, 'irrelevant', email)
-
-            user_objects_manager.create_user.assert_called_once_with(
-                username=expected_uname, email=expected_email, password=expected_password
-            )
-            authenticate_mock.assert_called_once_with(username=expected_uname, password=expected_password)
-            login_mock.assert_called_once_with(request, auth_result)
-
     @ddt.unpack
     @ddt.data(
-        ('Luke Skywalker', 'luke27@tatooine.com', True),
-        ('Ben Solo', None, False),
+        ('FN-2187', 'fn-2187@first_order.com', 'fn-2187@first_order.com'),
+        ('Kylo Ren', None, 'Kylo Ren@localhost'),
     )
-    def test_authentication_hook_user_missing_integrity_error(self, user_id, email, auth_result, user_objects_manager):
-        user_objects_manager.get.side_effect = self.user_does_not_exist_side_effect
-        user_objects_manager.create.side_effect = self.integrity_error_side_effect
-        request = mock.Mock()
-        expected_uname, expected_password = self._get_uname_and_password(user_id)
-        expected_email = email = email if email else user_id+'@localhost'
+    def test_authentication_hook(self, user_id, email, expected_email):
+        user = User()
+        request = mock.Mock(session=SessionStore())
+        expected_uname = self.manager._compress_user_name(user_id)
 
         with mock.patch('dalite.authenticate') as authenticate_mock, mock.patch('dalite.login') as login_mock:
-            authenticate_mock.return_value = auth_result
+            authenticate_mock.return_value = user
             self.manager.authentication_hook(request, user_id, 'irrelevant', email)
 
-            user_objects_manager.create_user.assert_called_once_with(
-                username=expected_uname, email=expected_email, password=expected_password
+            authenticate_mock.assert_called_once_with(
+                lti_username=expected_uname, lti_email=expected_email, lti_password=None
             )
-            authenticate_mock.assert_called_once_with(username=expected_uname, password=expected_password)
-            login_mock.assert_called_once_with(request, auth_result)
+            login_mock.assert_called_once_with(request, user)
 
     @ddt.data(True, False)
-    def test_authentication_hook_admin_roles(self, is_admin, user_objects_manager):
+    def test_authentication_hook_admin_roles(self, is_admin):
         user = User()
-        user_objects_manager.get.return_value = user
-        request = mock.Mock()
+        request = mock.Mock(session=SessionStore())
 
         with mock.patch('dalite.authenticate') as authenticate_mock, mock.patch('dalite.login') as login_mock, \
                 mock.patch.object(ApplicationHookManager, 'is_user_staff') as is_user_staff, \
@@ -107,6 +55,24 @@ class ApplicationHookManagerTests(SimpleTestCase):
 
             self.assertEqual(update_staff_user.called, is_admin)
 
+    @override_settings(TENANT_DATABASES={'course-v1:Big+B1+now': 'big'})
+    def test_authentication_hook_tenant(self):
+        request = mock.Mock(session=SessionStore())
+        self.addCleanup(routers.deactivate)
+
+        with mock.patch('dalite.authenticate') as authenticate_mock, mock.patch('dalite.login'):
+            authenticate_mock.return_value = User()
+            self.manager.authentication_hook(
+                request, 'irrelevant', 'irrelevant', 'irrelevant',
+                {'consumer_key': 'key', 'course_id': 'course-v1:Big+B1+now', 'assignment_id': 'a', 'question_id': 1}
+            )
+
+        self.assertEqual(
+            request.session[routers.TENANT_SESSION_KEY],
+            {'a:1': {'consumer_key': 'key', 'course_id': 'course-v1:Big+B1+now'}}
+        )
+        self.assertEqual(routers.get_active_database(), 'big')
+
     @ddt.unpack
     @ddt.data(
         ({}, False),
@@ -118,7 +84,7 @@ class ApplicationHookManagerTests(SimpleTestCase):
         ({"roles": [LTIRoles.LEARNER, LTIRoles.INSTRUCTOR]}, True),
         ({"roles": [LTIRoles.LEARNER, LTIRoles.STAFF]}, True),
     )
-    def test_is_staff_user(self, extra_args, is_staff_expected, user_objects_manager):
+    def test_is_staff_user(self, extra_args, is_staff_expected):
         is_staff_actual = self.manager.is_user_staff(extra_args)
         self.assertEqual(is_staff_actual, is_staff_expected)
 
@@ -127,7 +93,7 @@ class ApplicationHookManagerTests(SimpleTestCase):
         ('assignment_1', 1),
         ('assignment_2', 2),
     )
-    def test_authenticated_redirect_normal(self, assignment_id, question_id, user_objects_manager):
+    def test_authenticated_redirect_normal(self, assignment_id, question_id):
         request = mock.Mock()
         request.user.is_staff = False
         lti_data = {
@@ -151,7 +117,7 @@ class ApplicationHookManagerTests(SimpleTestCase):
     )
     @ddt.unpack
     def test_authenticated_redirect_studio_user(
-            self, assignment_id, question_id, action, expected_redirect, user_objects_manager):
+            self, assignment_id, question_id, action, expected_redirect):
         request = mock.Mock()
         request.user.is_staff = True
         request.user.username = "student"
@@ -168,6 +134,65 @@ class ApplicationHookManagerTests(SimpleTestCase):
         self.assertEqual(actual_redirect, expected_redirect)
 
 
+class LTIBackendTests(TestCase):
+    def setUp(self):
+        self.backend = LTIBackend()
+
+    def test_authenticate_creates_user(self):
+        user = self.backend.authenticate(lti_username='student', lti_email='student@localhost')
+        self.assertEqual((user.username, user.email), ('student', 'student@localhost'))
+        self.assertFalse(user.has_usable_password())
+        self.assertEqual(self.backend.authenticate(lti_username='student', lti_email='other'), user)
+        self.assertEqual(User.objects.count(), 1)
+
+    def test_authenticate_race_condition(self):
+        existing = User.objects.create(username='student')
+        with mock.patch('dalite.backends.User.objects.get') as get_mock:
+            get_mock.side_effect = [User.DoesNotExist(), existing]
+            user = self.backend.authenticate(lti_username='student', lti_email='student@localhost')
+        self.assertEqual(user, existing)
+
+    def test_authenticate_with_password(self):
+        User.objects.create_user(username='student', password='password')
+        user = authenticate(username='student', password='password')
+        self.assertEqual(user.backend, 'django.contrib.auth.backends.ModelBackend')
+        self.assertIsNone(self.backend.authenticate(lti_username=None))
+
+    def test_authenticate_refuses_other_accounts(self):
+        User.objects.create_superuser(username='admin', email='admin@localhost', password='password')
+        staff = User.objects.create(username='staff', is_staff=True)
+        staff.set_password('password')
+        staff.save()
+        superuser = User.objects.create(username='superuser', is_superuser=True)
+        superuser.set_unusable_password()
+        superuser.save()
+        for username in ['admin', 'staff', 'superuser']:
+            self.assertIsNone(self.backend.authenticate(lti_username=username))
+            self.assertIsNone(self.backend.authenticate(lti_username=username, lti_password='other'))
+
+    def test_authenticate_derived_password(self):
+        # Users created by older versions have a password derived from their LTI user id.
+        existing = User.objects.create_user(username='student', password='derived')
+        self.assertIsNone(self.backend.authenticate(lti_username='student'))
+        user = self.backend.authenticate(lti_username='student', lti_password='derived')
+        self.assertEqual(user, existing)
+        self.assertFalse(User.objects.get(pk=user.pk).has_usable_password())
+        self.assertEqual(self.backend.authenticate(lti_username='student'), existing)
+
+    def test_launch_as_admin(self):
+        User.objects.create_superuser(username='admin', email='admin@localhost', password='password')
+        request = mock.Mock(session=SessionStore())
+        with mock.patch('dalite.login') as login_mock:
+            with self.assertRaises(PermissionDenied):
+                ApplicationHookManager().authentication_hook(request, 'admin', 'admin', None)
+        self.assertFalse(login_mock.called)
+
+    def test_authenticate_through_django(self):
+        user = authenticate(lti_username='student', lti_email='student@localhost')
+        self.assertEqual(user.backend, 'dalite.backends.LTIBackend')
+        self.assertEqual(self.backend.get_user(user.pk), user)
+
+
 class TestUpdateStaffUser(TestCase):
     def setUp(self):
         self.manager = ApplicationHookManager()
@@ -181,6 +206,22 @@ class TestUpdateStaffUser(TestCase):
         self.manager.update_staff_user(user)
         actual_perms = set((p.codename for p in user.user_permissions.all()))
         self.assertEqual(expected_perms, actual_perms)
+        self.assertTrue(User.objects.get(pk=user.pk).is_staff)
+
+    def test_update_staff_user_unchanged(self):
+        user = User.objects.create(username="test")
+        self.manager.update_staff_user(user)
+        user = User.objects.get(pk=user.pk)
+        # Nothing is written when the user already has the staff flag and all permissions.
+        with self.assertNumQueries(1):
+            self.manager.update_staff_user(user)
+
+    def test_update_staff_user_missing_permission(self):
+        user = User.objects.create(username="test", is_staff=True)
+        self.manager.update_staff_user(user)
+        user.user_permissions.remove(user.user_permissions.get(codename='change_question'))
+        self.manager.update_staff_user(User.objects.get(pk=user.pk))
+        self.assertEqual(user.user_permissions.count(), 6)
 
 
 class TestViews(TestCase):
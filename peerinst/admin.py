@@ -4,8 +4,13 @@ from __future__ import unicode_literals
 from django.core import exceptions
 from django import forms
 from django.contrib import admin
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
-from .models import Answer, AnswerChoice, Assignment, Question, Category
+from . import bulk_jobs, grade_passback, routers
+from .models import (
+    Answer, AnswerChoice, ArchivedAnswer, Assignment, BulkJob, Question, Category, GradePassback,
+    SentGrade
+)
 
 
 class AnswerChoiceInlineForm(forms.ModelForm):
@@ -39,15 +44,28 @@ class AnswerChoiceInline(admin.TabularInline):
 
 
 class AnswerModelForm(forms.ModelForm):
+    # The rationale isn't a model field, since the texts are stored separately.
+    rationale = forms.CharField(
+        label=_('Rationale'), widget=forms.Textarea,
+        help_text=_('An example rationale that will be shown to students during the answer review.'),
+    )
+
     class Meta:
         labels = {'first_answer_choice': _('Associated answer')}
         help_texts = {
-            'rationale':
-                _('An example rationale that will be shown to students during the answer review.'),
             'first_answer_choice':
                 _('The number of the associated answer; 1 = first answer, 2 = second answer etc.'),
         }
 
+    def __init__(self, *args, **kwargs):
+        forms.ModelForm.__init__(self, *args, **kwargs)
+        if self.instance.pk is not None:
+            self.fields['rationale'].initial = self.instance.rationale
+
+    def save(self, commit=True):
+        self.instance.rationale = self.cleaned_data['rationale']
+        return forms.ModelForm.save(self, commit)
+
 
 class AnswerInline(admin.StackedInline):
     model = Answer
@@ -71,8 +89,35 @@ class AnswerInline(admin.StackedInline):
         return qs.filter(user_token='', show_to_others=True)
 
 
+def delete_in_background(modeladmin, request, queryset):
+    for obj in queryset:
+        bulk_jobs.enqueue_delete(obj)
+    modeladmin.message_user(request, _(
+        'The deletion of {count} objects has been scheduled.  Check the bulk jobs for progress.'
+    ).format(count=len(queryset)))
+delete_in_background.short_description = _('Delete selected %(verbose_name_plural)s')
+
+
+class BackgroundDeleteMixin(object):
+    """Delete objects with many answers in the background instead of in the request.
+
+    This replaces the default delete action, and hides the delete button on the change page.
+    """
+    actions = [delete_in_background]
+
+    def get_actions(self, request):
+        actions = admin.ModelAdmin.get_actions(self, request)
+        actions.pop('delete_selected', None)
+        return actions
+
+    def has_delete_permission(self, request, obj=None):
+        if obj is not None:
+            return False
+        return admin.ModelAdmin.has_delete_permission(self, request, obj)
+
+
 @admin.register(Question)
-class QuestionAdmin(admin.ModelAdmin):
+class QuestionAdmin(BackgroundDeleteMixin, admin.ModelAdmin):
     fieldsets = [
         (None, {'fields': ['title', 'text', 'category', 'id']}),
         (_('Question image or video'), {'fields': ['image', 'image_alt_text', 'video_url']}),
@@ -97,20 +142,107 @@ class CategoryAdmin(admin.ModelAdmin):
 
 
 @admin.register(Assignment)
-class AssignmentAdmin(admin.ModelAdmin):
+class AssignmentAdmin(BackgroundDeleteMixin, admin.ModelAdmin):
     filter_horizontal = ['questions']
 
 
 def publish_answers(modeladmin, request, queryset):
-    queryset.update(show_to_others=True)
+    answer_ids = list(queryset.values_list('pk', flat=True))
+    if len(answer_ids) <= bulk_jobs.INLINE_UPDATE_LIMIT:
+        Answer.objects.filter(pk__in=answer_ids).update(show_to_others=True)
+        return
+    bulk_jobs.enqueue_publish_answers(answer_ids)
+    modeladmin.message_user(request, _(
+        'Updating {count} answers has been scheduled.  Check the bulk jobs for progress.'
+    ).format(count=len(answer_ids)))
 publish_answers.short_description = _('Show selected answers to students')
 
 
 @admin.register(Answer)
 class AnswerAdmin(admin.ModelAdmin):
     list_display = ['question', 'user_token', 'first_answer_choice_label', 'second_answer_choice_label',
-                    'rationale', 'show_to_others', 'expert', 'chosen_rationale', 'upvotes', 'downvotes']
+                    'rationale', 'show_to_others', 'expert', 'chosen_rationale', 'upvotes', 'downvotes',
+                    'times_shown', 'times_chosen']
     list_display_links = None
     list_editable = ['show_to_others', 'expert']
     list_filter=['chosen_rationale']
     actions = [publish_answers]
+
+    def get_queryset(self, request):
+        return admin.ModelAdmin.get_queryset(self, request).prefetch_related('rationale_text')
+
+
+@admin.register(ArchivedAnswer)
+class ArchivedAnswerAdmin(admin.ModelAdmin):
+    list_display = ['id', 'question', 'assignment', 'user_token', 'first_answer_choice',
+                    'second_answer_choice', 'chosen_rationale_id', 'upvotes', 'downvotes',
+                    'times_shown', 'times_chosen', 'archived']
+    list_display_links = None
+    list_filter = ['assignment']
+
+    def has_add_permission(self, request):
+        return False
+
+
+def retry_grade_passbacks(modeladmin, request, queryset):
+    queryset.update(status=GradePassback.PENDING, attempts=0, next_attempt=timezone.now(), claim='')
+retry_grade_passbacks.short_description = _('Retry sending selected grades')
+
+
+@admin.register(GradePassback)
+class GradePassbackAdmin(admin.ModelAdmin):
+    list_display = ['user', 'custom_key', 'grade', 'status', 'attempts', 'next_attempt', 'last_error']
+    list_filter = ['status']
+    actions = [retry_grade_passbacks]
+
+
+def resend_grades(modeladmin, request, queryset):
+    resent = 0
+    for sent_grade in queryset.select_related('user'):
+        assignment_id, question_id = sent_grade.custom_key.rsplit(':', 1)
+        # The answer and the LTI user data are in the database of the student's tenant.
+        for database in routers.get_tenant_databases():
+            with routers.use_database(database):
+                answer = Answer.objects.filter(
+                    assignment_id=assignment_id,
+                    question_id=question_id,
+                    user_token=sent_grade.user.username,
+                ).select_related('question').first()
+                if answer is None:
+                    continue
+                grade_passback.pass_back_grade(
+                    sent_grade.user, sent_grade.custom_key, answer.get_grade(), force=True
+                )
+                resent += 1
+                break
+    modeladmin.message_user(request, _('Resent {count} grades.').format(count=resent))
+resend_grades.short_description = _('Recompute and resend selected grades')
+
+
+@admin.register(SentGrade)
+class SentGradeAdmin(admin.ModelAdmin):
+    list_display = ['user', 'custom_key', 'grade', 'sent']
+    search_fields = ['user__username', 'custom_key']
+    actions = [resend_grades]
+
+
+def retry_bulk_jobs(modeladmin, request, queryset):
+    # The jobs resume where they failed, see peerinst.bulk_jobs.
+    retried = queryset.filter(status=BulkJob.FAILED).update(
+        status=BulkJob.PENDING, last_error='', updated=timezone.now()
+    )
+    modeladmin.message_user(request, _('Retrying {count} failed jobs.').format(count=retried))
+retry_bulk_jobs.short_description = _('Retry selected failed jobs')
+
+
+@admin.register(BulkJob)
+class BulkJobAdmin(admin.ModelAdmin):
+    list_display = ['description', 'kind', 'status', 'processed', 'total', 'created', 'updated',
+                    'last_error']
+    list_filter = ['status', 'kind']
+    fields = list_display
+    readonly_fields = list_display
+    actions = [retry_bulk_jobs]
+
+    def has_add_permission(self, request):
+        return False
@@ -8,16 +8,18 @@ import urllib
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib import messages
 from django.core.urlresolvers import reverse
-from django.db.models import F
 from django import forms
 from django.shortcuts import get_object_or_404, redirect
 from django.utils.translation import ugettext_lazy as _
 from django.views.generic.base import TemplateView
 from django.views.generic.edit import FormView
 from .forms import FirstAnswerForm
+from . import aggregates
 from . import models
+from . import routers
 from .admin import AnswerAdmin
-from .util import make_percent_function
+from .routers import UseReplicaMixin
+from .util import HyperLogLog, make_percent_function
 
 
 class StaffMemberRequiredMixin(object):
@@ -36,58 +38,59 @@ class AdminIndexView(StaffMemberRequiredMixin, TemplateView):
         return context
 
 
-def get_question_aggregates(assignment, question):
-    """Get aggregate statistics for the given assignment and question.
+def get_answer_querysets(assignment, include_archived=False):
+    """Return the querysets of the answers entered by students for the given assignment.
 
-    This function returns a pair (sums, students), where 'sums' is a collections.Counter object
-    mapping labels to integers, and 'students' is the set of all user tokens of the submitted
-    answers.
+    These are the answers and, if `include_archived` is true, the archived answers, in the
+    databases of all tenants.  Example answers are excluded.
     """
-    # Get indices of the correct answer choices (usually only one)
-    answerchoice_correct = question.answerchoice_set.values_list('correct', flat=True)
-    correct_choices = list(itertools.compress(itertools.count(1), answerchoice_correct))
-    # Select answers entered by students, not example answers
-    answers = question.answer_set.filter(assignment=assignment).exclude(user_token='')
-    switched_answers = answers.exclude(second_answer_choice=F('first_answer_choice'))
-    sums = collections.Counter(
-        total_answers=answers.count(),
-        correct_first_answers=answers.filter(first_answer_choice__in=correct_choices).count(),
-        correct_second_answers=answers.filter(second_answer_choice__in=correct_choices).count(),
-        switches=switched_answers.count(),
-    )
-    for choice_index in range(1, question.answerchoice_set.count() + 1):
-        key = ('switches', choice_index)
-        count = switched_answers.filter(second_answer_choice=choice_index).count()
-        if count:
-            sums[key] = count
-    # Get a set of all user tokens.  DISTINCT queries are not implemented for MySQL, so this is the
-    # only way I can think of to determine the number of students who answered at least one
-    # question in an assignment.
-    students = set(answers.values_list('user_token', flat=True))
-    return sums, students
+    answer_models = [models.Answer]
+    if include_archived:
+        answer_models.append(models.ArchivedAnswer)
+    return [
+        model.objects.using(database).filter(assignment=assignment).exclude(user_token='')
+        for database in routers.get_tenant_read_databases()
+        for model in answer_models
+    ]
 
 
-def get_assignment_aggregates(assignment):
-    """Get aggregate statistics for the given assignment.
+def get_assignment_stats(assignment, include_archived=False):
+    """Get aggregate statistics for the given assignment from the AssignmentQuestionStats table.
 
     This function returns a pair (sums, question_data), where sums is a collections.Counter object
     mapping labels to integers, and question_data is a list of pairs (question, sums) with the sums
-    for the respective question.
+    for the respective question.  The sums are derived from the transition matrices stored in the
+    statistics tables of all tenant databases, and the students are estimated from the HyperLogLog
+    sketches stored along with them, so the answers aren't read at all.  Archived answers are only
+    included if `include_archived` is true.
     """
+    questions = list(assignment.questions.all())
+    matrices = collections.defaultdict(aggregates.TransitionMatrix)
+    students = collections.defaultdict(HyperLogLog)
+    for database in routers.get_tenant_read_databases():
+        db_matrices, db_students = models.AssignmentQuestionStats.objects.db_manager(
+            database
+        ).get_stats(assignment.pk, include_archived)
+        for question_id, matrix in db_matrices.iteritems():
+            matrices[question_id].update(matrix)
+        for question_id, sketch in db_students.iteritems():
+            students[question_id].update(sketch)
     sums = collections.Counter()
-    students = set()
+    all_students = HyperLogLog()
     question_data = []
-    for question in assignment.questions.all():
-        q_sums, q_students = get_question_aggregates(assignment, question)
+    for question in questions:
+        q_sums = matrices.get(question.pk, aggregates.TransitionMatrix()).get_sums(question)
         sums += q_sums
-        students |= q_students
+        q_students = students.get(question.pk, HyperLogLog())
+        all_students.update(q_students)
         q_sums.update(total_students=len(q_students))
         question_data.append((question, q_sums))
-    sums.update(total_students=len(students))
+    sums.update(total_students=len(all_students))
     return sums, question_data
 
 
-def get_question_rationale_aggregates(assignment, question, perpage, choice_id=None, include_own_rationales=False):
+def get_question_rationale_aggregates(assignment, question, perpage, choice_id=None,
+                                      include_own_rationales=False, include_archived=False):
     """Get the top `perpage` rationales for answers to the given assignment and question.
 
     This function returns a pair (sums, rationales), with entries for these groups of rationales:
@@ -97,6 +100,8 @@ def get_question_rationale_aggregates(assignment, question, perpage, choice_id=N
     * 'wrong_to_right': chosen rationales for answers that switched from wrong to right
 
     `perpage` limits the number of rationales returned, but does not affect the counts in the returned `sums`.
+    Archived answers are only included if `include_archived` is true.  The rationales can then be
+    archived answers as well.
 
     'sums' is a collection.Counter object mapping the above rationale group labels to total rationale counts.
 
@@ -122,65 +127,109 @@ def get_question_rationale_aggregates(assignment, question, perpage, choice_id=N
 
     """
     # Select answers entered by students, not example answers
-    answers = question.answer_set.filter(assignment=assignment).exclude(user_token='')
+    answer_querysets = [
+        answers.filter(question=question)
+        for answers in get_answer_querysets(assignment, include_archived)
+    ]
 
     if choice_id is not None:
         # Filter the answers we look at to just those who eventually chose
         # the option we're interested in - we want to know which rationales
         # were convincing for this answer.
-        answers = answers.filter(second_answer_choice=choice_id)
+        answer_querysets = [
+            answers.filter(second_answer_choice=choice_id) for answers in answer_querysets
+        ]
 
     # Get indices of the correct answer choice(s)
-    answerchoice_correct = question.answerchoice_set.values_list('correct', flat=True)
-    correct_choices = list(itertools.compress(itertools.count(1), answerchoice_correct))
-
-    # Helper function collects chosen rationales and the number of times used from a list of answers
-    def _top_rationales(answer_list):
-        # Count the chosen rationales for the given answer list, counting the answer's original
-        # rationale if there's no related chosen rationale (the student stuck with their original rationale)
-        # and the function was called with include_own_rationales=True
-        counts = collections.Counter(
-            a.chosen_rationale or (
-                # If a.chosen_rationale isn't truthy (in other words, if it is None),
-                # count a itself if include_own_rationales is True; otherwise, count None
-                a if include_own_rationales else None
-            ) 
-            for a in answer_list.select_related('chosen_rationale')
-        )
+    correct_choices = question.get_correct_choices()
+
+    # Helper function collects chosen rationales and the number of times used from lists of answers
+    def _top_rationales(answer_querysets):
+        # Count the chosen rationales by database and id for the given answer lists, counting the
+        # answer's original rationale if there's no chosen rationale (the student stuck with their
+        # original rationale) and the function was called with include_own_rationales=True
+        counts = collections.Counter()
+        for answers in answer_querysets:
+            rationale_ids = (
+                # If chosen_rationale_id is None, count the answer itself if include_own_rationales
+                # is True; otherwise, count None
+                chosen_rationale_id or (answer_id if include_own_rationales else None)
+                for answer_id, chosen_rationale_id
+                in answers.values_list('id', 'chosen_rationale_id').iterator()
+            )
+            counts.update(
+                (answers.db, rationale_id) if rationale_id is not None else None
+                for rationale_id in rationale_ids
+            )
 
-        # Return a list of dicts, sorted by descending count
-        sorted_list = [dict(rationale=rationale, count=counts[rationale])
-                       for rationale in sorted(counts, key=counts.get, reverse=True)]
+        # Return a list of dicts, sorted by descending count.  The rationales are loaded below.
+        sorted_list = [dict(rationale=rationale_id, count=counts[rationale_id])
+                       for rationale_id in sorted(counts, key=counts.get, reverse=True)]
         return sorted_list[:perpage], len(sorted_list)
 
     # Collect the upvoted rationales, sorted by descending upvotes
-    output = {'upvoted': []}
-    upvoted = answers.exclude(upvotes=0).order_by('-upvotes')
-    for rationale in upvoted.all()[:perpage]:
-        output['upvoted'].append({'rationale': rationale, 'count': rationale.upvotes})
+    upvoted = [answers.exclude(upvotes=0).order_by('-upvotes') for answers in answer_querysets]
+    top_upvoted = sorted(
+        itertools.chain.from_iterable(answers[:perpage] for answers in upvoted),
+        key=lambda rationale: rationale.upvotes, reverse=True,
+    )
+    output = {'upvoted': [
+        {'rationale': rationale, 'count': rationale.upvotes} for rationale in top_upvoted[:perpage]
+    ]}
 
     # Show totals in the sums counter
     sums = collections.Counter()
-    sums['upvoted'] = upvoted.count()
+    sums['upvoted'] = sum(answers.count() for answers in upvoted)
 
     # Collect top rationales chosen for all answers
-    output['chosen'], sums['chosen'] = _top_rationales(answers)
+    output['chosen'], sums['chosen'] = _top_rationales(answer_querysets)
 
     # Collect top rationales chosen for answers switched from wrong to right
-    wrong_to_right = (answers.exclude(first_answer_choice__in=correct_choices)
-                      .filter(second_answer_choice__in=correct_choices))
-    output['wrong_to_right'], sums['wrong_to_right'] = _top_rationales(wrong_to_right)
+    output['wrong_to_right'], sums['wrong_to_right'] = _top_rationales([
+        answers.exclude(first_answer_choice__in=correct_choices)
+        .filter(second_answer_choice__in=correct_choices)
+        for answers in answer_querysets
+    ])
 
     # Collect top rationales chosen for answers switched from right to wrong
-    right_to_wrong = (answers.exclude(second_answer_choice__in=correct_choices)
-                      .filter(first_answer_choice__in=correct_choices))
-    output['right_to_wrong'], sums['right_to_wrong'] = _top_rationales(right_to_wrong)
+    output['right_to_wrong'], sums['right_to_wrong'] = _top_rationales([
+        answers.exclude(second_answer_choice__in=correct_choices)
+        .filter(first_answer_choice__in=correct_choices)
+        for answers in answer_querysets
+    ])
+
+    # Load the chosen rationales of all lists with a single query per database, and those that
+    # have been archived with another one
+    chosen_lists = [output['chosen'], output['wrong_to_right'], output['right_to_wrong']]
+    rationale_keys = {
+        item['rationale'] for items in chosen_lists for item in items
+        if item['rationale'] is not None
+    }
+    rationales = {}
+    for database in {database for database, unused_id in rationale_keys}:
+        rationale_ids = {pk for key_database, pk in rationale_keys if key_database == database}
+        loaded = models.Answer.objects.using(database).in_bulk(rationale_ids)
+        if include_archived and rationale_ids - set(loaded):
+            loaded.update(
+                models.ArchivedAnswer.objects.using(database).in_bulk(rationale_ids - set(loaded))
+            )
+        rationales.update(((database, pk), rationale) for pk, rationale in loaded.iteritems())
+    for items in chosen_lists:
+        for item in items:
+            if item['rationale'] is not None:
+                item['rationale'] = rationales[item['rationale']]
+
+    # Load the rationale texts of all lists with a single query
+    models.Answer.objects.resolve_rationales([
+        item['rationale'] for items in output.itervalues() for item in items
+        if item['rationale'] is not None
+    ])
 
     # Return the sums and final sorted lists of rationales
     return sums, output
 
 
-class QuestionRationaleView(StaffMemberRequiredMixin, TemplateView):
+class QuestionRationaleView(StaffMemberRequiredMixin, UseReplicaMixin, TemplateView):
     template_name = "admin/peerinst/question_rationales.html"
 
     @staticmethod
@@ -264,10 +313,14 @@ class QuestionRationaleView(StaffMemberRequiredMixin, TemplateView):
         if (perpage is None) or (perpage <= 0) or (perpage > AnswerAdmin.list_per_page):
             perpage = AnswerAdmin.list_per_page
 
-        sums, rationale_data = get_question_rationale_aggregates(assignment, question, perpage)
+        include_archived = self.request.GET.get('include_archived') == 'true'
+        sums, rationale_data = get_question_rationale_aggregates(
+            assignment, question, perpage, include_archived=include_archived
+        )
         context.update(
             assignment=assignment,
             question=question,
+            include_archived=include_archived,
             summary_data=self.prepare_summary_data(sums),
             rationale_data=self.prepare_rationale_data(rationale_data),
             perpage=perpage,
@@ -275,7 +328,7 @@ class QuestionRationaleView(StaffMemberRequiredMixin, TemplateView):
         return context
 
 
-class AssignmentResultsView(StaffMemberRequiredMixin, TemplateView):
+class AssignmentResultsView(StaffMemberRequiredMixin, UseReplicaMixin, TemplateView):
     template_name = "admin/peerinst/assignment_results.html"
 
     def prepare_stats(self, sums, switch_columns):
@@ -324,7 +377,7 @@ class AssignmentResultsView(StaffMemberRequiredMixin, TemplateView):
                 link_rationales=reverse('question-rationales', kwargs={
                     'assignment_id': self.assignment_id,
                     'question_id': question.id,
-                }),
+                }) + ('?include_archived=true' if self.include_archived else ''),
             ))
         labels = [
             _('No.'), _('Question ID'), _('Total answers'), _('Total students'),
@@ -340,10 +393,12 @@ class AssignmentResultsView(StaffMemberRequiredMixin, TemplateView):
         context = TemplateView.get_context_data(self, **kwargs)
         self.assignment_id = self.kwargs['assignment_id']
         assignment = get_object_or_404(models.Assignment, identifier=self.assignment_id)
-        sums, question_data = get_assignment_aggregates(assignment)
+        self.include_archived = self.request.GET.get('include_archived') == 'true'
+        sums, question_data = get_assignment_stats(assignment, self.include_archived)
         switch_columns = sorted(k[1] for k in sums if isinstance(k, tuple) and k[0] == 'switches')
         context.update(
             assignment=assignment,
+            include_archived=self.include_archived,
             assignment_data=self.prepare_assignment_data(sums, switch_columns),
             question_data=self.prepare_question_data(question_data, switch_columns),
         )
@@ -447,7 +502,7 @@ class FakeCountries(StringListView):
     model_class = models.FakeCountry
 
 
-def aggregate_fake_attribution_data(votes_qs):
+def aggregate_fake_attribution_data(votes_querysets):
 
     def update_aggregates(data, key, vote_type):
         aggregates = data.get(key)
@@ -464,10 +519,11 @@ def aggregate_fake_attribution_data(votes_qs):
     # We are using plain dictionaries instead of collections.defaultdict for perfromance reasons.
     username_data = {}
     country_data = {}
-    for answer_vote in votes_qs.iterator():
-        vote_type = answer_vote.vote_type
-        update_aggregates(username_data, answer_vote.fake_username, vote_type)
-        update_aggregates(country_data, answer_vote.fake_country, vote_type)
+    for votes_qs in votes_querysets:
+        for answer_vote in votes_qs.iterator():
+            vote_type = answer_vote.vote_type
+            update_aggregates(username_data, answer_vote.fake_username, vote_type)
+            update_aggregates(country_data, answer_vote.fake_country, vote_type)
     return username_data, country_data
 
 
@@ -478,9 +534,10 @@ class AttributionAnalysisFilterForm(forms.Form):
     question = forms.ModelChoiceField(
         models.Question.objects.all(), empty_label=_('---all---'), required=False
     )
+    include_archived = forms.BooleanField(label=_('Include archived answers'), required=False)
 
 
-class AttributionAnalysis(TemplateView):
+class AttributionAnalysis(UseReplicaMixin, TemplateView):
     template_name = "admin/peerinst/attribution_analysis.html"
 
     def get_aggregates(self, form_data):
@@ -505,8 +562,14 @@ class AttributionAnalysis(TemplateView):
             filters['assignment'] = assignment
         if question is not None:
             filters['answer__question'] = question
-        votes_qs = models.AnswerVote.objects.filter(**filters)
-        username_data, country_data = aggregate_fake_attribution_data(votes_qs)
+        vote_models = [models.AnswerVote]
+        if form_data['include_archived']:
+            vote_models.append(models.ArchivedAnswerVote)
+        username_data, country_data = aggregate_fake_attribution_data([
+            model.objects.using(database).filter(**filters)
+            for database in routers.get_tenant_read_databases()
+            for model in vote_models
+        ])
         username_data_table = list(itertools.starmap(
             extract_columns, sorted(username_data.iteritems())
         ))
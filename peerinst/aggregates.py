@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""Answer statistics derived from transition matrices.
+
+The transition matrix of a question counts its answers by pairs of first and second answer
+choice.  A single grouped query returns the matrices of all questions of an assignment, and the
+totals, correct answers and switches shown in the reports are all derived from them, instead of
+running several COUNT queries per question and answer choice.
+"""
+from __future__ import unicode_literals
+
+import collections
+
+from django.conf import settings
+from django.db.models import Count
+
+from .util import HyperLogLog
+
+
+class TransitionMatrix(collections.Counter):
+    """Maps (first answer choice, second answer choice) pairs to numbers of answers.
+
+    The second answer choice is None for answers that haven't been completed.
+    """
+
+    def first_choice_count(self, index):
+        return sum(count for (first, unused_second), count in self.iteritems() if first == index)
+
+    def second_choice_count(self, index):
+        return sum(count for (unused_first, second), count in self.iteritems() if second == index)
+
+    def get_sums(self, question):
+        """Return the statistics of the answers to the given question.
+
+        The result is a collections.Counter object with the number of answers, correct first and
+        second answers and switches, and the number of switches to each answer choice as
+        ('switches', index) if there are any.
+        """
+        sums = collections.Counter(
+            total_answers=0, correct_first_answers=0, correct_second_answers=0, switches=0
+        )
+        for (first, second), count in self.iteritems():
+            sums['total_answers'] += count
+            if question.is_correct(first):
+                sums['correct_first_answers'] += count
+            if question.is_correct(second):
+                sums['correct_second_answers'] += count
+            if second != first:
+                sums['switches'] += count
+                if second is not None and 0 < second <= question.choice_count:
+                    sums['switches', second] += count
+        return sums
+
+
+def get_transition_matrices(answer_querysets):
+    """Return a dict mapping question ids to the transition matrices of the given answers.
+
+    `answer_querysets` is a list of querysets of answers or archived answers, which are counted
+    together.  Runs one grouped query per queryset.
+    """
+    matrices = collections.defaultdict(TransitionMatrix)
+    for answers in answer_querysets:
+        rows = (
+            answers.order_by()
+            .values_list('question_id', 'first_answer_choice', 'second_answer_choice')
+            .annotate(count=Count('id'))
+        )
+        for question_id, first, second, count in rows:
+            matrices[question_id][first, second] += count
+    return matrices
+
+
+def count_distinct_in_database(answer_querysets):
+    """Count the distinct students with COUNT(DISTINCT) queries, see get_student_counts()."""
+    by_question = collections.Counter()
+    total = 0
+    for i, answers in enumerate(answer_querysets):
+        # A student has only one answer per question and assignment, either current or archived,
+        # so the counts per question are added up.
+        by_question.update(dict(
+            answers.order_by().values('question_id')
+            .annotate(students=Count('user_token', distinct=True))
+            .values_list('question_id', 'students')
+        ))
+        # Students with answers in several querysets are only counted in the first one.  The
+        # databases of different tenants can't be compared in a query, so students with answers
+        # in several of them are counted once per database.
+        for previous in answer_querysets[:i]:
+            if previous.db == answers.db:
+                answers = answers.exclude(user_token__in=previous.values('user_token'))
+        total += answers.aggregate(students=Count('user_token', distinct=True))['students']
+    return total, by_question
+
+
+def get_student_counts(answer_querysets, question_ids):
+    """Return the number of distinct students who answered the given questions.
+
+    Returns a pair (total, by_question), where by_question maps question ids to the number of
+    students who answered the question.  Depending on the setting STUDENT_COUNT_MODE, the user
+    tokens are either collected in sets ("exact"), counted by the database ("distinct"), or their
+    number is estimated with HyperLogLog sketches in constant memory ("approximate").
+    """
+    answer_querysets = [
+        answers.filter(question_id__in=question_ids) for answers in answer_querysets
+    ]
+    if settings.STUDENT_COUNT_MODE == 'distinct':
+        return count_distinct_in_database(answer_querysets)
+    counter_class = HyperLogLog if settings.STUDENT_COUNT_MODE == 'approximate' else set
+    counters = collections.defaultdict(counter_class)
+    for answers in answer_querysets:
+        pairs = answers.order_by().values_list('question_id', 'user_token').distinct()
+        for question_id, user_token in pairs.iterator():
+            counters[question_id].add(user_token)
+    total = counter_class()
+    for counter in counters.itervalues():
+        total.update(counter)
+    by_question = {question_id: len(counter) for question_id, counter in counters.iteritems()}
+    return len(total), by_question
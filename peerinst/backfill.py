@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""Batched backfills of existing rows after schema changes.
+
+Updating all rows of a big table like the answers table in a data migration would lock it for
+a long time.  Instead, a backfill is defined here by subclassing Backfill and registering the
+class, and the migration only schedules it:
+
+    operations = [
+        migrations.AddField(...),
+        backfill.schedule('answer_something'),
+    ]
+
+The "run_backfill" management command then processes the rows in chunks ordered by primary key,
+each in a short transaction, optionally pausing between chunks.  The progress is checkpointed in
+the database after each chunk, so the command can be stopped at any time and will resume where
+it stopped.
+
+Backfills of tenant models like the answers run in the databases of all tenants, see
+peerinst.routers.  The checkpoints are all stored in the default database, one per backfill and
+tenant database.
+"""
+from __future__ import unicode_literals
+
+import datetime
+import time
+
+from django.db import DEFAULT_DB_ALIAS, migrations, router, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import models, routers
+
+# Maps backfill names to Backfill subclasses.
+registry = {}
+
+# The creation timestamp given to rows recorded before creation times were tracked.
+UNKNOWN_CREATED = datetime.datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def register(name):
+    """Class decorator to register a backfill under the given name."""
+    def decorator(cls):
+        cls.name = name
+        registry[name] = cls
+        return cls
+    return decorator
+
+
+def schedule(name):
+    """Return a migration operation scheduling the named backfill."""
+    def forwards(apps, schema_editor):
+        BackfillCheckpoint = apps.get_model('peerinst', 'BackfillCheckpoint')
+        BackfillCheckpoint.objects.get_or_create(name=name)
+
+    def backwards(apps, schema_editor):
+        BackfillCheckpoint = apps.get_model('peerinst', 'BackfillCheckpoint')
+        BackfillCheckpoint.objects.filter(name=name).delete()
+
+    return migrations.RunPython(forwards, backwards)
+
+
+class Backfill(object):
+    """Base class for backfills.
+
+    Subclasses set the model and implement get_queryset() and process().  Keyword arguments
+    given to run() are passed to the constructor.
+    """
+    name = None
+    model = None
+
+    def __init__(self, **params):
+        self.params = params
+
+    def get_queryset(self):
+        """Return the rows that still need to be processed."""
+        raise NotImplementedError
+
+    def process(self, pks):
+        """Process the rows with the given primary keys, which are in ascending order.
+
+        This is called inside a transaction.
+        """
+        raise NotImplementedError
+
+
+def get_checkpoint_name(name, database=DEFAULT_DB_ALIAS):
+    """Return the name of the checkpoint of a backfill in the given tenant database."""
+    if database == DEFAULT_DB_ALIAS:
+        return name
+    return '{}@{}'.format(name, database)
+
+
+def run(name, database=DEFAULT_DB_ALIAS, chunk_size=1000, sleep=0, max_chunks=None,
+        progress=None, **params):
+    """Run the named backfill in the given tenant database, resuming from its checkpoint.
+
+    A backfill that has already been completed is started from the beginning again.  Stops
+    after `max_chunks` chunks if given, and calls `progress` with the checkpoint after each chunk.
+    Returns whether the backfill has been completed.
+    """
+    backfill = registry[name](**params)
+    checkpoint, unused_created = models.BackfillCheckpoint.objects.get_or_create(
+        name=get_checkpoint_name(name, database)
+    )
+    if checkpoint.done:
+        checkpoint.last_pk = checkpoint.processed = 0
+        checkpoint.done = False
+        checkpoint.save()
+    chunks = 0
+    while max_chunks is None or chunks < max_chunks:
+        # The checkpoint is saved after the chunk has been committed.  If the command is stopped in
+        # between, the chunk is processed again, which doesn't change anything.
+        with routers.use_database(database):
+            with transaction.atomic(using=router.db_for_write(backfill.model)):
+                pks = list(
+                    backfill.get_queryset().filter(pk__gt=checkpoint.last_pk).order_by('pk')
+                    .values_list('pk', flat=True)[:chunk_size]
+                )
+                if pks:
+                    backfill.process(pks)
+        if not pks:
+            checkpoint.done = True
+            checkpoint.save()
+            return True
+        checkpoint.last_pk = pks[-1]
+        checkpoint.processed += len(pks)
+        checkpoint.save()
+        chunks += 1
+        if progress is not None:
+            progress(checkpoint)
+        if sleep:
+            time.sleep(sleep)
+    return False
+
+
+def get_pending(database=DEFAULT_DB_ALIAS):
+    """Return the names of the scheduled backfills not completed in a database, oldest first.
+
+    The migrations schedule the backfills in the default database, and they are pending in the
+    other tenant databases until they have been completed there as well.
+    """
+    scheduled = list(
+        models.BackfillCheckpoint.objects.filter(name__in=registry)
+        .order_by('id').values_list('name', 'done')
+    )
+    if database == DEFAULT_DB_ALIAS:
+        return [name for name, done in scheduled if not done]
+    # Backfills of the shared tables only run in the default database.
+    scheduled = [
+        (name, done) for name, done in scheduled if routers.is_tenant_model(registry[name].model)
+    ]
+    completed = set(
+        models.BackfillCheckpoint.objects.filter(
+            name__in=[get_checkpoint_name(name, database) for name, unused_done in scheduled],
+            done=True,
+        ).values_list('name', flat=True)
+    )
+    return [
+        name for name, unused_done in scheduled
+        if get_checkpoint_name(name, database) not in completed
+    ]
+
+
+class CreatedTimestamps(Backfill):
+    """Fill in the creation timestamps of rows recorded before they were tracked.
+
+    The real creation times are unknown, so all these rows get the same explicit `timestamp`,
+    by default the UNKNOWN_CREATED sentinel.  Since ties are broken by primary key, the old rows
+    still sort before all newer ones.
+    """
+
+    def __init__(self, timestamp=UNKNOWN_CREATED, **params):
+        super(CreatedTimestamps, self).__init__(**params)
+        self.timestamp = timestamp
+
+    def get_queryset(self):
+        return self.model.objects.filter(created__isnull=True)
+
+    def process(self, pks):
+        self.model.objects.filter(pk__in=pks).update(created=self.timestamp)
+
+
+@register('answer_created')
+class AnswerCreatedTimestamps(CreatedTimestamps):
+    model = models.Answer
+
+
+@register('answervote_created')
+class AnswerVoteCreatedTimestamps(CreatedTimestamps):
+    model = models.AnswerVote
+
+
+@register('answer_rationale_text')
+class AnswerRationaleTexts(Backfill):
+    """Move the rationales of answers stored before rationale texts were deduplicated."""
+    model = models.Answer
+
+    def get_queryset(self):
+        return models.Answer.objects.filter(rationale_text__isnull=True)
+
+    def process(self, pks):
+        batch = list(
+            models.Answer.objects.filter(pk__in=pks).values_list('pk', 'legacy_rationale')
+        )
+        text_ids = models.RationaleText.objects.intern_many({text for pk, text in batch})
+        pks_by_text_id = {}
+        for pk, text in batch:
+            pks_by_text_id.setdefault(text_ids[text], []).append(pk)
+        for text_id, pks in pks_by_text_id.iteritems():
+            models.Answer.objects.filter(pk__in=pks, rationale_text__isnull=True).update(
+                rationale_text_id=text_id, legacy_rationale=''
+            )
+
+
+class ExposureCounters(Backfill):
+    """Set the exposure counters of answers recorded before they were counted to zero."""
+
+    def get_queryset(self):
+        return self.model.objects.filter(
+            Q(times_shown__isnull=True) | Q(times_chosen__isnull=True)
+        )
+
+    def process(self, pks):
+        rows = self.model.objects.filter(pk__in=pks)
+        rows.filter(times_shown__isnull=True).update(times_shown=0)
+        rows.filter(times_chosen__isnull=True).update(times_chosen=0)
+
+
+@register('answer_exposure_counters')
+class AnswerExposureCounters(ExposureCounters):
+    model = models.Answer
+
+
+@register('archivedanswer_exposure_counters')
+class ArchivedAnswerExposureCounters(ExposureCounters):
+    model = models.ArchivedAnswer
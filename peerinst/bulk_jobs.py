@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""Deletions and bulk updates of many answers, processed in chunks outside the request.
+
+Deleting a question or assignment in one go cascades over all its answers and votes in a single
+transaction, which locks the answers table for a long time.  Instead, the admin enqueues a bulk
+job, and the "run_bulk_jobs" management command deletes the rows in small chunks, each in its own
+short transaction, before deleting the object itself.  Every chunk only touches rows that still
+exist, so an interrupted job simply continues where it stopped when the command is run again.
+A failed job can be resumed the same way with the "Retry" action in the admin.  The answers are
+deleted from the databases of all tenants, see peerinst.routers.
+
+The statistics cells of the question or assignment are deleted first, so that the answers can
+then be deleted with one raw DELETE per chunk, instead of loading them to update their cells one
+by one through the post_delete signal.
+"""
+from __future__ import unicode_literals
+
+import logging
+import time
+
+from django.db import router, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import models, routers
+
+LOGGER = logging.getLogger(__name__)
+
+# Selections of up to this many answers are updated directly in the admin action.
+INLINE_UPDATE_LIMIT = 1000
+
+
+def enqueue_delete(obj):
+    """Enqueue the deletion of a question or an assignment."""
+    kind = {
+        models.Question: models.BulkJob.DELETE_QUESTION,
+        models.Assignment: models.BulkJob.DELETE_ASSIGNMENT,
+    }[type(obj)]
+    return models.BulkJob.objects.create(
+        kind=kind, target=unicode(obj.pk), description='Delete {}'.format(obj)
+    )
+
+
+def enqueue_publish_answers(answer_ids):
+    answer_ids = sorted(answer_ids)
+    return models.BulkJob.objects.create(
+        kind=models.BulkJob.PUBLISH_ANSWERS,
+        answer_ids=','.join(map(str, answer_ids)),
+        description='Show {} answers to students'.format(len(answer_ids)),
+        total=len(answer_ids),
+    )
+
+
+def delete_exposures(answer_ids):
+    """Delete the rationale exposures of the given answers, both as student and as rationale."""
+    models.RationaleExposure.objects.filter(answer_id__in=answer_ids).delete()
+    models.RationaleExposure.objects.filter(rationale_id__in=answer_ids).delete()
+
+
+def delete_answers(answer_ids):
+    """Delete the given answers and the votes on them.
+
+    No signals are sent, so the statistics cells of the answers must have been deleted already.
+    """
+    database = router.db_for_write(models.Answer)
+    with transaction.atomic(using=database):
+        # Answers choosing the deleted ones as rationale would be deleted as well otherwise.
+        models.Answer.objects.filter(chosen_rationale_id__in=answer_ids).update(
+            chosen_rationale=None
+        )
+        models.AnswerVote.objects.filter(answer_id__in=answer_ids).delete()
+        delete_exposures(answer_ids)
+        # Nothing else refers to the answers now.
+        models.Answer.objects.filter(id__in=answer_ids)._raw_delete(database)
+
+
+def delete_archived_answers(answer_ids):
+    """Delete the given archived answers and their votes, see delete_answers()."""
+    database = router.db_for_write(models.ArchivedAnswer)
+    with transaction.atomic(using=database):
+        models.ArchivedAnswerVote.objects.filter(answer_id__in=answer_ids).delete()
+        delete_exposures(answer_ids)
+        models.ArchivedAnswer.objects.filter(id__in=answer_ids)._raw_delete(database)
+
+
+def delete_rows(model, ids):
+    with transaction.atomic(using=router.db_for_write(model)):
+        model.objects.filter(id__in=ids).delete()
+
+
+def get_stats_cells(job):
+    """Return the statistics cells of the question or assignment deleted by a job."""
+    if job.kind == models.BulkJob.DELETE_QUESTION:
+        return models.AssignmentQuestionStats.objects.filter(question_id=int(job.target))
+    return models.AssignmentQuestionStats.objects.filter(assignment_id=job.target)
+
+
+def get_delete_steps(job):
+    """Return the steps of a deletion job as a list of (queryset, delete function) pairs."""
+    delete_stats = (
+        get_stats_cells(job), lambda ids: delete_rows(models.AssignmentQuestionStats, ids)
+    )
+    if job.kind == models.BulkJob.DELETE_QUESTION:
+        question_id = int(job.target)
+        return [
+            delete_stats,
+            (models.Answer.objects.filter(question_id=question_id), delete_answers),
+            (models.ArchivedAnswer.objects.filter(question_id=question_id), delete_archived_answers),
+        ]
+    assignment_id = job.target
+    return [
+        delete_stats,
+        (models.AnswerVote.objects.filter(assignment_id=assignment_id),
+         lambda ids: delete_rows(models.AnswerVote, ids)),
+        (models.Answer.objects.filter(assignment_id=assignment_id), delete_answers),
+        (models.ArchivedAnswerVote.objects.filter(assignment_id=assignment_id),
+         lambda ids: delete_rows(models.ArchivedAnswerVote, ids)),
+        (models.ArchivedAnswer.objects.filter(assignment_id=assignment_id), delete_archived_answers),
+    ]
+
+
+def record_progress(job, count):
+    models.BulkJob.objects.filter(pk=job.pk).update(
+        processed=F('processed') + count, updated=timezone.now()
+    )
+
+
+def run_delete_job(job, chunk_size, sleep):
+    databases = routers.get_tenant_databases()
+    if job.status == models.BulkJob.PENDING:
+        total = 0
+        for database in databases:
+            with routers.use_database(database):
+                total += sum(queryset.count() for queryset, unused_delete in get_delete_steps(job))
+        # A retried job has already processed some rows.
+        models.BulkJob.objects.filter(pk=job.pk).update(
+            status=models.BulkJob.RUNNING, total=F('processed') + total
+        )
+    for database in databases:
+        with routers.use_database(database):
+            for queryset, delete in get_delete_steps(job):
+                while True:
+                    # Newest rows first, since answers can only choose older answers as rationale.
+                    ids = list(queryset.order_by('-id').values_list('id', flat=True)[:chunk_size])
+                    if not ids:
+                        break
+                    delete(ids)
+                    record_progress(job, len(ids))
+                    if sleep:
+                        time.sleep(sleep)
+            # Answers submitted during the job may have created new cells.
+            get_stats_cells(job).delete()
+    # Only the object itself and small related tables like the answer choices are left now.  They
+    # are all in the default database.
+    model = models.Question if job.kind == models.BulkJob.DELETE_QUESTION else models.Assignment
+    with transaction.atomic():
+        model.objects.filter(pk=job.target).delete()
+
+
+def run_publish_job(job, chunk_size, sleep):
+    models.BulkJob.objects.filter(pk=job.pk).update(status=models.BulkJob.RUNNING)
+    answer_ids = map(int, job.answer_ids.split(','))
+    for start in range(job.processed, len(answer_ids), chunk_size):
+        ids = answer_ids[start:start + chunk_size]
+        models.Answer.objects.filter(id__in=ids).update(show_to_others=True)
+        record_progress(job, len(ids))
+        if sleep:
+            time.sleep(sleep)
+
+
+def run_job(job, chunk_size=500, sleep=0):
+    """Run a bulk job to completion, or resume it if it has been interrupted.
+
+    Returns whether the job was successful.
+    """
+    try:
+        if job.kind == models.BulkJob.PUBLISH_ANSWERS:
+            run_publish_job(job, chunk_size, sleep)
+        else:
+            run_delete_job(job, chunk_size, sleep)
+    except Exception as e:
+        LOGGER.exception('Bulk job %s failed.', job.pk)
+        models.BulkJob.objects.filter(pk=job.pk).update(
+            status=models.BulkJob.FAILED, last_error=repr(e)
+        )
+        return False
+    models.BulkJob.objects.filter(pk=job.pk).update(status=models.BulkJob.DONE)
+    return True
+
+
+def get_next_job():
+    """Return the oldest job that still needs to be run, including interrupted ones."""
+    return models.BulkJob.objects.filter(
+        status__in=[models.BulkJob.PENDING, models.BulkJob.RUNNING]
+    ).order_by('id').first()
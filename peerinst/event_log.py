@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""Reading the student event log.
+
+The events are logged as one JSON object per line.  The log can be spread over several files:
+the shards written by each worker process, and the rotated and possibly gzipped older files (see
+peerinst.log_handlers).  Every single file is ordered by time, so the files can be merged into one
+ordered stream without loading them into memory.
+"""
+from __future__ import unicode_literals
+
+import datetime
+import glob
+import gzip
+import heapq
+import io
+import json
+
+from django.conf import settings
+
+from .log_handlers import get_shard_filename
+
+TIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+
+
+def get_default_filename():
+    """Return the name of the student event log file configured in the settings."""
+    return settings.LOGGING['handlers']['file_student_log']['filename']
+
+
+def get_log_files(filename=None):
+    """Return all files of the event log with the given name, including shards and rotated files."""
+    if filename is None:
+        filename = get_default_filename()
+    shard_pattern = get_shard_filename(filename, '[0-9]*')
+    paths = set()
+    for pattern in [filename, filename + '.[0-9]*', shard_pattern, shard_pattern + '.[0-9]*']:
+        paths.update(glob.glob(pattern))
+    return sorted(paths)
+
+
+def open_log_file(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return io.open(path, 'rb')
+
+
+def iter_lines(path):
+    """Yield the lines of a log file as byte strings."""
+    with open_log_file(path) as f:
+        for line in f:
+            if line.strip():
+                yield line if line.endswith(b'\n') else line + b'\n'
+
+
+def parse_time(value):
+    """Parse the time of an event, or return None if it isn't valid."""
+    for time_format in TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, time_format)
+        except (TypeError, ValueError):
+            pass
+    return None
+
+
+def parse_event(line):
+    """Parse a line of the log, or return None if it isn't a valid event."""
+    try:
+        event = json.loads(line)
+    except ValueError:
+        return None
+    return event if isinstance(event, dict) else None
+
+
+def iter_timed_lines(path, index):
+    """Yield (time, index, line number, line) tuples for the lines of a log file.
+
+    Lines without a valid time get the time of the previous line, so they keep their place.
+    """
+    last_time = datetime.datetime.min
+    for line_number, line in enumerate(iter_lines(path)):
+        event = parse_event(line)
+        time = parse_time(event.get('time')) if event is not None else None
+        if time is not None:
+            last_time = time
+        yield last_time, index, line_number, line
+
+
+def merge_lines(paths):
+    """Yield the lines of all given log files ordered by the time of the events.
+
+    Events with the same time are ordered by file and then by position in the file.
+    """
+    streams = [iter_timed_lines(path, index) for index, path in enumerate(paths)]
+    for unused_time, unused_index, unused_line_number, line in heapq.merge(*streams):
+        yield line
+
+
+def iter_file_events(paths, substrings=None):
+    """Yield the events of the given log files file by file, skipping invalid lines.
+
+    If `substrings` is given, lines that contain none of these byte strings are skipped without
+    parsing them, which is much faster when only a few event types are of interest.
+    """
+    for path in paths:
+        for line in iter_lines(path):
+            if substrings is not None and not any(value in line for value in substrings):
+                continue
+            event = parse_event(line)
+            if event is not None:
+                yield event
+
+
+def iter_events(paths):
+    """Yield the events of all given log files ordered by time, skipping invalid lines."""
+    for line in merge_lines(paths):
+        event = parse_event(line)
+        if event is not None:
+            yield event
+
+
+class EventStats(object):
+    """Aggregate counts over review submission events.
+
+    For each question, counts how often each rationale has been shown to students and how often
+    it has been chosen, and how often students went from each first answer choice to each second
+    answer choice.  The memory needed only depends on the number of questions and rationales,
+    not on the number of events.
+    """
+
+    def __init__(self):
+        self.events = 0
+        # Maps (question id, rationale id) pairs to [shown, chosen] counts.
+        self.rationales = {}
+        # Maps (question id, first answer choice, second answer choice) to counts.
+        self.switches = {}
+        # Events without the first answer choice, which were logged before it was included.
+        self.without_first_choice = 0
+
+    def add(self, event):
+        data = event.get('event') or {}
+        if 'second_answer_choice' not in data:
+            # Only review submissions are counted.
+            return
+        self.events += 1
+        question_id = data.get('question_id')
+        # Compact events only contain the rationale ids.
+        rationale_ids = data.get('rationale_ids')
+        if rationale_ids is None:
+            rationale_ids = [rationale.get('id') for rationale in data.get('rationales') or []]
+        for rationale_id in rationale_ids:
+            self.rationales.setdefault((question_id, rationale_id), [0, 0])[0] += 1
+        chosen_rationale_id = data.get('chosen_rationale_id')
+        if chosen_rationale_id is not None:
+            self.rationales.setdefault((question_id, chosen_rationale_id), [0, 0])[1] += 1
+        first_answer_choice = data.get('first_answer_choice')
+        if first_answer_choice is None:
+            self.without_first_choice += 1
+            return
+        key = (question_id, first_answer_choice, data['second_answer_choice'])
+        self.switches[key] = self.switches.get(key, 0) + 1
+
+    def get_rationale_rows(self):
+        """Return (question id, rationale id, shown, chosen) tuples."""
+        return sorted(key + tuple(counts) for key, counts in self.rationales.iteritems())
+
+    def get_switch_rows(self):
+        """Return (question id, first answer choice, second answer choice, count) tuples."""
+        return sorted(key + (count,) for key, count in self.switches.iteritems())
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""Passback of grades to the LMS.
+
+The last grade successfully sent for each user and key is recorded, and sending the same grade
+again is skipped unless explicitly forced.
+
+When LTI_GRADE_PASSBACK_ASYNC is enabled, the student views only enqueue grades.  The
+"send_grades" management command sends them to the LTI outcome service in parallel, retrying
+failed attempts with exponential backoff.  Grades that still fail after the maximum number of
+attempts are kept in the queue with the status FAILED, so staff can inspect and retry them in the
+admin interface.
+"""
+from __future__ import unicode_literals
+
+import collections
+import datetime
+import logging
+import uuid
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.utils import timezone
+from django_lti_tool_provider.models import LtiUserData
+from ims_lti_py.tool_provider import ToolProvider
+
+from . import models, routers
+
+LOGGER = logging.getLogger(__name__)
+
+# Upper bound for the delay between two attempts to send a grade.
+MAX_RETRY_DELAY = datetime.timedelta(hours=6)
+
+
+class GradePassbackError(Exception):
+    """Raised when the outcome service did not accept a grade."""
+
+
+def pass_back_grade(user, custom_key, grade, force=False, lti_parameters=None):
+    """Send a grade to the LMS, or enqueue it in asynchronous mode.
+
+    Unless `force` is True, nothing happens if the same grade was the last one sent for the user
+    and key.  The LTI launch parameters of the user and key are looked up unless given.  The grade
+    is only recorded as sent once the outcome service has accepted it, so a failed attempt is
+    repeated the next time.  Returns whether the grade was sent or enqueued.
+    """
+    if not force and models.SentGrade.objects.is_sent(user, custom_key, grade):
+        return False
+    if settings.LTI_GRADE_PASSBACK_ASYNC:
+        models.GradePassback.objects.enqueue(user, custom_key, grade)
+        return True
+    if lti_parameters is None:
+        lti_data = LtiUserData.objects.filter(user=user, custom_key=custom_key).first()
+        if lti_data is None:
+            LOGGER.warning('No LTI launch data found for user %s and key %s.', user.pk, custom_key)
+            return False
+        lti_parameters = lti_data.edx_lti_parameters
+    try:
+        send_grade(lti_parameters, grade)
+    except Exception:
+        # Network errors come in many flavours; treat them all as failures.
+        LOGGER.exception(
+            'Sending grade %s for user %s and key %s failed.', grade, user.pk, custom_key
+        )
+        return False
+    models.SentGrade.objects.record(user.pk, custom_key, grade)
+    return True
+
+
+def send_grade(lti_parameters, grade):
+    """Send a grade to the outcome service given in the stored LTI launch parameters.
+
+    Raises an exception if the grade wasn't accepted.  The request times out according to the
+    default socket timeout.
+    """
+    provider = ToolProvider(settings.LTI_CLIENT_KEY, settings.LTI_CLIENT_SECRET, lti_parameters)
+    # The score is passed as a string, since ims_lti_py leaves out a score of 0.0 otherwise.
+    outcome = provider.post_replace_result('{:.2f}'.format(grade))
+    if not outcome.is_success():
+        raise GradePassbackError(
+            'The outcome service did not accept the grade: {}'.format(outcome.description)
+        )
+
+
+def send_grades_in_parallel(grades, concurrency):
+    """Send grades given as pairs (lti_parameters, grade) using `concurrency` threads.
+
+    Returns a list with an error message or None for each of the grades.
+    """
+    def send(item):
+        lti_parameters, grade = item
+        if lti_parameters is None:
+            return 'No LTI launch data found for this user and key.'
+        try:
+            send_grade(lti_parameters, grade)
+        except Exception as e:
+            # Network errors come in many flavours; treat them all as failures.
+            return '{}: {}'.format(type(e).__name__, e)
+        return None
+
+    pool = ThreadPool(concurrency)
+    try:
+        return pool.map(send, grades)
+    finally:
+        pool.close()
+
+
+def retry_delay(attempts, base_delay):
+    """Return the delay before the next attempt after `attempts` failed attempts."""
+    delay = datetime.timedelta(seconds=base_delay * 2 ** (attempts - 1))
+    return min(delay, MAX_RETRY_DELAY)
+
+
+def claim_due_grades(batch_size, lease):
+    """Claim up to `batch_size` due grades for sending.
+
+    Claimed grades that aren't marked as sent or failed within `lease` seconds, e.g. because the
+    worker died, become due again.  Only the newest grade for a user and key is sent:  older ones
+    are dropped, and a grade queued while an older one is being sent waits for the older one's
+    claim to end, so the LMS can't receive them in the wrong order.
+    """
+    now = timezone.now()
+    queue = models.GradePassback.objects
+    ids = list(
+        queue.exclude(status=models.GradePassback.FAILED).filter(next_attempt__lte=now)
+        .order_by('next_attempt').values_list('id', flat=True)[:batch_size]
+    )
+    if not ids:
+        return []
+    claim = uuid.uuid4().hex
+    # Only claim grades that haven't been claimed by another worker in the meantime.
+    queue.filter(id__in=ids, next_attempt__lte=now).exclude(
+        status=models.GradePassback.FAILED
+    ).update(
+        status=models.GradePassback.SENDING,
+        claim=claim,
+        next_attempt=now + datetime.timedelta(seconds=lease),
+    )
+    grades = list(queue.filter(claim=claim))
+    newest = {}
+    in_flight = {}
+    for grade in queue.filter(
+            user_id__in={grade.user_id for grade in grades},
+            custom_key__in={grade.custom_key for grade in grades},
+    ).order_by('id'):
+        key = grade.user_id, grade.custom_key
+        newest[key] = grade.id
+        if grade.status == models.GradePassback.SENDING and grade.claim != claim:
+            in_flight.setdefault(key, grade.next_attempt)
+    superseded = {
+        grade.id for grade in grades if grade.id != newest[grade.user_id, grade.custom_key]
+    }
+    queue.filter(id__in=superseded).delete()
+    claimed = []
+    for grade in grades:
+        key = grade.user_id, grade.custom_key
+        if grade.id in superseded:
+            continue
+        if key in in_flight:
+            queue.filter(id=grade.id).update(
+                status=models.GradePassback.PENDING, claim='', next_attempt=in_flight[key]
+            )
+            continue
+        claimed.append(grade)
+    return claimed
+
+
+def process_queue(batch_size=100, concurrency=10, max_attempts=8, base_delay=30, lease=300):
+    """Send one batch of due grades to the LMS.
+
+    Returns a collections.Counter with the number of grades 'sent', 'retried' and 'failed'.
+    """
+    stats = collections.Counter()
+    grades = claim_due_grades(batch_size, lease)
+    if not grades:
+        return stats
+    # The LTI user data is stored in the database of the tenant, see peerinst.routers.
+    lti_parameters = {}
+    for database in routers.get_tenant_databases():
+        lti_parameters.update(
+            ((lti_data.user_id, lti_data.custom_key), lti_data.edx_lti_parameters)
+            for lti_data in LtiUserData.objects.using(database).filter(
+                user_id__in={grade.user_id for grade in grades},
+                custom_key__in={grade.custom_key for grade in grades},
+            )
+        )
+
+    errors = send_grades_in_parallel(
+        [(lti_parameters.get((grade.user_id, grade.custom_key)), grade.grade) for grade in grades],
+        concurrency,
+    )
+    now = timezone.now()
+    for grade, error in zip(grades, errors):
+        if error is None:
+            models.SentGrade.objects.record(grade.user_id, grade.custom_key, grade.grade)
+            grade.delete()
+            stats['sent'] += 1
+            continue
+        grade.attempts += 1
+        grade.last_error = error
+        grade.claim = ''
+        if grade.attempts >= max_attempts:
+            LOGGER.error(
+                'Giving up sending grade %s for user %s and key %s: %s',
+                grade.grade, grade.user_id, grade.custom_key, error,
+            )
+            grade.status = models.GradePassback.FAILED
+            stats['failed'] += 1
+        else:
+            grade.status = models.GradePassback.PENDING
+            grade.next_attempt = now + retry_delay(grade.attempts, base_delay)
+            stats['retried'] += 1
+        grade.save()
+    return stats
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""Logging handlers."""
+from __future__ import unicode_literals
+
+import datetime
+import glob
+import gzip
+import io
+import logging
+import os
+import Queue
+import shutil
+import threading
+import time
+import traceback
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_shard_filename(filename, pid):
+    """Return the name of the shard file of the given process."""
+    root, ext = os.path.splitext(filename)
+    return '{}-{}{}'.format(root, pid, ext)
+
+
+class BufferedEventLogHandler(logging.Handler):
+    """Write log records to a file from a background thread.
+
+    Records are formatted and put into an in-memory queue by the logging thread, which never
+    waits for the disk.  A background thread writes them to the file in batches and flushes the
+    file once per batch.
+
+    The file is rotated when it would exceed `max_bytes`, or `rotate_interval` seconds after it
+    has been opened (either can be zero to disable it).  Rotated files are renamed by appending a
+    timestamp and compressed with gzip if `compress` is true.  The compression runs in a second
+    background thread, so that the writer never waits for it.  If `backup_count` is non-zero, only
+    that many rotated files are kept.
+
+    The queue holds up to `queue_size` records.  If the writer can't keep up, the `overflow`
+    policy decides what happens to new records:
+
+    * 'drop':  drop the new record,
+    * 'drop_oldest':  drop the oldest record in the queue to make room for the new one,
+    * 'block':  wait until there is room in the queue.
+
+    Dropped records are counted and reported as a warning on this module's logger.  After a fork,
+    the child process starts its own writer thread.
+
+    If `shard_by_pid` is true, each process writes to its own shard file named after its process
+    id, e.g. "student-1234.log" instead of "student.log", so that several worker processes never
+    append to the same file.  The shards can be merged with the "merge_event_logs" management
+    command.
+    """
+
+    OVERFLOW_POLICIES = ('drop', 'drop_oldest', 'block')
+
+    def __init__(self, filename, max_bytes=0, rotate_interval=0, backup_count=0, compress=True,
+                 queue_size=10000, overflow='drop', batch_size=500, flush_interval=1.0,
+                 shard_by_pid=False):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy: {}'.format(overflow))
+        logging.Handler.__init__(self)
+        self.filename = os.path.abspath(filename)
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backup_count = backup_count
+        self.compress = compress
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.shard_by_pid = shard_by_pid
+        self.path = self.filename
+        self.dropped = 0
+        self.pid = None
+        self.queue = None
+        self.thread = None
+        self.stopping = None
+        self.stream = None
+        self.rotate_at = None
+        self.compress_queue = None
+        self.compress_thread = None
+
+    def start(self):
+        """Start the writer thread of the current process."""
+        self.pid = os.getpid()
+        if self.shard_by_pid:
+            self.path = get_shard_filename(self.filename, self.pid)
+        self.queue = Queue.Queue(self.queue_size)
+        self.stopping = threading.Event()
+        # Whatever the parent process had opened is left alone.
+        self.stream = None
+        self.thread = threading.Thread(target=self.run, name='BufferedEventLogHandler')
+        self.thread.daemon = True
+        self.thread.start()
+        if self.compress:
+            self.compress_queue = Queue.Queue()
+            self.compress_thread = threading.Thread(
+                target=self.run_compressor, name='BufferedEventLogHandler compressor'
+            )
+            self.compress_thread.daemon = True
+            self.compress_thread.start()
+
+    def emit(self, record):
+        try:
+            line = self.format(record)
+            if not isinstance(line, unicode):
+                line = line.decode('utf-8', 'replace')
+            line += '\n'
+        except Exception:
+            self.handleError(record)
+            return
+        # Handler.handle() holds self.lock while calling emit().
+        if self.pid != os.getpid():
+            self.start()
+        if self.overflow == 'block':
+            self.queue.put(line)
+            return
+        while True:
+            try:
+                self.queue.put_nowait(line)
+                return
+            except Queue.Full:
+                pass
+            if self.overflow == 'drop':
+                self.dropped += 1
+                return
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self.dropped += 1
+            except Queue.Empty:
+                pass
+
+    def run(self):
+        while True:
+            try:
+                lines = [self.queue.get(timeout=self.flush_interval)]
+            except Queue.Empty:
+                if self.stopping.is_set():
+                    break
+                continue
+            while len(lines) < self.batch_size:
+                try:
+                    lines.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                self.write(lines)
+            except Exception:
+                # There's nowhere else to log this.
+                if logging.raiseExceptions:
+                    traceback.print_exc()
+            finally:
+                for unused_line in lines:
+                    self.queue.task_done()
+            if self.dropped:
+                with self.lock:
+                    dropped, self.dropped = self.dropped, 0
+                LOGGER.warning('Dropped %d log records because the queue was full.', dropped)
+        self.close_stream()
+
+    def write(self, lines):
+        data = ''.join(lines).encode('utf-8')
+        if self.stream is not None and self.should_rotate(len(data)):
+            self.rotate()
+        if self.stream is None:
+            self.open_stream()
+        self.stream.write(data)
+        self.stream.flush()
+
+    def open_stream(self):
+        self.stream = io.open(self.path, 'ab')
+        if self.rotate_interval:
+            self.rotate_at = time.time() + self.rotate_interval
+
+    def close_stream(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    def should_rotate(self, size):
+        if self.max_bytes and self.stream.tell() and self.stream.tell() + size > self.max_bytes:
+            return True
+        return bool(self.rotate_interval) and time.time() >= self.rotate_at
+
+    def rotate(self):
+        self.close_stream()
+        # Sorting the rotated files by name sorts them by age.
+        suffix = datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        rotated = '{}.{}'.format(self.path, suffix)
+        counter = 1
+        while os.path.exists(rotated) or os.path.exists(rotated + '.gz'):
+            rotated = '{}.{}-{}'.format(self.path, suffix, counter)
+            counter += 1
+        os.rename(self.path, rotated)
+        if self.compress:
+            # The old files are removed once the file has been compressed.
+            self.compress_queue.put(rotated)
+        else:
+            self.remove_old_files()
+
+    def run_compressor(self):
+        while True:
+            rotated = self.compress_queue.get()
+            try:
+                if rotated is None:
+                    break
+                self.compress_file(rotated)
+                self.remove_old_files()
+            except Exception:
+                # There's nowhere else to log this.
+                if logging.raiseExceptions:
+                    traceback.print_exc()
+            finally:
+                self.compress_queue.task_done()
+
+    def compress_file(self, rotated):
+        if not os.path.exists(rotated):
+            # Already removed because there were more than `backup_count` newer files.
+            return
+        # Compress to a name that isn't picked up as a log file, so readers never see a partial
+        # file, see peerinst.event_log.get_log_files().
+        directory, name = os.path.split(rotated)
+        partial = os.path.join(directory, '.{}.gz'.format(name))
+        with io.open(rotated, 'rb') as source, gzip.open(partial, 'wb') as target:
+            shutil.copyfileobj(source, target)
+        os.rename(partial, rotated + '.gz')
+        os.remove(rotated)
+
+    def remove_old_files(self):
+        if self.backup_count:
+            for old_file in self.get_rotated_files()[:-self.backup_count]:
+                os.remove(old_file)
+
+    def get_rotated_files(self):
+        """Return the rotated log files, oldest first."""
+        return sorted(glob.glob(self.path + '.[0-9]*'))
+
+    def flush(self):
+        """Wait until all queued records have been written and the rotated files compressed."""
+        if self.queue is not None and self.pid == os.getpid():
+            self.queue.join()
+            if self.compress_queue is not None:
+                self.compress_queue.join()
+
+    def close(self):
+        if self.thread is not None and self.pid == os.getpid():
+            self.flush()
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+            if self.compress_thread is not None:
+                self.compress_queue.put(None)
+                self.compress_thread.join()
+                self.compress_thread = None
+            self.pid = None
+        logging.Handler.close(self)
@@ -0,0 +1,98 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from peerinst import routers
+from peerinst.models import Answer, ArchivedAnswer, Assignment
+
+
+class Command(BaseCommand):
+    help = (
+        'Move the answers to the given assignments, and all votes on them, to the archive tables.  '
+        'Archived answers are no longer offered as rationales to students and only show up in '
+        'reports when explicitly requested.  Answers still chosen as rationale by answers that '
+        'are not archived are skipped.  The answers are archived in the databases of all tenants.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'assignments', nargs='+', metavar='assignment', help='Assignment identifier.'
+        )
+        parser.add_argument(
+            '--before', default=None,
+            help='Only archive answers created before this time, e.g. "2016-06-01 00:00Z".',
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=500,
+            help='Number of answers to archive per transaction.',
+        )
+        parser.add_argument(
+            '--sleep', type=float, default=0,
+            help='Seconds to pause between chunks to reduce the load on the database.',
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true', default=False,
+            help='Only show how many answers would be considered for archival.',
+        )
+
+    def handle(self, *args, **options):
+        assignment_ids = options['assignments']
+        unknown = set(assignment_ids) - set(
+            Assignment.objects.filter(identifier__in=assignment_ids)
+            .values_list('identifier', flat=True)
+        )
+        if unknown:
+            raise CommandError('Unknown assignments: {}'.format(', '.join(sorted(unknown))))
+        before = None
+        if options['before'] is not None:
+            before = parse_datetime(options['before'])
+            if before is None:
+                raise CommandError('Invalid timestamp: {}'.format(options['before']))
+            if timezone.is_naive(before):
+                before = timezone.make_aware(before)
+        considered = archived = skipped = votes = 0
+        for database in routers.get_tenant_databases():
+            with routers.use_database(database):
+                answers = Answer.objects.filter(assignment_id__in=assignment_ids)
+                if before is not None:
+                    answers = answers.filter(created__lt=before)
+                if options['dry_run']:
+                    considered += answers.count()
+                    continue
+                archived_here, skipped_here, votes_here = self.archive(answers, options)
+            archived += archived_here
+            skipped += skipped_here
+            votes += votes_here
+        if options['dry_run']:
+            self.stdout.write('{} answers would be considered.'.format(considered))
+            return
+        self.stdout.write(
+            'Archived {} answers and {} votes, skipped {} answers still chosen as rationale.'
+            .format(archived, votes, skipped)
+        )
+
+    def archive(self, answers, options):
+        """Archive the given answers in chunks.
+
+        Returns the numbers of archived answers, skipped answers and archived votes.
+        """
+        archived = skipped = votes = 0
+        # Newest answers first, since answers can only choose older answers as rationale.
+        last_pk = None
+        while True:
+            chunk = answers if last_pk is None else answers.filter(pk__lt=last_pk)
+            chunk = list(chunk.order_by('-pk').values_list('pk', flat=True)[:options['chunk_size']])
+            if not chunk:
+                break
+            archived_ids, vote_count = ArchivedAnswer.objects.archive(chunk)
+            archived += len(archived_ids)
+            skipped += len(chunk) - len(archived_ids)
+            votes += vote_count
+            last_pk = chunk[-1]
+            if options['verbosity'] > 1:
+                self.stdout.write('Archived {} answers so far.'.format(archived))
+            if options['sleep']:
+                time.sleep(options['sleep'])
+        return archived, skipped, votes
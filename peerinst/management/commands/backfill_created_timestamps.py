@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from peerinst import backfill, routers
+from peerinst.models import BackfillCheckpoint
+
+
+class Command(BaseCommand):
+    help = (
+        'Fill in the creation timestamps of answers and votes recorded before they were tracked.  '
+        'The real creation times are unknown, so all these rows get the same timestamp, by '
+        'default 1970-01-01 00:00Z to mark them as unknown.  Since ties are broken by primary '
+        'key, the old rows still sort before all newer ones.  Same as "run_backfill answer_created '
+        'answervote_created", but allows choosing the timestamp.  Runs in the databases of all '
+        'tenants.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--timestamp', default=None,
+            help='Timestamp to use instead of 1970-01-01 00:00Z, e.g. the date of the migration '
+                 'adding the creation timestamps.',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of rows to update per query.',
+        )
+        parser.add_argument(
+            '--sleep', type=float, default=0,
+            help='Seconds to pause between batches to reduce the load on the database.',
+        )
+
+    def handle(self, *args, **options):
+        timestamp = backfill.UNKNOWN_CREATED
+        if options['timestamp'] is not None:
+            timestamp = parse_datetime(options['timestamp'])
+            if timestamp is None:
+                raise CommandError('Invalid timestamp: {}'.format(options['timestamp']))
+            if timezone.is_naive(timestamp):
+                timestamp = timezone.make_aware(timestamp)
+        for database in routers.get_tenant_databases():
+            for name in ['answer_created', 'answervote_created']:
+                backfill.run(
+                    name, database=database, chunk_size=options['batch_size'],
+                    sleep=options['sleep'], timestamp=timestamp,
+                )
+                checkpoint = BackfillCheckpoint.objects.get(
+                    name=backfill.get_checkpoint_name(name, database)
+                )
+                self.stdout.write(
+                    '{}: backfilled {} rows.'.format(checkpoint.name, checkpoint.processed)
+                )
@@ -0,0 +1,83 @@
+from django.core.management.base import BaseCommand
+from django.db import router, transaction
+from django.db.models import Count, F
+from django.db.models.functions import Coalesce
+
+from peerinst import routers
+from peerinst.models import Answer, AnswerVote, ArchivedAnswer, BufferedVote, RationaleExposure
+
+
+class Command(BaseCommand):
+    help = (
+        'Merge the answers of students who submitted more than one answer to the same question '
+        'in the same assignment.  The latest completed answer is kept, and references to the '
+        'other answers and their votes are moved to it.  Each student is handled in a separate '
+        'short transaction, so this can be run on a live system before adding the uniqueness '
+        'constraint.  The answers are merged in the databases of all tenants.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true', default=False,
+            help='Only show how many students have duplicate answers.',
+        )
+
+    def handle(self, *args, **options):
+        students = merged = 0
+        for database in routers.get_tenant_databases():
+            with routers.use_database(database):
+                groups = list(
+                    Answer.objects.exclude(assignment=None)
+                    .values('assignment', 'question', 'user_token')
+                    .annotate(count=Count('id')).filter(count__gt=1).order_by()
+                )
+                students += len(groups)
+                if not options['dry_run']:
+                    merged += sum(self.merge(group) for group in groups)
+        if options['dry_run']:
+            self.stdout.write('{} students have duplicate answers.'.format(students))
+            return
+        self.stdout.write('Merged {} duplicate answers of {} students.'.format(merged, students))
+
+    def merge(self, group):
+        """Merge the answers in the given group and return the number of deleted answers."""
+        with transaction.atomic(using=router.db_for_write(Answer)):
+            answers = list(
+                Answer.objects.select_for_update().filter(
+                    assignment_id=group['assignment'],
+                    question_id=group['question'],
+                    user_token=group['user_token'],
+                ).order_by('id')
+            )
+            if len(answers) < 2:
+                return 0
+            completed = [answer for answer in answers if answer.second_answer_choice is not None]
+            keeper = (completed or answers)[-1]
+            duplicates = [answer for answer in answers if answer.pk != keeper.pk]
+            duplicate_ids = [answer.pk for answer in duplicates]
+            Answer.objects.filter(chosen_rationale_id__in=duplicate_ids).exclude(
+                pk=keeper.pk
+            ).update(chosen_rationale=keeper)
+            Answer.objects.filter(pk=keeper.pk, chosen_rationale_id__in=duplicate_ids).update(
+                chosen_rationale=None
+            )
+            ArchivedAnswer.objects.filter(chosen_rationale_id__in=duplicate_ids).update(
+                chosen_rationale_id=keeper.pk
+            )
+            AnswerVote.objects.filter(answer_id__in=duplicate_ids).update(answer=keeper)
+            BufferedVote.objects.filter(answer_id__in=duplicate_ids).update(answer_id=keeper.pk)
+            RationaleExposure.objects.filter(answer_id__in=duplicate_ids).update(
+                answer_id=keeper.pk
+            )
+            RationaleExposure.objects.filter(rationale_id__in=duplicate_ids).update(
+                rationale_id=keeper.pk
+            )
+            Answer.objects.filter(pk=keeper.pk).update(**{
+                # The exposure counters are NULL until they have been backfilled.
+                field: Coalesce(F(field), 0) + sum(
+                    getattr(answer, field) or 0 for answer in duplicates
+                )
+                for field in ['upvotes', 'downvotes', 'times_shown', 'times_chosen']
+            })
+            Answer.objects.filter(pk__in=duplicate_ids).delete()
+        return len(duplicates)
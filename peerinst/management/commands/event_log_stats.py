@@ -0,0 +1,87 @@
+import csv
+import io
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from peerinst import event_log
+
+
+class Command(BaseCommand):
+    help = (
+        'Aggregate the review submissions in the student event log, including rotated and '
+        'gzipped files, reading them line by line.  Writes two CSV files:  rationale_counts.csv '
+        'with the number of times each rationale was shown and chosen, and switch_matrices.csv '
+        'with the number of students going from each first to each second answer choice, per '
+        'question.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths', nargs='*', metavar='path',
+            help='Log file to read.  Defaults to all files of the student log.',
+        )
+        parser.add_argument('--course', help='Only count events of this course id.')
+        parser.add_argument('--assignment', help='Only count events of this assignment.')
+        parser.add_argument(
+            '--question', type=int, action='append', dest='questions', default=[],
+            help='Only count events of this question.  Can be given several times.',
+        )
+        parser.add_argument(
+            '--event-type', action='append', dest='event_types', default=[],
+            help=(
+                'Only count events of this type.  Can be given several times.  Defaults to '
+                '"save_problem_success", which is logged once per submission.'
+            ),
+        )
+        parser.add_argument(
+            '--output-dir', default='.', help='Directory to write the CSV files to.'
+        )
+
+    def handle(self, *args, **options):
+        paths = options['paths'] or event_log.get_log_files()
+        if not paths:
+            raise CommandError('No log files found.')
+        event_types = set(options['event_types'] or ['save_problem_success'])
+        questions = set(options['questions'])
+        stats = event_log.EventStats()
+        read = 0
+        for event in event_log.iter_file_events(paths, substrings=event_types):
+            read += 1
+            if event.get('event_type') not in event_types:
+                continue
+            if options['course'] is not None and event.get('course_id') != options['course']:
+                continue
+            data = event.get('event') or {}
+            assignment_id = data.get('assignment_id')
+            if options['assignment'] is not None and assignment_id != options['assignment']:
+                continue
+            if questions and data.get('question_id') not in questions:
+                continue
+            stats.add(event)
+        self.write_csv(
+            os.path.join(options['output_dir'], 'rationale_counts.csv'),
+            ['question_id', 'rationale_id', 'shown', 'chosen'],
+            stats.get_rationale_rows(),
+        )
+        self.write_csv(
+            os.path.join(options['output_dir'], 'switch_matrices.csv'),
+            ['question_id', 'first_answer_choice', 'second_answer_choice', 'count'],
+            stats.get_switch_rows(),
+        )
+        self.stdout.write(
+            'Read {} files, {} matching lines, counted {} submissions.'.format(
+                len(paths), read, stats.events
+            )
+        )
+        if stats.without_first_choice:
+            self.stdout.write(
+                '{} submissions were logged without the first answer choice and are missing from '
+                'the switch matrices.'.format(stats.without_first_choice)
+            )
+
+    def write_csv(self, path, header, rows):
+        with io.open(path, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
@@ -0,0 +1,72 @@
+import csv
+import io
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from peerinst import routers
+from peerinst.models import Answer
+from peerinst.util import iterate_since
+
+
+class Command(BaseCommand):
+    help = (
+        'Append the answers created since the last export to a CSV file, in creation order.  '
+        'Pass the watermark printed by the previous run with --since to only export the new '
+        'answers.  Answers of the last minute are left for the next run, since they might not '
+        'all be committed yet.'
+    )
+    header = [
+        'id', 'created', 'assignment_id', 'question_id', 'user_token', 'first_answer_choice',
+        'second_answer_choice', 'chosen_rationale_id', 'rationale',
+    ]
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV file to append to.  Created if it doesn\'t exist.')
+        parser.add_argument(
+            '--since', metavar='WATERMARK',
+            help='Watermark printed by the previous run.  Defaults to exporting all answers.',
+        )
+        parser.add_argument(
+            '--database', default='default',
+            help='Tenant database to export the answers of, see TENANT_DATABASES.',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of answers to read per query.',
+        )
+
+    def handle(self, *args, **options):
+        if options['database'] not in routers.get_tenant_databases():
+            raise CommandError('Unknown database: {}'.format(options['database']))
+        watermark = self.parse_watermark(options['since'])
+        exported = 0
+        new_file = not os.path.exists(options['path'])
+        with routers.use_database(options['database']), io.open(options['path'], 'ab') as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(self.header)
+            answers = Answer.objects.select_related('rationale_text')
+            for answer, watermark in iterate_since(answers, watermark, options['batch_size']):
+                writer.writerow([
+                    unicode(value).encode('utf-8') if value is not None else ''
+                    for value in [
+                        answer.id, answer.created.isoformat(), answer.assignment_id,
+                        answer.question_id, answer.user_token, answer.first_answer_choice,
+                        answer.second_answer_choice, answer.chosen_rationale_id, answer.rationale,
+                    ]
+                ])
+                exported += 1
+        self.stdout.write('Exported {} answers.'.format(exported))
+        if watermark is not None:
+            self.stdout.write('Watermark: {},{}'.format(watermark[0].isoformat(), watermark[1]))
+
+    def parse_watermark(self, value):
+        if value is None:
+            return None
+        created, unused_comma, pk = value.rpartition(',')
+        created = parse_datetime(created)
+        if created is None or not pk.isdigit():
+            raise CommandError('Invalid watermark: {}'.format(value))
+        return created, int(pk)
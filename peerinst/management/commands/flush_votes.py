@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from peerinst import routers
+from peerinst.models import BufferedVote
+
+
+class Command(BaseCommand):
+    help = (
+        'Fold the votes recorded in write-behind mode into the vote counters of the rationales, '
+        'in the databases of all tenants.  Runs once by default, or forever if an interval is '
+        'given.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of buffered votes to fold into the counters per transaction.',
+        )
+        parser.add_argument(
+            '--interval', type=float, default=None,
+            help='Keep running and flush the buffer every INTERVAL seconds.',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            processed = 0
+            for database in routers.get_tenant_databases():
+                with routers.use_database(database):
+                    processed += BufferedVote.objects.flush(batch_size=options['batch_size'])
+            if options['verbosity'] > 1 or options['interval'] is None:
+                self.stdout.write('Flushed {} buffered votes.'.format(processed))
+            if options['interval'] is None:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from peerinst import backfill, routers
+
+
+class Command(BaseCommand):
+    help = (
+        'Move the rationales of answers stored before rationale texts were deduplicated to the '
+        'rationale text table, in batches, in the databases of all tenants.  Same as "run_backfill '
+        'answer_rationale_text".'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Number of answers to process per transaction.',
+        )
+        parser.add_argument(
+            '--sleep', type=float, default=0,
+            help='Seconds to pause between batches to reduce the load on the database.',
+        )
+
+    def handle(self, *args, **options):
+        for database in routers.get_tenant_databases():
+            backfill.run(
+                'answer_rationale_text', database=database, chunk_size=options['batch_size'],
+                sleep=options['sleep'],
+            )
+        self.stdout.write('Moved all rationales to the rationale text table.')
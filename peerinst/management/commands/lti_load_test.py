@@ -0,0 +1,228 @@
+import hashlib
+import time
+import urllib
+import urllib2
+import uuid
+from multiprocessing.pool import ThreadPool
+
+import oauth2
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from dalite import ApplicationHookManager, LTIRoles
+from peerinst.models import Assignment
+
+
+def percentile(sorted_values, fraction):
+    """Return the given percentile of a sorted list using the nearest-rank method."""
+    if not sorted_values:
+        return None
+    index = max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+class NoRedirectHandler(urllib2.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure the latency of LTI launches by acting as an LMS.  Launch requests for synthetic '
+        'users are signed with LTI_CLIENT_KEY and LTI_CLIENT_SECRET and sent concurrently, '
+        'either through the Django test client in this process or to a running server given by '
+        '--url.  Every user is launched --repeat times, so the cost of creating users can be '
+        'compared with the launches of existing users.  The users are created in the configured '
+        'database, so only run this against a test or staging database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--users', type=int, default=1000, help='Number of synthetic users to launch.'
+        )
+        parser.add_argument(
+            '--repeat', type=int, default=2, help='Number of launches per user.'
+        )
+        parser.add_argument(
+            '--concurrency', type=int, default=10, help='Number of launches sent in parallel.'
+        )
+        parser.add_argument(
+            '--url', default=None,
+            help=(
+                'LTI launch URL of a running server, e.g. "http://localhost:8000/lti/".  By '
+                'default, the launches are sent through the Django test client.'
+            ),
+        )
+        parser.add_argument(
+            '--host', default='localhost', help='Host name used with the Django test client.'
+        )
+        parser.add_argument(
+            '--assignment', action='append', dest='assignments', default=[],
+            help=(
+                'Identifier of an assignment to launch.  Can be given several times.  Defaults to '
+                'all assignments.'
+            ),
+        )
+        parser.add_argument(
+            '--course-id', default='course-v1:LoadTest+LT101+now',
+            help='Course id sent as LTI context id.',
+        )
+        parser.add_argument(
+            '--role', default=LTIRoles.LEARNER, help='LTI role of the synthetic users.'
+        )
+        parser.add_argument(
+            '--user-prefix', default='loadtest',
+            help='Prefix from which the synthetic LTI user ids are derived.',
+        )
+        parser.add_argument(
+            '--cleanup', action='store_true', default=False,
+            help='Delete the users created by the load test afterwards.',
+        )
+
+    def handle(self, *args, **options):
+        if not settings.LTI_CLIENT_KEY or not settings.LTI_CLIENT_SECRET:
+            raise CommandError('LTI_CLIENT_KEY and LTI_CLIENT_SECRET need to be configured.')
+        self.options = options
+        self.targets = self.get_targets()
+        if options['url'] is None:
+            self.launch_url = 'http://{}/lti/'.format(options['host'])
+        else:
+            self.launch_url = options['url']
+        user_ids = [
+            hashlib.md5('{}-{}'.format(options['user_prefix'], n)).hexdigest()
+            for n in range(options['users'])
+        ]
+        usernames = [ApplicationHookManager._compress_user_name(user_id) for user_id in user_ids]
+        existing = set(
+            User.objects.filter(username__in=usernames).values_list('username', flat=True)
+        )
+        users_before = User.objects.count()
+
+        # Each user is launched once in every round, so the first round creates the new users.
+        results = []
+        start = time.time()
+        for round_number in range(options['repeat']):
+            launches = [
+                (user_id, username not in existing and round_number == 0, n)
+                for n, (user_id, username) in enumerate(zip(user_ids, usernames))
+            ]
+            results.extend(self.run_launches(launches))
+        elapsed = time.time() - start
+
+        self.report(results, elapsed, User.objects.count() - users_before)
+        if options['cleanup']:
+            created = set(usernames) - existing
+            User.objects.filter(username__in=created).delete()
+            self.stdout.write('Deleted the {} users created by the load test.'.format(len(created)))
+
+    def get_targets(self):
+        """Return a list of (assignment id, question id) pairs to launch."""
+        assignments = Assignment.objects.prefetch_related('questions')
+        if self.options['assignments']:
+            assignments = assignments.filter(identifier__in=self.options['assignments'])
+        targets = [
+            (assignment.pk, question.pk)
+            for assignment in assignments
+            for question in assignment.questions.all()
+        ]
+        if not targets:
+            raise CommandError('No assignments with questions found.')
+        return targets
+
+    def run_launches(self, launches):
+        if self.options['concurrency'] <= 1:
+            return [self.launch(item) for item in launches]
+        pool = ThreadPool(self.options['concurrency'])
+        try:
+            return pool.map(self.launch, launches)
+        finally:
+            pool.close()
+
+    def sign_launch(self, user_id, n):
+        """Return the POST parameters of an LTI 1.1 launch signed with OAuth 1.0 HMAC-SHA1.
+
+        The ToolConsumer of ims_lti_py isn't used, since it signs and returns every known launch
+        parameter, with "None" for the missing ones.
+        """
+        assignment_id, question_id = self.targets[n % len(self.targets)]
+        request = oauth2.Request(method='POST', url=self.launch_url, parameters={
+            'lti_message_type': 'basic-lti-launch-request',
+            'lti_version': 'LTI-1p0',
+            'resource_link_id': '{}-{}'.format(assignment_id, question_id),
+            'context_id': self.options['course_id'],
+            'user_id': user_id,
+            'roles': self.options['role'],
+            'custom_assignment_id': unicode(assignment_id),
+            'custom_question_id': unicode(question_id),
+            'oauth_consumer_key': settings.LTI_CLIENT_KEY,
+            'oauth_nonce': uuid.uuid4().hex,
+            'oauth_timestamp': str(int(time.time())),
+            'oauth_version': '1.0',
+        })
+        request.sign_request(
+            oauth2.SignatureMethod_HMAC_SHA1(),
+            oauth2.Consumer(settings.LTI_CLIENT_KEY, settings.LTI_CLIENT_SECRET),
+            None,
+        )
+        return dict(request)
+
+    def launch(self, item):
+        """Send a launch and return a tuple (new user, success, seconds, number of queries)."""
+        user_id, new_user, n = item
+        data = self.sign_launch(user_id, n)
+        if self.options['url'] is not None:
+            return (new_user,) + self.launch_http(data) + (None,)
+        client = Client(HTTP_HOST=self.options['host'])
+        with CaptureQueriesContext(connection) as queries:
+            start = time.time()
+            response = client.post('/lti/', data)
+            seconds = time.time() - start
+        return new_user, response.status_code == 302, seconds, len(queries)
+
+    def launch_http(self, data):
+        opener = urllib2.build_opener(NoRedirectHandler)
+        start = time.time()
+        try:
+            opener.open(self.launch_url, urllib.urlencode(data)).read()
+            success = False
+        except urllib2.HTTPError as e:
+            # The launch redirects to the question.
+            success = e.code == 302
+        except urllib2.URLError:
+            success = False
+        return success, time.time() - start
+
+    def report(self, results, elapsed, users_created):
+        failed = sum(1 for result in results if not result[1])
+        self.stdout.write('{} launches ({} failed) in {:.1f} s, {:.1f} launches/s.'.format(
+            len(results), failed, elapsed, len(results) / elapsed if elapsed else 0
+        ))
+        medians = {}
+        for new_user, label in [(True, 'New users'), (False, 'Existing users')]:
+            group = [result for result in results if result[0] == new_user and result[1]]
+            if not group:
+                continue
+            latencies = sorted(result[2] * 1000 for result in group)
+            line = '{}: {} launches, p50 {:.1f} ms, p95 {:.1f} ms, p99 {:.1f} ms'.format(
+                label, len(group), percentile(latencies, 0.5), percentile(latencies, 0.95),
+                percentile(latencies, 0.99),
+            )
+            medians[new_user] = [percentile(latencies, 0.5)]
+            if group[0][3] is not None:
+                queries = sorted(result[3] for result in group)
+                line += ', queries p50 {} max {}'.format(percentile(queries, 0.5), queries[-1])
+                medians[new_user].append(percentile(queries, 0.5))
+            self.stdout.write(line + '.')
+        self.stdout.write('{} users created.'.format(users_created))
+        if len(medians) == 2:
+            line = 'User creation cost: {:+.1f} ms median latency'.format(
+                medians[True][0] - medians[False][0]
+            )
+            if len(medians[True]) > 1:
+                line += ', {:+d} queries'.format(medians[True][1] - medians[False][1])
+            self.stdout.write(line + '.')
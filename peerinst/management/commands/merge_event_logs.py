@@ -0,0 +1,36 @@
+import io
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from peerinst import event_log
+
+
+class Command(BaseCommand):
+    help = (
+        'Merge student event log files, e.g. the shards written by each worker process and their '
+        'rotated files, into one stream ordered by the time of the events.  By default, all files '
+        'of the student log configured in the settings are merged.  Gzipped files are supported.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', metavar='path', help='Log file to merge.')
+        parser.add_argument(
+            '--output', default=None, help='File to write the merged log to instead of stdout.'
+        )
+
+    def handle(self, *args, **options):
+        paths = options['paths'] or event_log.get_log_files()
+        if not paths:
+            raise CommandError('No log files found.')
+        if options['output'] is None:
+            self.write_lines(paths, sys.stdout)
+        else:
+            with io.open(options['output'], 'wb') as output:
+                self.write_lines(paths, output)
+        if options['verbosity'] > 1:
+            self.stderr.write('Merged {} files.'.format(len(paths)))
+
+    def write_lines(self, paths, output):
+        for line in event_log.merge_lines(paths):
+            output.write(line)
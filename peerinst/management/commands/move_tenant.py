@@ -0,0 +1,220 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connections, transaction
+from django_lti_tool_provider.models import LtiUserData
+
+from peerinst.models import (
+    Answer, AnswerVote, ArchivedAnswer, ArchivedAnswerVote, BufferedVote, RationaleExposure
+)
+
+
+def chunked(ids, size):
+    ids = sorted(ids)
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+class Command(BaseCommand):
+    help = (
+        'Move the student data of a tenant, i.e. of a course or an LTI consumer key, to another '
+        'database:  the LTI user data, the answers and archived answers of the tenant\'s '
+        'students, and the votes and rationale exposures belonging to them.  Answers chosen as '
+        'rationale by these answers and the expert answers of the questions are copied as well, '
+        'and answers still chosen as rationale by other students are only copied.  Run it before '
+        'adding the tenant to TENANT_DATABASES, and once more afterwards to move the answers '
+        'submitted in between.  Rows that already exist in the target database are skipped, so '
+        'an interrupted move can simply be repeated, but the command aborts instead of deleting '
+        'source rows that differ from the existing ones.  The moved answers are removed from the '
+        'assignment statistics of the source database, run "rebuild_assignment_stats" afterwards '
+        'to add them to the target database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('target', help='Alias of the database to move the tenant to.')
+        tenant = parser.add_mutually_exclusive_group()
+        tenant.add_argument('--course', help='Course id (LTI context id) of the tenant.')
+        tenant.add_argument('--consumer-key', help='LTI consumer key of the tenant.')
+        parser.add_argument(
+            '--from', dest='source', default='default', help='Alias of the source database.'
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=500,
+            help='Number of rows to copy or delete per transaction.',
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true', default=False,
+            help='Only show how many rows would be moved.',
+        )
+
+    def handle(self, *args, **options):
+        if options['course'] is None and options['consumer_key'] is None:
+            raise CommandError('Either --course or --consumer-key is required.')
+        for alias in [options['source'], options['target']]:
+            if alias not in connections.databases:
+                raise CommandError('Unknown database: {}'.format(alias))
+        if options['source'] == options['target']:
+            raise CommandError('The source and target databases are the same.')
+        self.options = options
+        self.source = options['source']
+        self.target = options['target']
+
+        lti_data_ids, answer_keys = self.get_lti_data(options['course'], options['consumer_key'])
+        answer_ids = self.get_tenant_ids(Answer, answer_keys)
+        archived_ids = self.get_tenant_ids(ArchivedAnswer, answer_keys)
+        copied_ids = self.get_copied_answer_ids(answer_ids)
+        deleted_ids = self.get_deleted_answer_ids(answer_ids)
+        if options['dry_run']:
+            self.stdout.write(
+                '{} LTI user data, {} answers and {} archived answers would be moved, {} more '
+                'answers copied.'.format(
+                    len(lti_data_ids), len(deleted_ids), len(archived_ids),
+                    len(copied_ids) - len(deleted_ids),
+                )
+            )
+            return
+
+        # The steps are ordered so that rows are always copied before the rows they depend on are
+        # deleted.
+        steps = [
+            (Answer.objects.using(self.source), 'pk', copied_ids, False),
+            (AnswerVote.objects.using(self.source), 'answer_id', deleted_ids, True),
+            (BufferedVote.objects.using(self.source), 'answer_id', deleted_ids, True),
+            (RationaleExposure.objects.using(self.source), 'answer_id', answer_ids, True),
+            (Answer.objects.using(self.source), 'pk', deleted_ids, True),
+            (ArchivedAnswerVote.objects.using(self.source), 'answer_id', archived_ids, True),
+            (ArchivedAnswer.objects.using(self.source), 'pk', archived_ids, True),
+            (LtiUserData.objects.using(self.source), 'pk', lti_data_ids, True),
+        ]
+        for queryset, field, ids, delete in steps:
+            for chunk in chunked(ids, options['chunk_size']):
+                rows = queryset.filter(**{field + '__in': chunk})
+                self.copy_rows(rows)
+                if delete:
+                    with transaction.atomic(using=self.source):
+                        rows.delete()
+        self.stdout.write(
+            'Moved {} LTI user data, {} answers and {} archived answers, copied {} more answers.'
+            .format(
+                len(lti_data_ids), len(deleted_ids), len(archived_ids),
+                len(copied_ids) - len(deleted_ids),
+            )
+        )
+
+    def get_lti_data(self, course_id, consumer_key):
+        """Return the ids of the LTI user data of the tenant, and the keys of their answers.
+
+        The answers are identified by (user token, assignment id, question id) tuples.
+        """
+        if course_id is not None:
+            parameter, value = 'context_id', course_id
+        else:
+            parameter, value = 'oauth_consumer_key', consumer_key
+        # The parameters are stored as JSON, so they can only be matched here.
+        rows = [
+            lti_data
+            for lti_data in LtiUserData.objects.using(self.source).only(
+                'id', 'user', 'custom_key', 'edx_lti_parameters'
+            )
+            if lti_data.edx_lti_parameters.get(parameter) == value
+        ]
+        usernames = dict(
+            User.objects.filter(pk__in={row.user_id for row in rows}).values_list('pk', 'username')
+        )
+        answer_keys = set()
+        for row in rows:
+            # The custom key is "<assignment id>:<question id>".
+            assignment_id, unused_separator, question_id = row.custom_key.rpartition(':')
+            if row.user_id in usernames and question_id.isdigit():
+                answer_keys.add((usernames[row.user_id], assignment_id, int(question_id)))
+        return {row.pk for row in rows}, answer_keys
+
+    def get_tenant_ids(self, model, answer_keys):
+        """Return the ids of the answers of the given model identified by the given keys."""
+        ids = set()
+        user_tokens = {user_token for user_token, unused_assignment, unused_question in answer_keys}
+        for chunk in chunked(user_tokens, self.options['chunk_size']):
+            answers = model.objects.using(self.source).filter(user_token__in=chunk).values_list(
+                'id', 'user_token', 'assignment_id', 'question_id'
+            )
+            ids.update(answer[0] for answer in answers if answer[1:] in answer_keys)
+        return ids
+
+    def get_copied_answer_ids(self, answer_ids):
+        """Return the ids of the answers to copy along with the given ones.
+
+        These are the expert answers of their questions, and all answers chosen as rationale by
+        the given answers, directly or indirectly.  The given answers are included.
+        """
+        queryset = Answer.objects.using(self.source)
+        question_ids = set()
+        for chunk in chunked(answer_ids, self.options['chunk_size']):
+            question_ids.update(
+                queryset.filter(pk__in=chunk).values_list('question_id', flat=True).distinct()
+            )
+        ids = set(answer_ids)
+        ids.update(
+            queryset.filter(question_id__in=question_ids, expert=True).values_list('pk', flat=True)
+        )
+        new_ids = ids
+        while new_ids:
+            referenced = set()
+            for chunk in chunked(new_ids, self.options['chunk_size']):
+                referenced.update(
+                    queryset.filter(pk__in=chunk).exclude(chosen_rationale=None)
+                    .values_list('chosen_rationale_id', flat=True)
+                )
+            new_ids = referenced - ids
+            ids.update(new_ids)
+        return ids
+
+    def get_deleted_answer_ids(self, answer_ids):
+        """Return the ids of the given answers that aren't chosen as rationale by other answers.
+
+        Deleting the others would delete the answers choosing them as well.
+        """
+        queryset = Answer.objects.using(self.source)
+        ids = set(answer_ids)
+        while ids:
+            referenced = set()
+            for chunk in chunked(ids, self.options['chunk_size']):
+                referenced.update(
+                    chosen_rationale_id
+                    for answer_id, chosen_rationale_id in queryset.filter(
+                        chosen_rationale_id__in=chunk
+                    ).values_list('pk', 'chosen_rationale_id')
+                    if answer_id not in ids
+                )
+            if not referenced:
+                break
+            ids -= referenced
+        return ids
+
+    def copy_rows(self, queryset):
+        """Copy the rows of the given queryset to the target database, unless they exist there.
+
+        Rows that exist in the target database must be identical to the source rows, since they
+        are deleted from the source afterwards.  The sequences of the target database are reset
+        after the rows have been inserted with their ids.
+        """
+        rows = list(queryset)
+        if not rows:
+            return
+        model = queryset.model
+        manager = model._default_manager.db_manager(self.target)
+        existing = manager.in_bulk([row.pk for row in rows])
+        fields = [field.attname for field in model._meta.concrete_fields]
+        for row in rows:
+            if row.pk in existing and any(
+                getattr(row, field) != getattr(existing[row.pk], field) for field in fields
+            ):
+                raise CommandError(
+                    'The {} with id {} in the database "{}" differs from the one in "{}", '
+                    'aborting.'.format(model._meta.verbose_name, row.pk, self.target, self.source)
+                )
+        with transaction.atomic(using=self.target):
+            manager.bulk_create([row for row in rows if row.pk not in existing])
+            connection = connections[self.target]
+            with connection.cursor() as cursor:
+                for sql in connection.ops.sequence_reset_sql(no_style(), [model]):
+                    cursor.execute(sql)
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from peerinst import routers
+from peerinst.models import Assignment, AssignmentQuestionStats
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute the statistics shown in the assignment results from the answers and archived '
+        'answers, in the databases of all tenants.  Run it once to fill in the statistics of the '
+        'answers submitted before they were recorded, and whenever answers have been changed or '
+        'deleted outside the student views, e.g. in the admin or with "move_tenant".  Each '
+        'assignment is recomputed in its own transaction.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'assignment_ids', nargs='*', metavar='assignment',
+            help='Identifier of an assignment to recompute.  Defaults to all assignments.',
+        )
+
+    def handle(self, *args, **options):
+        assignment_ids = options['assignment_ids']
+        if assignment_ids:
+            unknown = set(assignment_ids) - set(
+                Assignment.objects.filter(pk__in=assignment_ids).values_list('pk', flat=True)
+            )
+            if unknown:
+                raise CommandError('Unknown assignments: {}'.format(', '.join(sorted(unknown))))
+        else:
+            assignment_ids = Assignment.objects.order_by('pk').values_list('pk', flat=True)
+        for database in routers.get_tenant_databases():
+            saved = 0
+            with routers.use_database(database):
+                for assignment_id in assignment_ids:
+                    saved += AssignmentQuestionStats.objects.rebuild(assignment_id)
+            self.stdout.write('{}: rebuilt {} statistics cells.'.format(database, saved))
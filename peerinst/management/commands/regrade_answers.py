@@ -0,0 +1,148 @@
+import itertools
+import socket
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django_lti_tool_provider.models import LtiUserData
+
+from peerinst import grade_passback, routers
+from peerinst.models import Answer, GradePassback, Question, SentGrade, compute_grade
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute the grades of all student answers to a question or an assignment, e.g. after '
+        'changing the grading scheme, and send the grades that changed to the LMS.  The answers '
+        'are regraded in the databases of all tenants.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--question', type=int, help='Only regrade answers to this question.')
+        parser.add_argument(
+            '--assignment', help='Only regrade answers given in this assignment.'
+        )
+        parser.add_argument(
+            '--force', action='store_true', default=False,
+            help='Send all grades, even if they are unchanged.',
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true', default=False,
+            help='Only report the number of changed grades without sending them.',
+        )
+        parser.add_argument(
+            '--concurrency', type=int, default=10,
+            help='Number of grades to send in parallel.',
+        )
+        parser.add_argument(
+            '--timeout', type=float, default=10,
+            help='Timeout in seconds for requests to the outcome service.',
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=500,
+            help='Number of answers to process at a time.',
+        )
+
+    def handle(self, *args, **options):
+        if options['question'] is None and options['assignment'] is None:
+            raise CommandError('You need to specify a question or an assignment.')
+        socket.setdefaulttimeout(options['timeout'])
+        databases = routers.get_tenant_databases()
+        total = 0
+        for database in databases:
+            with routers.use_database(database):
+                total += self.get_answers(options).count()
+        self.stats = dict(processed=0, changed=0, sent=0, queued=0, failed=0, skipped=0)
+        for database in databases:
+            with routers.use_database(database):
+                self.regrade(self.get_answers(options), total, options)
+
+    def get_answers(self, options):
+        """Return the answers entered by students in an assignment selected by the options."""
+        answers = Answer.objects.exclude(user_token='').filter(assignment__isnull=False)
+        if options['question'] is not None:
+            answers = answers.filter(question_id=options['question'])
+        if options['assignment'] is not None:
+            answers = answers.filter(assignment_id=options['assignment'])
+        return answers
+
+    def regrade(self, answers, total, options):
+        self.grading = self.get_grading_data(answers)
+        rows = answers.order_by('id').values_list(
+            'question_id', 'assignment_id', 'user_token', 'first_answer_choice',
+            'second_answer_choice',
+        ).iterator()
+        while True:
+            chunk = list(itertools.islice(rows, options['chunk_size']))
+            if not chunk:
+                break
+            self.process_chunk(chunk, options)
+            self.stats['processed'] += len(chunk)
+            self.stdout.write(
+                '{processed}/{total} answers: {changed} changed grades, {sent} sent, {queued} '
+                'queued, {failed} failed, {skipped} without grade passback.'.format(
+                    total=total, **self.stats
+                )
+            )
+
+    def get_grading_data(self, answers):
+        """Return a dict mapping question ids to questions with the fields needed for grading."""
+        question_ids = set(answers.values_list('question_id', flat=True).distinct())
+        return Question.objects.filter(id__in=question_ids).only(
+            'grading_scheme', 'correct_choices_mask', 'choice_count'
+        ).in_bulk(question_ids)
+
+    def compute_grade(self, question_id, first_answer_choice, second_answer_choice):
+        question = self.grading[question_id]
+        return compute_grade(
+            question.grading_scheme, question.is_correct, first_answer_choice, second_answer_choice
+        )
+
+    def process_chunk(self, chunk, options):
+        user_ids = dict(
+            User.objects.filter(username__in={row[2] for row in chunk})
+            .values_list('username', 'id')
+        )
+        grades = {}
+        for question_id, assignment_id, user_token, first, second in chunk:
+            if user_token not in user_ids:
+                continue
+            custom_key = '{}:{}'.format(assignment_id, question_id)
+            grades[user_ids[user_token], custom_key] = self.compute_grade(question_id, first, second)
+        user_ids = {user_id for user_id, unused_key in grades}
+        custom_keys = {custom_key for unused_id, custom_key in grades}
+        if not options['force']:
+            sent_grades = SentGrade.objects.filter(user_id__in=user_ids, custom_key__in=custom_keys)
+            for user_id, custom_key, grade in sent_grades.values_list(
+                    'user_id', 'custom_key', 'grade'):
+                if grades.get((user_id, custom_key)) == grade:
+                    del grades[user_id, custom_key]
+        self.stats['changed'] += len(grades)
+        lti_parameters = {
+            (lti_data.user_id, lti_data.custom_key): lti_data.edx_lti_parameters
+            for lti_data in LtiUserData.objects.filter(
+                user_id__in=user_ids, custom_key__in=custom_keys
+            )
+            if lti_data.edx_lti_parameters.get('lis_outcome_service_url')
+        }
+        to_send = [(key, grade) for key, grade in grades.iteritems() if key in lti_parameters]
+        self.stats['skipped'] += len(grades) - len(to_send)
+        if options['dry_run'] or not to_send:
+            return
+        if settings.LTI_GRADE_PASSBACK_ASYNC:
+            for (user_id, custom_key), grade in to_send:
+                GradePassback.objects.enqueue(User(id=user_id), custom_key, grade)
+            self.stats['queued'] += len(to_send)
+            return
+        errors = grade_passback.send_grades_in_parallel(
+            [(lti_parameters[key], grade) for key, grade in to_send], options['concurrency']
+        )
+        for ((user_id, custom_key), grade), error in zip(to_send, errors):
+            if error is None:
+                SentGrade.objects.record(user_id, custom_key, grade)
+                self.stats['sent'] += 1
+            else:
+                self.stderr.write('Sending grade for user {} and key {} failed: {}'.format(
+                    user_id, custom_key, error
+                ))
+                self.stats['failed'] += 1
@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from peerinst import backfill, routers
+
+
+class Command(BaseCommand):
+    help = (
+        'Run the given backfills, or all scheduled backfills that have not been completed yet, in '
+        'chunks ordered by primary key.  The progress is saved after every chunk, so the command '
+        'can be interrupted at any time and resumes where it stopped.  Backfills of the student '
+        'data run in the databases of all tenants.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', metavar='name', help='Name of a backfill.')
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help='Number of rows to process per transaction.',
+        )
+        parser.add_argument(
+            '--sleep', type=float, default=0,
+            help='Seconds to pause between chunks to reduce the load on the database.',
+        )
+        parser.add_argument(
+            '--max-chunks', type=int, default=None,
+            help='Stop after processing this many chunks of each backfill.',
+        )
+        parser.add_argument(
+            '--list', action='store_true', default=False,
+            help='List the available backfills and the pending ones.',
+        )
+
+    def handle(self, *args, **options):
+        databases = routers.get_tenant_databases()
+        if options['list']:
+            pending = set().union(*(backfill.get_pending(database) for database in databases))
+            for name in sorted(backfill.registry):
+                self.stdout.write('{}{}'.format(name, ' (pending)' if name in pending else ''))
+            return
+        unknown = set(options['names']) - set(backfill.registry)
+        if unknown:
+            raise CommandError('Unknown backfills: {}'.format(', '.join(sorted(unknown))))
+        for database in databases:
+            names = options['names'] or backfill.get_pending(database)
+            for name in names:
+                if database != DEFAULT_DB_ALIAS and not routers.is_tenant_model(
+                        backfill.registry[name].model):
+                    # Backfills of the shared tables only run in the default database.
+                    continue
+                done = backfill.run(
+                    name,
+                    database=database,
+                    chunk_size=options['chunk_size'],
+                    sleep=options['sleep'],
+                    max_chunks=options['max_chunks'],
+                    progress=self.report_progress if options['verbosity'] > 1 else None,
+                )
+                self.stdout.write('{}: {}'.format(
+                    backfill.get_checkpoint_name(name, database), 'done' if done else 'paused'
+                ))
+
+    def report_progress(self, checkpoint):
+        self.stdout.write('{}: processed {} rows so far.'.format(
+            checkpoint.name, checkpoint.processed
+        ))
@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from peerinst import bulk_jobs
+
+
+class Command(BaseCommand):
+    help = (
+        'Run the deletions and bulk updates enqueued in the admin interface, in small chunks.  '
+        'Interrupted jobs are resumed.  Runs until no jobs are left, or forever if an interval is '
+        'given.  Only run one instance of this command at a time.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=500,
+            help='Number of rows to delete or update per transaction.',
+        )
+        parser.add_argument(
+            '--sleep', type=float, default=0,
+            help='Seconds to pause between chunks to reduce the load on the database.',
+        )
+        parser.add_argument(
+            '--interval', type=float, default=None,
+            help='Keep running and poll for new jobs every INTERVAL seconds.',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            job = bulk_jobs.get_next_job()
+            if job is not None:
+                success = bulk_jobs.run_job(
+                    job, chunk_size=options['chunk_size'], sleep=options['sleep']
+                )
+                self.stdout.write('{}: {}'.format(job, 'done' if success else 'failed'))
+                continue
+            if options['interval'] is None:
+                break
+            time.sleep(options['interval'])
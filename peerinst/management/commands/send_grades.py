@@ -0,0 +1,58 @@
+import socket
+import time
+
+from django.core.management.base import BaseCommand
+
+from peerinst import grade_passback
+
+
+class Command(BaseCommand):
+    help = (
+        'Send the grades queued in asynchronous grade passback mode to the LMS.  Runs until the '
+        'queue has no due grades left, or forever if an interval is given.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help='Number of grades to claim from the queue at a time.',
+        )
+        parser.add_argument(
+            '--concurrency', type=int, default=10,
+            help='Number of grades to send in parallel.',
+        )
+        parser.add_argument(
+            '--timeout', type=float, default=10,
+            help='Timeout in seconds for requests to the outcome service.',
+        )
+        parser.add_argument(
+            '--max-attempts', type=int, default=8,
+            help='Number of attempts before a grade is marked as failed.',
+        )
+        parser.add_argument(
+            '--retry-delay', type=float, default=30,
+            help='Delay in seconds before the first retry.  Doubles with every attempt.',
+        )
+        parser.add_argument(
+            '--interval', type=float, default=None,
+            help='Keep running and poll the queue every INTERVAL seconds.',
+        )
+
+    def handle(self, *args, **options):
+        # The LTI library doesn't allow passing a timeout, so we set the default for this process.
+        socket.setdefaulttimeout(options['timeout'])
+        while True:
+            stats = grade_passback.process_queue(
+                batch_size=options['batch_size'],
+                concurrency=options['concurrency'],
+                max_attempts=options['max_attempts'],
+                base_delay=options['retry_delay'],
+            )
+            if stats:
+                self.stdout.write('Sent {sent}, retrying {retried}, failed {failed}.'.format(
+                    sent=stats['sent'], retried=stats['retried'], failed=stats['failed'],
+                ))
+                continue
+            if options['interval'] is None:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from . import routers
+
+
+class TenantMiddleware(object):
+    """Make sure that the tenant database activated by a view doesn't leak into other requests.
+
+    The question view activates the database of the tenant of the question, see
+    peerinst.routers.
+    """
+
+    def process_request(self, request):
+        routers.deactivate()
+
+    def process_response(self, request, response):
+        routers.deactivate()
+        return response
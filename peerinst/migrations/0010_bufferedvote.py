@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('peerinst', '0009_auto_20160210_2236'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BufferedVote',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('answer_id', models.PositiveIntegerField()),
+                ('upvotes', models.PositiveSmallIntegerField(default=0)),
+                ('downvotes', models.PositiveSmallIntegerField(default=0)),
+            ],
+        ),
+    ]
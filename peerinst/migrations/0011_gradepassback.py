@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('peerinst', '0010_bufferedvote'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GradePassback',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('custom_key', models.CharField(max_length=190)),
+                ('grade', models.FloatField()),
+                ('status', models.PositiveSmallIntegerField(default=0, verbose_name='Status', choices=[(0, 'Pending'), (1, 'Sending'), (2, 'Failed')])),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='Attempts')),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Next attempt')),
+                ('claim', models.CharField(db_index=True, max_length=32, blank=True)),
+                ('last_error', models.TextField(verbose_name='Last error', blank=True)),
+                ('user', models.ForeignKey(to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'grade passback',
+                'verbose_name_plural': 'grade passbacks',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='gradepassback',
+            index_together=set([('status', 'next_attempt')]),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('peerinst', '0011_gradepassback'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SentGrade',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('custom_key', models.CharField(max_length=190)),
+                ('grade', models.FloatField(verbose_name='Grade')),
+                ('sent', models.DateTimeField(verbose_name='Sent')),
+                ('user', models.ForeignKey(to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'sent grade',
+                'verbose_name_plural': 'sent grades',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='sentgrade',
+            unique_together=set([('user', 'custom_key')]),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def fill_answer_choice_summary(apps, schema_editor):
+    Question = apps.get_model('peerinst', 'Question')
+    AnswerChoice = apps.get_model('peerinst', 'AnswerChoice')
+    summaries = {}
+    for question_id, correct in AnswerChoice.objects.order_by('question_id', 'id').values_list(
+            'question_id', 'correct'):
+        correct_choices_mask, choice_count = summaries.get(question_id, (0, 0))
+        if correct:
+            correct_choices_mask |= 1 << choice_count
+        summaries[question_id] = correct_choices_mask, choice_count + 1
+    for question_id, (correct_choices_mask, choice_count) in summaries.iteritems():
+        Question.objects.filter(pk=question_id).update(
+            correct_choices_mask=correct_choices_mask, choice_count=choice_count
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('peerinst', '0012_sentgrade'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='question',
+            name='choice_count',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='question',
+            name='correct_choices_mask',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_answer_choice_summary, migrations.RunPython.noop),
+    ]
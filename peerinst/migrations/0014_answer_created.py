@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def created_field(**kwargs):
+    return models.DateTimeField(
+        verbose_name='Created', null=True, editable=False, db_index=True, **kwargs
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('peerinst', '0013_question_correct_choices_mask'),
+    ]
+
+    # The columns are added without a default, so existing rows are left NULL instead of all
+    # getting the time of the migration (which would also rewrite the whole table).  Use the
+    # backfill_created_timestamps management command to fill them in batches.
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.AddField(
+                    model_name='answer',
+                    name='created',
+                    field=created_field(),
+                ),
+                migrations.AddField(
+                    model_name='answervote',
+                    name='created',
+                    field=created_field(),
+                ),
+            ],
+            state_operations=[
+                migrations.AddField(
+                    model_name='answer',
+                    name='created',
+                    field=created_field(default=django.utils.timezone.now),
+                ),
+                migrations.AddField(
+                    model_name='answervote',
+                    name='created',
+                    field=created_field(default=django.utils.timezone.now),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('peerinst', '0014_answer_created'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RationaleText',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('digest', models.CharField(unique=True, max_length=64)),
+                ('text', models.TextField(verbose_name='Text')),
+            ],
+        ),
+        # The existing column keeps its name, so existing rationales stay in place until they are
+        # moved with the intern_rationales management command.
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.RenameField(
+                    model_name='answer',
+                    old_name='rationale',
+                    new_name='legacy_rationale',
+                ),
+                migrations.AlterField(
+                    model_name='answer',
+                    name='legacy_rationale',
+                    field=models.TextField(db_column='rationale', blank=True, editable=False),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name='answer',
+            name='rationale_text',
+            field=models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.PROTECT, blank=True, editable=False, to='peerinst.RationaleText', null=True),
+        ),
+    ]
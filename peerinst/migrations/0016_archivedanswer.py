@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('peerinst', '0015_rationaletext'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedAnswer',
+            fields=[
+                ('id', models.IntegerField(serialize=False, primary_key=True)),
+                ('first_answer_choice', models.PositiveSmallIntegerField(verbose_name='First answer choice')),
+                ('legacy_rationale', models.TextField(blank=True)),
+                ('second_answer_choice', models.PositiveSmallIntegerField(null=True, verbose_name='Second answer choice', blank=True)),
+                ('chosen_rationale_id', models.PositiveIntegerField(null=True, blank=True)),
+                ('user_token', models.CharField(max_length=100, blank=True)),
+                ('show_to_others', models.BooleanField(default=True, verbose_name='Show to others?')),
+                ('expert', models.BooleanField(default=False, verbose_name='Expert rationale?')),
+                ('upvotes', models.PositiveIntegerField(default=0)),
+                ('downvotes', models.PositiveIntegerField(default=0)),
+                ('created', models.DateTimeField(null=True, verbose_name='Created')),
+                ('archived', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Archived')),
+                ('assignment', models.ForeignKey(blank=True, to='peerinst.Assignment', null=True)),
+                ('question', models.ForeignKey(to='peerinst.Question')),
+                ('rationale_text', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.PROTECT, blank=True, to='peerinst.RationaleText', null=True)),
+            ],
+            options={
+                'verbose_name': 'archived answer',
+                'verbose_name_plural': 'archived answers',
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedAnswerVote',
+            fields=[
+                ('id', models.IntegerField(serialize=False, primary_key=True)),
+                ('user_token', models.CharField(max_length=100)),
+                ('fake_username', models.CharField(max_length=100)),
+                ('fake_country', models.CharField(max_length=100)),
+                ('vote_type', models.PositiveSmallIntegerField(verbose_name='Vote type', choices=[(0, 'upvote'), (1, 'downvote'), (2, 'final_choice')])),
+                ('created', models.DateTimeField(null=True, verbose_name='Created')),
+                ('answer', models.ForeignKey(to='peerinst.ArchivedAnswer')),
+                ('assignment', models.ForeignKey(to='peerinst.Assignment')),
+            ],
+        ),
+    ]
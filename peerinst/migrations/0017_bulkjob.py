@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('peerinst', '0016_archivedanswer'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BulkJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('kind', models.CharField(max_length=32, verbose_name='Kind', choices=[('delete_question', 'Delete question'), ('delete_assignment', 'Delete assignment'), ('publish_answers', 'Show answers to students')])),
+                ('target', models.CharField(max_length=100, blank=True)),
+                ('answer_ids', models.TextField(blank=True)),
+                ('description', models.CharField(max_length=300, verbose_name='Description')),
+                ('status', models.PositiveSmallIntegerField(default=0, verbose_name='Status', choices=[(0, 'Pending'), (1, 'Running'), (2, 'Done'), (3, 'Failed')])),
+                ('total', models.PositiveIntegerField(default=0, verbose_name='Total rows')),
+                ('processed', models.PositiveIntegerField(default=0, verbose_name='Processed rows')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Created')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='Updated')),
+                ('last_error', models.TextField(verbose_name='Last error', blank=True)),
+            ],
+            options={
+                'verbose_name': 'bulk job',
+                'verbose_name_plural': 'bulk jobs',
+            },
+        ),
+    ]
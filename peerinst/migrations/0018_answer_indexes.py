@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('peerinst', '0017_bulkjob'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='answer',
+            index_together=set([('question', 'show_to_others', 'first_answer_choice'), ('question', 'assignment', 'second_answer_choice')]),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def check_duplicates(apps, schema_editor):
+    # The answers of each tenant are checked when its database is migrated, see peerinst.routers.
+    Answer = apps.get_model('peerinst', 'Answer')
+    duplicates = (
+        Answer.objects.using(schema_editor.connection.alias).exclude(assignment=None)
+        .values('assignment', 'question', 'user_token')
+        .annotate(count=Count('id')).filter(count__gt=1)
+    )
+    if duplicates.exists():
+        raise RuntimeError(
+            'Some students have several answers to the same question and assignment.  Run the '
+            '"dedupe_answers" management command before applying this migration.'
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('peerinst', '0018_answer_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            check_duplicates, migrations.RunPython.noop, hints={'model_name': 'answer'}
+        ),
+        migrations.AlterUniqueTogether(
+            name='answer',
+            unique_together=set([('assignment', 'question', 'user_token')]),
+        ),
+    ]
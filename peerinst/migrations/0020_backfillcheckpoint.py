@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+from peerinst import backfill
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('peerinst', '0019_answer_unique_per_student'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackfillCheckpoint',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(unique=True, max_length=100, verbose_name='Name')),
+                ('last_pk', models.PositiveIntegerField(default=0, verbose_name='Last processed primary key')),
+                ('processed', models.PositiveIntegerField(default=0, verbose_name='Processed rows')),
+                ('done', models.BooleanField(default=False, verbose_name='Done')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Created')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='Updated')),
+            ],
+        ),
+        # Backfills for fields added before backfills could be scheduled.
+        backfill.schedule('answer_created'),
+        backfill.schedule('answervote_created'),
+        backfill.schedule('answer_rationale_text'),
+    ]
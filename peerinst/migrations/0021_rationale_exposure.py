@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+from peerinst import backfill
+
+COUNTERS = [('times_chosen', 'Times chosen'), ('times_shown', 'Times shown')]
+
+
+def counter_field(verbose_name, **kwargs):
+    return models.PositiveIntegerField(verbose_name=verbose_name, null=True, **kwargs)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('peerinst', '0020_backfillcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RationaleExposure',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('answer_id', models.PositiveIntegerField(db_index=True)),
+                ('rationale_id', models.PositiveIntegerField(db_index=True)),
+                ('chosen', models.BooleanField(default=False)),
+            ],
+        ),
+        # The counters are added without a default, so existing answers are left NULL instead of
+        # rewriting the whole tables.  The backfills scheduled below set them to zero in batches.
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.AddField(
+                    model_name=model_name,
+                    name=name,
+                    field=counter_field(verbose_name),
+                )
+                for model_name in ['answer', 'archivedanswer']
+                for name, verbose_name in COUNTERS
+            ],
+            state_operations=[
+                migrations.AddField(
+                    model_name=model_name,
+                    name=name,
+                    field=counter_field(verbose_name, default=0),
+                )
+                for model_name in ['answer', 'archivedanswer']
+                for name, verbose_name in COUNTERS
+            ],
+        ),
+        migrations.AddField(
+            model_name='bufferedvote',
+            name='times_chosen',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='bufferedvote',
+            name='times_shown',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        backfill.schedule('answer_exposure_counters'),
+        backfill.schedule('archivedanswer_exposure_counters'),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('peerinst', '0021_rationale_exposure'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AssignmentQuestionStats',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('archived', models.BooleanField(default=False)),
+                ('first_answer_choice', models.PositiveSmallIntegerField()),
+                ('second_answer_choice', models.PositiveSmallIntegerField(default=0)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('students', models.BinaryField(default=b'')),
+                ('assignment', models.ForeignKey(to='peerinst.Assignment')),
+                ('question', models.ForeignKey(to='peerinst.Question')),
+            ],
+            options={
+                'verbose_name': 'assignment question statistics',
+                'verbose_name_plural': 'assignment question statistics',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='assignmentquestionstats',
+            unique_together=set([('assignment', 'question', 'archived', 'first_answer_choice', 'second_answer_choice')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('peerinst', '0022_assignment_question_stats'),
+    ]
+
+    # Building the index locks the answers table, so it is kept out of the migration adding the
+    # counters and can be applied separately during a maintenance window.
+    operations = [
+        migrations.AlterIndexTogether(
+            name='answer',
+            index_together=set([('question', 'times_shown', 'times_chosen'), ('question', 'show_to_others', 'first_answer_choice'), ('question', 'assignment', 'second_answer_choice')]),
+        ),
+    ]
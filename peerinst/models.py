@@ -1,13 +1,22 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import collections
+import hashlib
 import itertools
 import string
+from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import IntegrityError, models, router, transaction
+from django.db.models import Case, F, When
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
 from django.core import exceptions
 from django.utils.translation import ugettext_lazy as _
-from . import rationale_choice
+from . import aggregates, rationale_choice
+from .util import HyperLogLog
 
 
 def no_hyphens(value):
@@ -20,6 +29,25 @@ class GradingScheme(object):
     ADVANCED = 1
 
 
+def compute_grade(grading_scheme, is_correct, first_answer_choice, second_answer_choice):
+    """Compute a grade based on a grading scheme.
+
+    `is_correct` is a callable returning whether the answer choice with the given index is
+    correct.
+    """
+    if grading_scheme == GradingScheme.STANDARD:
+        # Standard grading scheme: Full score if second answer is correct
+        return float(is_correct(second_answer_choice))
+    else:
+        # Advanced grading scheme: Partial scores for individual answers
+        grade = 0.
+        if is_correct(first_answer_choice):
+            grade += 0.5
+        if is_correct(second_answer_choice):
+            grade += 0.5
+        return grade
+
+
 class Category(models.Model):
     title = models.CharField(
         _('Category Name'), unique=True, max_length=100,
@@ -41,6 +69,22 @@ class QuestionManager(models.Manager):
     def get_by_natural_key(self, title):
         return self.get(title=title)
 
+    def update_answer_choice_summary(self, question_id):
+        """Recompute the correctness bitmask and choice count of a question from its choices.
+
+        Returns the pair (correct_choices_mask, choice_count).
+        """
+        correct_choices = AnswerChoice.objects.filter(question_id=question_id).order_by('id')
+        correct_choices_mask = 0
+        choice_count = 0
+        for choice_count, correct in enumerate(correct_choices.values_list('correct', flat=True), 1):
+            if correct:
+                correct_choices_mask |= 1 << (choice_count - 1)
+        self.filter(pk=question_id).update(
+            correct_choices_mask=correct_choices_mask, choice_count=choice_count
+        )
+        return correct_choices_mask, choice_count
+
 
 class Question(models.Model):
     objects = QuestionManager()
@@ -129,6 +173,11 @@ class Question(models.Model):
         )
     )
 
+    # Denormalized data about the answer choices, kept in sync when answer choices are saved or
+    # deleted.  Bit i of the mask is set if the answer choice with index i + 1 is correct.
+    correct_choices_mask = models.PositiveIntegerField(default=0, editable=False)
+    choice_count = models.PositiveSmallIntegerField(default=0, editable=False)
+
     def __unicode__(self):
         if self.category:
             return u'{} - {}'.format(self.category, self.title)
@@ -182,7 +231,19 @@ class Question(models.Model):
         ]
 
     def is_correct(self, index):
-        return self.answerchoice_set.all()[index - 1].correct
+        """Return whether the answer choice with the given index (starting at 1) is correct."""
+        if index is None or not 0 < index <= self.choice_count:
+            return False
+        return bool(self.correct_choices_mask >> (index - 1) & 1)
+
+    def get_correct_choices(self):
+        """Return a list of the indices of the correct answer choices."""
+        return [index for index in range(1, self.choice_count + 1) if self.is_correct(index)]
+
+    def update_answer_choice_summary(self):
+        self.correct_choices_mask, self.choice_count = (
+            Question.objects.update_answer_choice_summary(self.pk)
+        )
 
     class Meta:
         verbose_name = _('question')
@@ -203,6 +264,20 @@ class AnswerChoice(models.Model):
         verbose_name_plural = _('answer choices')
 
 
+@receiver(post_save, sender=AnswerChoice)
+def answer_choice_saved(sender, instance, raw, **kwargs):
+    if raw:
+        # Loading fixtures, the question might not exist yet.
+        Question.objects.update_answer_choice_summary(instance.question_id)
+    else:
+        instance.question.update_answer_choice_summary()
+
+
+@receiver(post_delete, sender=AnswerChoice)
+def answer_choice_deleted(sender, instance, **kwargs):
+    Question.objects.update_answer_choice_summary(instance.question_id)
+
+
 class Assignment(models.Model):
     identifier = models.CharField(
         _('identifier'), primary_key=True, max_length=100,
@@ -219,11 +294,134 @@ class Assignment(models.Model):
         verbose_name_plural = _('assignments')
 
 
+class RationaleTextManager(models.Manager):
+    @staticmethod
+    def get_digest(text):
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def intern(self, text):
+        """Return the stored copy of the given text, creating it if necessary."""
+        digest = self.get_digest(text)
+        try:
+            with transaction.atomic():
+                return self.get_or_create(digest=digest, defaults={'text': text})[0]
+        except IntegrityError:
+            # The same text was stored concurrently.
+            return self.get(digest=digest)
+
+    def intern_many(self, texts):
+        """Return a dict mapping each of the given texts to the id of its stored copy.
+
+        Missing texts are created with a single query.
+        """
+        texts_by_digest = {self.get_digest(text): text for text in texts}
+        ids = dict(self.filter(digest__in=texts_by_digest).values_list('digest', 'id'))
+        missing = [
+            RationaleText(digest=digest, text=text)
+            for digest, text in texts_by_digest.iteritems() if digest not in ids
+        ]
+        if missing:
+            try:
+                with transaction.atomic():
+                    self.bulk_create(missing)
+            except IntegrityError:
+                # Some of the texts were stored concurrently.
+                for rationale_text in missing:
+                    self.intern(rationale_text.text)
+            ids.update(
+                self.filter(digest__in=[rationale_text.digest for rationale_text in missing])
+                .values_list('digest', 'id')
+            )
+        return {text: ids[digest] for digest, text in texts_by_digest.iteritems()}
+
+
+class RationaleText(models.Model):
+    """The text of a rationale, stored only once no matter how many answers use it."""
+    objects = RationaleTextManager()
+
+    digest = models.CharField(max_length=64, unique=True)
+    text = models.TextField(_('Text'))
+
+    def __unicode__(self):
+        return self.text
+
+
+class AnswerManager(models.Manager):
+    def add_to_counters(self, deltas):
+        """Add to the counter fields of several answers using a single conditional UPDATE.
+
+        `deltas` maps field names to dicts mapping answer ids to the amount to add.  Incrementing
+        in the database avoids the lost-update window of reading, modifying and saving each
+        answer.  Counters that are still NULL because they haven't been backfilled yet count as zero.
+        Returns the number of updated rows.
+        """
+        answer_ids = set()
+        updates = {}
+        for field, amounts in deltas.iteritems():
+            # Group the answers by amount, so we need only one WHEN clause per distinct amount.
+            ids_by_amount = collections.defaultdict(list)
+            for answer_id, amount in amounts.iteritems():
+                if amount:
+                    ids_by_amount[amount].append(answer_id)
+            if not ids_by_amount:
+                continue
+            answer_ids.update(amounts)
+            updates[field] = Case(
+                *[
+                    When(id__in=ids, then=Coalesce(F(field), 0) + amount)
+                    for amount, ids in ids_by_amount.iteritems()
+                ],
+                default=F(field),
+                output_field=models.IntegerField()
+            )
+        if not updates:
+            return 0
+        return self.filter(id__in=answer_ids).update(**updates)
+
+    def get_conversion_rates(self, question_id):
+        """Return how often the rationales of a question were shown and chosen.
+
+        Returns a list of tuples (answer id, times shown, times chosen) for all answers that have
+        been shown at least once.  The query is answered from an index alone.
+        """
+        return [
+            (answer_id, times_shown, times_chosen or 0)
+            for answer_id, times_shown, times_chosen in
+            self.filter(question_id=question_id, times_shown__gt=0)
+            .values_list('id', 'times_shown', 'times_chosen')
+        ]
+
+    def resolve_rationales(self, answers):
+        """Load the rationale texts of the given answers or archived answers with a single query.
+
+        The rationale texts are fetched by id instead of joining them to the (wide) answers, and
+        only for answers that don't have their text loaded yet.
+        """
+        pending = [
+            answer for answer in answers
+            if answer.rationale_text_id is not None and not answer.has_rationale_text_loaded()
+        ]
+        if pending:
+            texts = RationaleText.objects.in_bulk({answer.rationale_text_id for answer in pending})
+            for answer in pending:
+                answer.rationale_text = texts[answer.rationale_text_id]
+        return answers
+
+
 class Answer(models.Model):
+    objects = AnswerManager()
+
     question = models.ForeignKey(Question)
     assignment = models.ForeignKey(Assignment, blank=True, null=True)
     first_answer_choice = models.PositiveSmallIntegerField(_('First answer choice'))
-    rationale = models.TextField(_('Rationale'))
+    # The rationale text is stored in RationaleText and accessed through the rationale property.
+    # Answers stored before that still have their text in legacy_rationale until the
+    # intern_rationales management command has been run.
+    rationale_text = models.ForeignKey(
+        RationaleText, blank=True, null=True, on_delete=models.PROTECT, related_name='+',
+        editable=False
+    )
+    legacy_rationale = models.TextField(db_column='rationale', blank=True, editable=False)
     second_answer_choice = models.PositiveSmallIntegerField(
         _('Second answer choice'), blank=True, null=True
     )
@@ -236,6 +434,27 @@ class Answer(models.Model):
     )
     upvotes = models.PositiveIntegerField(default=0)
     downvotes = models.PositiveIntegerField(default=0)
+    # How often this answer was shown as a rationale to other students, and how often they chose it.
+    # Null only for answers predating these fields that haven't been backfilled yet.
+    times_shown = models.PositiveIntegerField(_('Times shown'), default=0, null=True)
+    times_chosen = models.PositiveIntegerField(_('Times chosen'), default=0, null=True)
+    # Null only for answers predating this field that haven't been backfilled yet.
+    created = models.DateTimeField(
+        _('Created'), default=timezone.now, null=True, db_index=True, editable=False
+    )
+
+    class Meta:
+        # Each student can only submit one answer per question and assignment.  The unique index
+        # also serves the lookup of a student's answer in the question view.
+        unique_together = [('assignment', 'question', 'user_token')]
+        index_together = [
+            # Rationale selection
+            ('question', 'show_to_others', 'first_answer_choice'),
+            # Statistics in the admin views
+            ('question', 'assignment', 'second_answer_choice'),
+            # Conversion rates of the rationales, see AnswerManager.get_conversion_rates()
+            ('question', 'times_shown', 'times_chosen'),
+        ]
 
     def first_answer_choice_label(self):
         return self.question.get_choice_label(self.first_answer_choice)
@@ -250,20 +469,39 @@ class Answer(models.Model):
     def __unicode__(self):
         return unicode(_('{} for question {}').format(self.id, self.question.title))
 
+    @property
+    def rationale(self):
+        new_rationale = getattr(self, '_new_rationale', None)
+        if new_rationale is not None:
+            return new_rationale
+        if self.rationale_text_id is None:
+            return self.legacy_rationale
+        return self.rationale_text.text
+
+    @rationale.setter
+    def rationale(self, text):
+        # The text is stored when the answer is saved.
+        self._new_rationale = text
+
+    def has_rationale_text_loaded(self):
+        return hasattr(self, Answer._meta.get_field('rationale_text').get_cache_name())
+
+    def save(self, *args, **kwargs):
+        new_rationale = getattr(self, '_new_rationale', None)
+        if new_rationale is not None:
+            self.rationale_text = RationaleText.objects.intern(new_rationale)
+            self.legacy_rationale = ''
+            del self._new_rationale
+        super(Answer, self).save(*args, **kwargs)
+
     def get_grade(self):
         """ Compute grade based on grading scheme of question. """
-        if self.question.grading_scheme == GradingScheme.STANDARD:
-            # Standard grading scheme: Full score if second answer is correct
-            correct = self.question.is_correct(self.second_answer_choice)
-            return float(correct)
-        else:
-            # Advanced grading scheme: Partial scores for individual answers
-            grade = 0.
-            if self.question.is_correct(self.first_answer_choice):
-                grade += 0.5
-            if self.question.is_correct(self.second_answer_choice):
-                grade += 0.5
-            return grade
+        return compute_grade(
+            self.question.grading_scheme,
+            self.question.is_correct,
+            self.first_answer_choice,
+            self.second_answer_choice,
+        )
 
 
 class FakeUsername(models.Model):
@@ -296,3 +534,520 @@ class AnswerVote(models.Model):
         (FINAL_CHOICE, 'final_choice'),
     )
     vote_type = models.PositiveSmallIntegerField(_('Vote type'), choices=VOTE_TYPE_CHOICES)
+    # Null only for votes predating this field that haven't been backfilled yet.
+    created = models.DateTimeField(
+        _('Created'), default=timezone.now, null=True, db_index=True, editable=False
+    )
+
+
+class BufferedVoteManager(models.Manager):
+    def flush(self, batch_size=1000):
+        """Fold the buffered votes into the vote counters of the answers in batches.
+
+        Each batch is processed in its own short transaction.  Returns the number of buffered
+        votes processed.
+        """
+        processed = 0
+        while True:
+            with transaction.atomic(using=router.db_for_write(self.model)):
+                batch = list(
+                    self.select_for_update().order_by('id')
+                    .values_list('id', 'answer_id', *BufferedVote.COUNTER_FIELDS)[:batch_size]
+                )
+                if not batch:
+                    break
+                deltas = {field: collections.Counter() for field in BufferedVote.COUNTER_FIELDS}
+                for row in batch:
+                    for field, amount in zip(BufferedVote.COUNTER_FIELDS, row[2:]):
+                        deltas[field][row[1]] += amount
+                Answer.objects.add_to_counters(deltas)
+                self.filter(id__in=[row[0] for row in batch]).delete()
+            processed += len(batch)
+        return processed
+
+
+class BufferedVote(models.Model):
+    """Append-only buffer of vote counter deltas used in write-behind mode.
+
+    The answer is referenced by id only, so inserting into the buffer never touches the rows of
+    the answers table.
+    """
+    objects = BufferedVoteManager()
+
+    COUNTER_FIELDS = ('upvotes', 'downvotes', 'times_shown', 'times_chosen')
+
+    answer_id = models.PositiveIntegerField()
+    upvotes = models.PositiveSmallIntegerField(default=0)
+    downvotes = models.PositiveSmallIntegerField(default=0)
+    times_shown = models.PositiveSmallIntegerField(default=0)
+    times_chosen = models.PositiveSmallIntegerField(default=0)
+
+
+class RationaleExposure(models.Model):
+    """A rationale shown to a student when reviewing a question, recorded at submission.
+
+    Like in BufferedVote, both answers are referenced by id only, so recording exposures never
+    locks the rows of popular rationales in the answers table.  The ids stay valid when the
+    answers are archived.
+    """
+    # The answer of the student who was shown the rationale.
+    answer_id = models.PositiveIntegerField(db_index=True)
+    # The answer whose rationale was shown.
+    rationale_id = models.PositiveIntegerField(db_index=True)
+    chosen = models.BooleanField(default=False)
+
+
+class ArchivedAnswerManager(models.Manager):
+    def archive(self, answer_ids):
+        """Move the given answers and all votes on them to the archive tables.
+
+        Answers still chosen as rationale by an answer that isn't archived along with them are
+        skipped, since deleting them would delete the referring answers as well.  The answers are
+        moved to the archived statistics, and everything happens in a single transaction.
+        Returns a pair (archived answer ids, number of votes).
+        """
+        with transaction.atomic(using=router.db_for_write(Answer)):
+            answers = {
+                answer.id: answer
+                for answer in Answer.objects.select_for_update().filter(id__in=answer_ids)
+            }
+            ids = set(answers)
+            while ids:
+                referenced = set(
+                    Answer.objects.filter(chosen_rationale_id__in=ids).exclude(id__in=ids)
+                    .values_list('chosen_rationale_id', flat=True)
+                )
+                if not referenced:
+                    break
+                ids -= referenced
+            if not ids:
+                return [], 0
+            now = timezone.now()
+            answer_fields = [
+                field.attname for field in ArchivedAnswer._meta.concrete_fields
+                if field.attname != 'archived'
+            ]
+            self.bulk_create([
+                ArchivedAnswer(archived=now, **{
+                    field: getattr(answers[answer_id], field) for field in answer_fields
+                })
+                for answer_id in sorted(ids)
+            ])
+            votes = AnswerVote.objects.filter(answer_id__in=ids)
+            vote_fields = [field.attname for field in ArchivedAnswerVote._meta.concrete_fields]
+            archived_votes = [
+                ArchivedAnswerVote(**vote) for vote in votes.order_by('id').values(*vote_fields)
+            ]
+            ArchivedAnswerVote.objects.bulk_create(archived_votes)
+            votes.delete()
+            # Break references between the archived answers first, so they can be deleted in
+            # any order.
+            archived = Answer.objects.filter(id__in=ids)
+            archived.exclude(chosen_rationale=None).update(chosen_rationale=None)
+            archived.delete()
+            # Deleting the answers has removed them from the statistics of the current answers.
+            cells = collections.defaultdict(list)
+            for answer in (answers[answer_id] for answer_id in sorted(ids)):
+                if answer.assignment_id is not None and answer.user_token:
+                    cells[
+                        answer.assignment_id, answer.question_id, answer.first_answer_choice,
+                        answer.second_answer_choice
+                    ].append(answer.user_token)
+            # The cells are locked in a fixed order, so concurrent archiving can't deadlock.
+            for (assignment_id, question_id, first, second), user_tokens in sorted(
+                    cells.iteritems()):
+                AssignmentQuestionStats.objects.add(
+                    assignment_id, question_id, True, first, second, user_tokens
+                )
+        return sorted(ids), len(archived_votes)
+
+
+class ArchivedAnswer(models.Model):
+    """An answer moved out of the answers table by the archive_answers management command.
+
+    Archived answers keep their ids.  The chosen rationale can be an answer or an archived answer,
+    so its id is stored as a plain integer.
+    """
+    objects = ArchivedAnswerManager()
+
+    id = models.IntegerField(primary_key=True)
+    question = models.ForeignKey(Question)
+    assignment = models.ForeignKey(Assignment, blank=True, null=True)
+    first_answer_choice = models.PositiveSmallIntegerField(_('First answer choice'))
+    rationale_text = models.ForeignKey(
+        RationaleText, blank=True, null=True, on_delete=models.PROTECT, related_name='+'
+    )
+    legacy_rationale = models.TextField(blank=True)
+    second_answer_choice = models.PositiveSmallIntegerField(
+        _('Second answer choice'), blank=True, null=True
+    )
+    chosen_rationale_id = models.PositiveIntegerField(blank=True, null=True)
+    user_token = models.CharField(max_length=100, blank=True)
+    show_to_others = models.BooleanField(_('Show to others?'), default=True)
+    expert = models.BooleanField(_('Expert rationale?'), default=False)
+    upvotes = models.PositiveIntegerField(default=0)
+    downvotes = models.PositiveIntegerField(default=0)
+    times_shown = models.PositiveIntegerField(_('Times shown'), default=0, null=True)
+    times_chosen = models.PositiveIntegerField(_('Times chosen'), default=0, null=True)
+    created = models.DateTimeField(_('Created'), null=True)
+    archived = models.DateTimeField(_('Archived'), default=timezone.now)
+
+    class Meta:
+        verbose_name = _('archived answer')
+        verbose_name_plural = _('archived answers')
+
+    def __unicode__(self):
+        return unicode(_('{} for question {}').format(self.id, self.question.title))
+
+    @property
+    def rationale(self):
+        if self.rationale_text_id is None:
+            return self.legacy_rationale
+        return self.rationale_text.text
+
+    def has_rationale_text_loaded(self):
+        return hasattr(self, ArchivedAnswer._meta.get_field('rationale_text').get_cache_name())
+
+    @property
+    def chosen_rationale(self):
+        """Return the chosen rationale, which may or may not have been archived itself."""
+        if self.chosen_rationale_id is None:
+            return None
+        return (
+            Answer.objects.filter(id=self.chosen_rationale_id).first() or
+            ArchivedAnswer.objects.filter(id=self.chosen_rationale_id).first()
+        )
+
+    def get_grade(self):
+        return compute_grade(
+            self.question.grading_scheme,
+            self.question.is_correct,
+            self.first_answer_choice,
+            self.second_answer_choice,
+        )
+
+
+class ArchivedAnswerVote(models.Model):
+    """A vote on an archived answer."""
+    id = models.IntegerField(primary_key=True)
+    answer = models.ForeignKey(ArchivedAnswer)
+    assignment = models.ForeignKey(Assignment)
+    user_token = models.CharField(max_length=100)
+    fake_username = models.CharField(max_length=100)
+    fake_country = models.CharField(max_length=100)
+    vote_type = models.PositiveSmallIntegerField(
+        _('Vote type'), choices=AnswerVote.VOTE_TYPE_CHOICES
+    )
+    created = models.DateTimeField(_('Created'), null=True)
+
+
+class AssignmentQuestionStatsManager(models.Manager):
+    def add(self, assignment_id, question_id, archived, first, second, user_tokens):
+        """Add the answers of the given students to a cell of a transition matrix.
+
+        The cell is created if necessary.  It stays locked until the transaction ends, so
+        concurrent submissions only wait for each other if they have the same answer choices.
+        """
+        cell_key = dict(
+            assignment_id=assignment_id, question_id=question_id, archived=archived,
+            first_answer_choice=first, second_answer_choice=second or 0,
+        )
+        database = self._db or router.db_for_write(self.model)
+        with transaction.atomic(using=database):
+            cell = self.select_for_update().filter(**cell_key).first()
+            if cell is None:
+                try:
+                    with transaction.atomic(using=database):
+                        cell = self.model(count=0, **cell_key)
+                        cell.add_students(user_tokens)
+                        cell.save(using=database)
+                    return
+                except IntegrityError:
+                    # Another transaction has created the cell in the meantime.
+                    cell = self.select_for_update().get(**cell_key)
+            cell.add_students(user_tokens)
+            cell.save(update_fields=['count', 'students'])
+
+    def record_answer(self, answer):
+        """Add a newly submitted answer to the transition matrix of its assignment and question.
+
+        This must be called inside the transaction saving the answer, as late as possible.
+        """
+        if answer.assignment_id is not None and answer.user_token:
+            self.add(
+                answer.assignment_id, answer.question_id, False,
+                answer.first_answer_choice, answer.second_answer_choice, [answer.user_token],
+            )
+
+    def remove_answer(self, answer, archived):
+        """Remove a deleted answer or archived answer from its transition matrix.
+
+        The student stays in the sketch of the cell, since sketches can't forget values, until
+        the statistics are rebuilt.
+        """
+        if answer.assignment_id is not None and answer.user_token:
+            self.filter(
+                assignment_id=answer.assignment_id, question_id=answer.question_id,
+                archived=archived, first_answer_choice=answer.first_answer_choice,
+                second_answer_choice=answer.second_answer_choice or 0, count__gt=0,
+            ).update(count=F('count') - 1)
+
+    def get_transition_matrices(self, assignment_id, include_archived=False):
+        """Return a dict mapping question ids to the transition matrices of the assignment.
+
+        The result is the same as aggregates.get_transition_matrices() for the answers of the
+        assignment, and the archived answers if `include_archived` is true.
+        """
+        matrices, unused_students = self.get_stats(assignment_id, include_archived, False)
+        return matrices
+
+    def get_stats(self, assignment_id, include_archived=False, students=True):
+        """Return the transition matrices and the students of the questions of an assignment.
+
+        Returns a pair (matrices, students) of dicts mapping question ids to transition matrices
+        and to HyperLogLog sketches of the user tokens, see peerinst.util.HyperLogLog.  The
+        sketches can be merged to count the students of the whole assignment.  They are only
+        loaded if `students` is true.  Runs a single query.
+        """
+        cells = self.filter(assignment_id=assignment_id, count__gt=0)
+        if not include_archived:
+            cells = cells.filter(archived=False)
+        fields = ['question_id', 'first_answer_choice', 'second_answer_choice', 'count']
+        if students:
+            fields.append('students')
+        matrices = collections.defaultdict(aggregates.TransitionMatrix)
+        sketches = collections.defaultdict(HyperLogLog)
+        for row in cells.values_list(*fields):
+            question_id, first, second, count = row[:4]
+            matrices[question_id][first, second or None] += count
+            if students and row[4]:
+                sketches[question_id].update(HyperLogLog.from_bytes(row[4]))
+        return matrices, sketches
+
+    def rebuild(self, assignment_id, question_ids=None):
+        """Recompute the transition matrices of an assignment from its answers and archived answers.
+
+        Only the given questions are recomputed if `question_ids` is given.  The existing cells are
+        locked and updated in place, so submissions in the meantime wait for the rebuild to finish
+        instead of being lost.  Returns the number of cells saved.
+        """
+        with transaction.atomic(using=router.db_for_write(self.model)):
+            cells = self.select_for_update().filter(assignment_id=assignment_id)
+            if question_ids is not None:
+                cells = cells.filter(question_id__in=question_ids)
+            existing = {
+                (cell.question_id, cell.archived, cell.first_answer_choice,
+                 cell.second_answer_choice): cell
+                for cell in cells
+            }
+            saved = 0
+            for archived, model in [(False, Answer), (True, ArchivedAnswer)]:
+                answers = model.objects.filter(assignment_id=assignment_id).exclude(user_token='')
+                if question_ids is not None:
+                    answers = answers.filter(question_id__in=question_ids)
+                rows = answers.order_by().values_list(
+                    'question_id', 'first_answer_choice', 'second_answer_choice', 'user_token'
+                )
+                new_cells = {}
+                for question_id, first, second, user_token in rows.iterator():
+                    key = question_id, archived, first, second or 0
+                    if key not in new_cells:
+                        new_cells[key] = existing.pop(key, None) or self.model(
+                            assignment_id=assignment_id, question_id=question_id,
+                            archived=archived, first_answer_choice=first,
+                            second_answer_choice=second or 0,
+                        )
+                        new_cells[key].count = 0
+                        new_cells[key].students = b''
+                    new_cells[key].add_students([user_token])
+                for cell in new_cells.itervalues():
+                    cell.save()
+                    saved += 1
+            # The remaining cells don't have any answers anymore.
+            self.filter(pk__in=[cell.pk for cell in existing.itervalues()]).delete()
+        return saved
+
+
+class AssignmentQuestionStats(models.Model):
+    """A cell of the transition matrix of a question in an assignment, see peerinst.aggregates.
+
+    The assignment results are read from this table instead of the answers.  Only the numbers of
+    answers by pair of answer choices are stored, so the correct answers are always derived from
+    the current answer key.  Each cell also holds a HyperLogLog sketch of the user tokens of its
+    answers, which are merged to count the distinct students.  The answers and the archived
+    answers each have their own cells.  The cells are updated when answers are submitted, archived
+    or deleted, and can be recomputed with the "rebuild_assignment_stats" management command, e.g.
+    after changing answers in the admin.
+    """
+    objects = AssignmentQuestionStatsManager()
+
+    assignment = models.ForeignKey(Assignment)
+    question = models.ForeignKey(Question)
+    archived = models.BooleanField(default=False)
+    first_answer_choice = models.PositiveSmallIntegerField()
+    # 0 for answers without a second answer choice, so the unique constraint applies to them.
+    second_answer_choice = models.PositiveSmallIntegerField(default=0)
+    count = models.PositiveIntegerField(default=0)
+    # HyperLogLog sketch of the user tokens, see peerinst.util.HyperLogLog.
+    students = models.BinaryField(default=b'')
+
+    class Meta:
+        unique_together = [(
+            'assignment', 'question', 'archived', 'first_answer_choice', 'second_answer_choice'
+        )]
+        verbose_name = _('assignment question statistics')
+        verbose_name_plural = _('assignment question statistics')
+
+    def add_students(self, user_tokens):
+        """Add answers of the given students to the count and the sketch of the cell."""
+        students = HyperLogLog.from_bytes(self.students) if self.students else HyperLogLog()
+        for user_token in user_tokens:
+            students.add(user_token)
+        self.students = students.to_bytes()
+        self.count += len(user_tokens)
+
+
+@receiver(post_delete, sender=Answer)
+def answer_deleted(sender, instance, using, **kwargs):
+    AssignmentQuestionStats.objects.db_manager(using).remove_answer(instance, archived=False)
+
+
+@receiver(post_delete, sender=ArchivedAnswer)
+def archived_answer_deleted(sender, instance, using, **kwargs):
+    AssignmentQuestionStats.objects.db_manager(using).remove_answer(instance, archived=True)
+
+
+class GradePassbackManager(models.Manager):
+    def enqueue(self, user, custom_key, grade):
+        """Queue a grade for sending to the LMS.
+
+        A grade still waiting to be sent for the same user and key is replaced, and grades that
+        have failed for good are superseded by the new one.  A grade that is being sent right now
+        can't be changed anymore, so a new grade is queued after it, see
+        grade_passback.claim_due_grades().
+        """
+        grades = self.filter(user=user, custom_key=custom_key)
+        grades.filter(status=GradePassback.FAILED).delete()
+        if not grades.filter(status=GradePassback.PENDING).update(grade=grade):
+            self.create(user=user, custom_key=custom_key, grade=grade)
+
+
+class GradePassback(models.Model):
+    """A grade waiting to be sent to the LMS by the "send_grades" management command."""
+    objects = GradePassbackManager()
+
+    PENDING = 0
+    SENDING = 1
+    FAILED = 2
+    STATUS_CHOICES = (
+        (PENDING, _('Pending')),
+        (SENDING, _('Sending')),
+        (FAILED, _('Failed')),
+    )
+    user = models.ForeignKey(settings.AUTH_USER_MODEL)
+    custom_key = models.CharField(max_length=190)
+    grade = models.FloatField()
+    status = models.PositiveSmallIntegerField(
+        _('Status'), choices=STATUS_CHOICES, default=PENDING
+    )
+    attempts = models.PositiveSmallIntegerField(_('Attempts'), default=0)
+    # For claimed grades, this is the time the claim expires and the grade is retried.
+    next_attempt = models.DateTimeField(_('Next attempt'), default=timezone.now)
+    claim = models.CharField(max_length=32, blank=True, db_index=True)
+    last_error = models.TextField(_('Last error'), blank=True)
+
+    class Meta:
+        index_together = [('status', 'next_attempt')]
+        verbose_name = _('grade passback')
+        verbose_name_plural = _('grade passbacks')
+
+
+class SentGradeManager(models.Manager):
+    def is_sent(self, user, custom_key, grade):
+        """Return whether exactly this grade was the last one sent for the user and key."""
+        return self.filter(user=user, custom_key=custom_key, grade=grade).exists()
+
+    def record(self, user_id, custom_key, grade):
+        """Record a grade as successfully sent for the user and key."""
+        values = dict(grade=grade, sent=timezone.now())
+        if self.filter(user_id=user_id, custom_key=custom_key).update(**values):
+            return
+        try:
+            with transaction.atomic():
+                self.create(user_id=user_id, custom_key=custom_key, **values)
+        except IntegrityError:
+            # A concurrent request recorded a grade in the meantime.
+            self.filter(user_id=user_id, custom_key=custom_key).update(**values)
+
+
+class SentGrade(models.Model):
+    """The last grade successfully sent to the LMS for a user and key."""
+    objects = SentGradeManager()
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL)
+    custom_key = models.CharField(max_length=190)
+    grade = models.FloatField(_('Grade'))
+    sent = models.DateTimeField(_('Sent'))
+
+    class Meta:
+        unique_together = [('user', 'custom_key')]
+        verbose_name = _('sent grade')
+        verbose_name_plural = _('sent grades')
+
+
+class BulkJob(models.Model):
+    """A deletion or bulk update processed in chunks by the run_bulk_jobs management command."""
+    DELETE_QUESTION = 'delete_question'
+    DELETE_ASSIGNMENT = 'delete_assignment'
+    PUBLISH_ANSWERS = 'publish_answers'
+    KIND_CHOICES = (
+        (DELETE_QUESTION, _('Delete question')),
+        (DELETE_ASSIGNMENT, _('Delete assignment')),
+        (PUBLISH_ANSWERS, _('Show answers to students')),
+    )
+    PENDING = 0
+    RUNNING = 1
+    DONE = 2
+    FAILED = 3
+    STATUS_CHOICES = (
+        (PENDING, _('Pending')),
+        (RUNNING, _('Running')),
+        (DONE, _('Done')),
+        (FAILED, _('Failed')),
+    )
+
+    kind = models.CharField(_('Kind'), max_length=32, choices=KIND_CHOICES)
+    # The primary key of the question or assignment to delete.
+    target = models.CharField(max_length=100, blank=True)
+    # Comma-separated ids of the answers to update.
+    answer_ids = models.TextField(blank=True)
+    description = models.CharField(_('Description'), max_length=300)
+    status = models.PositiveSmallIntegerField(
+        _('Status'), choices=STATUS_CHOICES, default=PENDING
+    )
+    total = models.PositiveIntegerField(_('Total rows'), default=0)
+    processed = models.PositiveIntegerField(_('Processed rows'), default=0)
+    created = models.DateTimeField(_('Created'), default=timezone.now)
+    updated = models.DateTimeField(_('Updated'), auto_now=True)
+    last_error = models.TextField(_('Last error'), blank=True)
+
+    class Meta:
+        verbose_name = _('bulk job')
+        verbose_name_plural = _('bulk jobs')
+
+    def __unicode__(self):
+        return self.description
+
+
+class BackfillCheckpoint(models.Model):
+    """Progress of a backfill run by the run_backfill management command."""
+    name = models.CharField(_('Name'), max_length=100, unique=True)
+    # Rows up to this primary key have been processed.
+    last_pk = models.PositiveIntegerField(_('Last processed primary key'), default=0)
+    processed = models.PositiveIntegerField(_('Processed rows'), default=0)
+    done = models.BooleanField(_('Done'), default=False)
+    created = models.DateTimeField(_('Created'), default=timezone.now)
+    updated = models.DateTimeField(_('Updated'), auto_now=True)
+
+    def __unicode__(self):
+        return self.name
@@ -44,12 +44,11 @@ def _base_selection_algorithm(
     """Select the rationales at random."""
     from . import models  # Local import to avoid circular dependency
     first_choice = first_answer_choice
-    answer_choices = question.answerchoice_set.all()
     # Find all public rationales for this question.
     all_rationales = models.Answer.objects.filter(question=question, show_to_others=True)
     # Select a second answer to offer at random.  If the user's answer wasn't correct, the
     # second answer choice offered must be correct.
-    if answer_choices[first_choice - 1].correct:
+    if question.is_correct(first_choice):
         # We must make sure that rationales for the second answer exist.  The choice is
         # weighted by the number of rationales available.
         other_rationales = all_rationales.exclude(first_answer_choice=first_choice)
@@ -63,9 +62,7 @@ def _base_selection_algorithm(
         second_choice = random_rationale.first_answer_choice
     else:
         # Select a random correct answer.  We assume that a correct answer exists.
-        second_choice = rng.choice(
-            [i for i, choice in enumerate(answer_choices, 1) if choice.correct]
-        )
+        second_choice = rng.choice(question.get_correct_choices())
     chosen_choices = []
     for choice in [first_choice, second_choice]:
         label = question.get_choice_label(choice)
@@ -73,7 +70,9 @@ def _base_selection_algorithm(
         rationales = all_rationales.filter(first_answer_choice=choice)
         # Select up to four rationales for each choice, if available.
         if rationales:
-            rationales = selection_callback(rng, rationales)
+            rationales = models.Answer.objects.resolve_rationales(
+                selection_callback(rng, rationales)
+            )
             rationales = [(r.id, r.rationale) for r in rationales]
         else:
             rationales = []
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""Routing of the student data of each tenant to its own database, and of reports to replicas.
+
+All courses share the question bank (questions, assignments, categories, rationale texts, users,
+...), which stays in the default database.  The student data -- answers, votes and the LTI user
+data -- can be split by tenant, i.e. by LTI consumer key or by course, to move the load of big
+tenants to their own database nodes.  The settings map tenants to database aliases in
+TENANT_DATABASES; tenants that aren't listed use the default database.
+
+The tenant is determined when a user launches a question through LTI and stored in the session
+for that question, and the question view activates its database.  TenantMiddleware deactivates it
+again after each request.  Outside the question view, e.g. in management commands, the default
+database is used unless another one is activated with use_database().
+
+Data of a tenant that already has answers in the default database can be moved to its own
+database with the "move_tenant" management command.
+
+Each database can have a read replica configured in DATABASE_REPLICAS.  Views decorated with
+use_replica(), i.e. the reports, read from the replicas instead, unless a replica lags too far
+behind its primary database.
+"""
+from __future__ import unicode_literals
+
+import contextlib
+import functools
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError
+from django.db.models import Max
+from django.utils.decorators import method_decorator
+
+LOGGER = logging.getLogger(__name__)
+
+# Session key of the tenant of an LTI user, see set_session_tenant().
+TENANT_SESSION_KEY = 'tenant'
+
+# Models stored in the database of the tenant, as (app label, model name) pairs.  All other models
+# are stored in the default database.
+TENANT_MODELS = frozenset([
+    ('peerinst', 'answer'),
+    ('peerinst', 'answervote'),
+    ('peerinst', 'archivedanswer'),
+    ('peerinst', 'archivedanswervote'),
+    ('peerinst', 'assignmentquestionstats'),
+    ('peerinst', 'bufferedvote'),
+    ('peerinst', 'rationaleexposure'),
+    ('django_lti_tool_provider', 'ltiuserdata'),
+])
+
+# Seconds for which the result of checking the lag of a replica is reused.
+REPLICA_CHECK_INTERVAL = 10
+
+_active = threading.local()
+
+# Maps replica aliases to (time of the check, whether the replica is current) pairs.
+_replica_checks = {}
+
+
+def is_tenant_model(model):
+    return (model._meta.app_label, model._meta.model_name) in TENANT_MODELS
+
+
+def get_tenant_database(consumer_key=None, course_id=None):
+    """Return the alias of the database of the given tenant.
+
+    A course id listed in TENANT_DATABASES takes precedence over the LTI consumer key.
+    """
+    tenant_databases = settings.TENANT_DATABASES
+    for key in [course_id, consumer_key]:
+        if key and key in tenant_databases:
+            return tenant_databases[key]
+    return DEFAULT_DB_ALIAS
+
+
+def get_tenant_databases():
+    """Return the aliases of all databases holding tenant data, starting with the default one."""
+    aliases = set(settings.TENANT_DATABASES.values())
+    aliases.discard(DEFAULT_DB_ALIAS)
+    return [DEFAULT_DB_ALIAS] + sorted(aliases)
+
+
+def get_active_database():
+    """Return the alias of the tenant database activated in the current thread."""
+    return getattr(_active, 'database', None) or DEFAULT_DB_ALIAS
+
+
+def activate(database):
+    _active.database = database
+
+
+def deactivate():
+    _active.database = None
+
+
+@contextlib.contextmanager
+def use_database(database):
+    """Activate the given tenant database in the current thread for the duration of the block."""
+    previous = getattr(_active, 'database', None)
+    activate(database)
+    try:
+        yield
+    finally:
+        activate(previous)
+
+
+def get_primary_database(database):
+    """Return the alias of the primary database of a replica, or the given alias otherwise."""
+    for primary, replica in settings.DATABASE_REPLICAS.iteritems():
+        if replica == database:
+            return primary
+    return database
+
+
+def get_replica_lag(database, replica):
+    """Return by how many seconds the answers in the replica lag behind the primary database.
+
+    The lag is measured by comparing the creation time of the latest answer, which is cheap to
+    look up.  Returns None if the replica doesn't have any answers at all.
+    """
+    from .models import Answer
+
+    latest = Answer.objects.using(database).aggregate(latest=Max('created'))['latest']
+    if latest is None:
+        return 0
+    replica_latest = Answer.objects.using(replica).aggregate(latest=Max('created'))['latest']
+    if replica_latest is None:
+        return None
+    return max(0, (latest - replica_latest).total_seconds())
+
+
+def is_replica_current(database, replica):
+    """Return whether the replica is close enough to the primary database to read reports from.
+
+    The result is reused for REPLICA_CHECK_INTERVAL seconds.
+    """
+    now = time.time()
+    checked = _replica_checks.get(replica)
+    if checked is None or now - checked[0] > REPLICA_CHECK_INTERVAL:
+        try:
+            lag = get_replica_lag(database, replica)
+        except DatabaseError:
+            LOGGER.exception('Checking the lag of the replica %s failed.', replica)
+            lag = None
+        current = lag is not None and lag <= settings.DATABASE_REPLICA_MAX_LAG
+        if not current:
+            LOGGER.warning(
+                'The replica %s lags behind by %s seconds, reading from %s instead.',
+                replica, lag, database
+            )
+        checked = _replica_checks[replica] = now, current
+    return checked[1]
+
+
+def get_read_database(database):
+    """Return the alias of the database to read from in place of the given one.
+
+    Within use_replica(), this is the replica of the database if it is current.  The decision is
+    kept for the rest of the block, so all reads of a request see the same data.
+    """
+    replicas = getattr(_active, 'replicas', None)
+    replica = settings.DATABASE_REPLICAS.get(database)
+    if replicas is None or replica is None:
+        return database
+    if database not in replicas:
+        replicas[database] = replica if is_replica_current(database, replica) else database
+    return replicas[database]
+
+
+def get_tenant_read_databases():
+    """Return the aliases of the databases to read the data of all tenants from.
+
+    Reports across tenants query these with QuerySet.using(), which bypasses the routers, so the
+    replicas are chosen here as in get_read_database().
+    """
+    return [get_read_database(database) for database in get_tenant_databases()]
+
+
+@contextlib.contextmanager
+def replica_reads():
+    """Read from the replicas for the duration of the block."""
+    previous = getattr(_active, 'replicas', None)
+    _active.replicas = {}
+    try:
+        yield
+    finally:
+        _active.replicas = previous
+
+
+def use_replica(view):
+    """View decorator sending the reads of GET and HEAD requests to the replicas.
+
+    The response is rendered within the decorator, since templates can still run queries.  Use
+    it with method_decorator() on the dispatch() method of class-based views.
+    """
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return view(request, *args, **kwargs)
+        with replica_reads():
+            response = view(request, *args, **kwargs)
+            if callable(getattr(response, 'render', None)):
+                response.render()
+        return response
+    return wrapper
+
+
+class UseReplicaMixin(object):
+    """Class-based view mixin sending the reads of GET and HEAD requests to the replicas."""
+
+    @method_decorator(use_replica)
+    def dispatch(self, *args, **kwargs):
+        return super(UseReplicaMixin, self).dispatch(*args, **kwargs)
+
+
+def set_session_tenant(request, custom_key, consumer_key, course_id):
+    """Store the tenant of an LTI launch in the session and activate its database.
+
+    The same user can launch questions of several courses in one session, so the tenant is stored
+    per custom key, i.e. per assignment question.
+    """
+    tenants = dict(request.session.get(TENANT_SESSION_KEY) or {})
+    tenants[custom_key] = {'consumer_key': consumer_key, 'course_id': course_id}
+    request.session[TENANT_SESSION_KEY] = tenants
+    activate(get_tenant_database(consumer_key, course_id))
+
+
+def get_session_database(session, custom_key):
+    """Return the alias of the database of the tenant of the custom key stored in the session."""
+    tenant = (session.get(TENANT_SESSION_KEY) or {}).get(custom_key)
+    if not tenant:
+        return DEFAULT_DB_ALIAS
+    return get_tenant_database(tenant.get('consumer_key'), tenant.get('course_id'))
+
+
+class TenantRouter(object):
+    """Route the tenant models to the active tenant database and everything else to the default one.
+
+    Related objects are looked up in the database of the instance they are accessed from, so
+    tenant data loaded from a database that isn't the active one stays consistent.
+    """
+
+    def get_database(self, model, instance=None):
+        if not is_tenant_model(model):
+            return DEFAULT_DB_ALIAS
+        if instance is not None and instance._state.db and is_tenant_model(type(instance)):
+            return instance._state.db
+        return get_active_database()
+
+    def db_for_read(self, model, **hints):
+        return self.get_database(model, hints.get('instance'))
+
+    def db_for_write(self, model, **hints):
+        return self.get_database(model, hints.get('instance'))
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Tenant data references the shared tables across databases, but tenant data of
+        # different databases must not be mixed.
+        if is_tenant_model(type(obj1)) and is_tenant_model(type(obj2)):
+            return obj1._state.db == obj2._state.db
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == DEFAULT_DB_ALIAS or db not in settings.TENANT_DATABASES.values():
+            return None
+        # Databases of tenants only contain the tenant models.
+        return (app_label, model_name) in TENANT_MODELS
+
+
+class ReplicaRouter(TenantRouter):
+    """Route the tenant models like TenantRouter, and reads within use_replica() to the replicas.
+
+    Writes always go to the primary database, even for objects read from a replica.
+    """
+
+    def db_for_read(self, model, **hints):
+        return get_read_database(super(ReplicaRouter, self).db_for_read(model, **hints))
+
+    def db_for_write(self, model, **hints):
+        return get_primary_database(super(ReplicaRouter, self).db_for_write(model, **hints))
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if is_tenant_model(type(obj1)) and is_tenant_model(type(obj2)):
+            return get_primary_database(obj1._state.db) == get_primary_database(obj2._state.db)
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in settings.DATABASE_REPLICAS.values():
+            # Replicas get their tables from the primary database.
+            return False
+        return super(ReplicaRouter, self).allow_migrate(db, app_label, model_name, **hints)
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""A local stand-in for the LTI outcome service of an LMS."""
+from __future__ import unicode_literals
+
+import BaseHTTPServer
+import re
+import threading
+
+RESPONSE_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<imsx_POXEnvelopeResponse xmlns="http://www.imsglobal.org/services/ltiv1p1/xsd/imsoms_v1p0">
+  <imsx_POXHeader>
+    <imsx_POXResponseHeaderInfo>
+      <imsx_version>V1.0</imsx_version>
+      <imsx_messageIdentifier>1</imsx_messageIdentifier>
+      <imsx_statusInfo>
+        <imsx_codeMajor>{code_major}</imsx_codeMajor>
+        <imsx_severity>status</imsx_severity>
+        <imsx_description>Fake outcome service</imsx_description>
+        <imsx_messageRefIdentifier>1</imsx_messageRefIdentifier>
+        <imsx_operationRefIdentifier>replaceResult</imsx_operationRefIdentifier>
+      </imsx_statusInfo>
+    </imsx_POXResponseHeaderInfo>
+  </imsx_POXHeader>
+  <imsx_POXBody><replaceResultResponse/></imsx_POXBody>
+</imsx_POXEnvelopeResponse>
+"""
+
+
+class FakeOutcomeService(object):
+    """Outcome service listening on a local port that records the grades it receives.
+
+    If `accept` is False, all grades are rejected with an HTTP error.
+    """
+
+    def __init__(self, accept=True):
+        self.accept = accept
+        self.grades = []
+        service = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+                if not service.accept:
+                    self.send_error(500)
+                    return
+                grade = re.search(r'<textString>([^<]*)</textString>', body)
+                service.grades.append(float(grade.group(1)))
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/xml')
+                self.end_headers()
+                self.wfile.write(RESPONSE_TEMPLATE.format(code_major='success'))
+
+            def log_message(self, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/grade_handler'.format(self.server.server_port)
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -4,22 +4,30 @@ import ddt
 import mock
 
 from itertools import repeat
-from django.test import TestCase
+from unittest import skipUnless
+from django.conf import settings
+from django.test import TestCase, override_settings
 from django.core.urlresolvers import reverse
+from django_lti_tool_provider.models import LtiUserData
 from . import factories
+from .. import aggregates
 from .. import admin_views
 from .. import models
 from .. import admin
+from .. import routers
 
 
 class AggregatesTestCase(TestCase):
     fixtures = ['peerinst_test_data']
 
-    def test_get_question_aggregates(self):
+    def get_assignment_stats(self, include_archived=False):
         assignment = models.Assignment.objects.get(identifier='Assignment1')
+        models.AssignmentQuestionStats.objects.rebuild(assignment.pk)
+        return admin_views.get_assignment_stats(assignment, include_archived)
 
-        question = models.Question.objects.get(id=29)
-        sums, students = admin_views.get_question_aggregates(assignment, question)
+    def test_get_question_stats(self):
+        unused_sums, question_data = self.get_assignment_stats()
+        question_sums = {question.pk: dict(q_sums) for question, q_sums in question_data}
         expected_sums = {
             'correct_first_answers': 6,
             'correct_second_answers': 3,
@@ -29,15 +37,9 @@ class AggregatesTestCase(TestCase):
             ('switches', 3): 3,
             ('switches', 4): 3,
             'total_answers': 14,
+            'total_students': 14,
         }
-        self.assertDictEqual(dict(sums), expected_sums)
-        expected_students = {
-            'bmnwf', 'eeawg', 'esbxa', 'kmhti', 'nrqek', 'qsrzd', 'rhtof', 'upjwt', 'yosbj'
-        }
-        self.assertSetEqual(students, expected_students)
-
-        question = models.Question.objects.get(id=30)
-        sums, students = admin_views.get_question_aggregates(assignment, question)
+        self.assertDictEqual(question_sums[29], expected_sums)
         expected_sums = {
             'correct_first_answers': 3,
             'correct_second_answers': 3,
@@ -45,15 +47,12 @@ class AggregatesTestCase(TestCase):
             ('switches', 1): 3,
             ('switches', 2): 3,
             'total_answers': 6,
+            'total_students': 6,
         }
-        self.assertDictEqual(dict(sums), expected_sums)
-        expected_students = {'askvw', 'ciuaq', 'etgfe', 'glepb', 'kmhti', 'nrqek'}
-        self.assertSetEqual(students, expected_students)
-
-    def test_get_assignment_aggregates(self):
-        assignment = models.Assignment.objects.get(identifier='Assignment1')
+        self.assertDictEqual(question_sums[30], expected_sums)
 
-        sums, unused_question_data = admin_views.get_assignment_aggregates(assignment)
+    def test_get_assignment_stats(self):
+        sums, unused_question_data = self.get_assignment_stats()
         expected_sums = {
             'correct_first_answers': 9,
             'correct_second_answers': 6,
@@ -63,10 +62,168 @@ class AggregatesTestCase(TestCase):
             ('switches', 3): 3,
             ('switches', 4): 3,
             'total_answers': 20,
-            'total_students': 13,
+            'total_students': 18,
         }
         self.assertDictEqual(dict(sums), expected_sums)
 
+    def test_get_assignment_stats_queries(self):
+        assignment = models.Assignment.objects.get(identifier='Assignment1')
+        models.AssignmentQuestionStats.objects.rebuild(assignment.pk)
+        # The questions and the statistics cells
+        for include_archived in [False, True]:
+            with self.assertNumQueries(2):
+                admin_views.get_assignment_stats(assignment, include_archived)
+
+    def test_student_count_modes(self):
+        assignment = models.Assignment.objects.get(identifier='Assignment1')
+        models.ArchivedAnswer.objects.archive(
+            models.Answer.objects.filter(assignment=assignment, question_id=29)
+            .values_list('pk', flat=True)
+        )
+        for mode in ['exact', 'distinct', 'approximate']:
+            with override_settings(STUDENT_COUNT_MODE=mode):
+                total, by_question = aggregates.get_student_counts(
+                    admin_views.get_answer_querysets(assignment, include_archived=True),
+                    [29, 30],
+                )
+            self.assertEqual(total, 18)
+            self.assertEqual(dict(by_question), {29: 14, 30: 6})
+
+    def test_question_rationale_aggregates_include_archived(self):
+        assignment = models.Assignment.objects.get(identifier='Assignment1')
+        question = models.Question.objects.get(pk=29)
+
+        def get_aggregates(include_archived):
+            sums, rationales = admin_views.get_question_rationale_aggregates(
+                assignment, question, None, include_archived=include_archived
+            )
+            return dict(sums), {
+                key: sorted(
+                    (item['rationale'] and item['rationale'].pk, item['rationale'] and
+                     item['rationale'].rationale, item['count'])
+                    for item in items
+                )
+                for key, items in rationales.iteritems()
+            }
+
+        expected = get_aggregates(include_archived=False)
+        self.assertTrue(expected[0]['chosen'])
+        models.ArchivedAnswer.objects.archive(
+            models.Answer.objects.filter(assignment=assignment, question=question)
+            .values_list('pk', flat=True)
+        )
+        self.assertFalse(
+            models.Answer.objects.filter(assignment=assignment, question=question).exists()
+        )
+        self.assertEqual(get_aggregates(include_archived=True), expected)
+        sums, unused_rationales = get_aggregates(include_archived=False)
+        self.assertEqual((sums['upvoted'], sums['chosen']), (0, 0))
+
+    def test_attribution_analysis_include_archived(self):
+        assignment = factories.AssignmentFactory()
+        question = factories.QuestionFactory(choices=2, choices__correct=[1])
+        answer = factories.AnswerFactory(
+            assignment=assignment, question=question, first_answer_choice=1, user_token='a'
+        )
+        models.AnswerVote.objects.create(
+            answer=answer, assignment=assignment, user_token='b', fake_username='Alice',
+            fake_country='Canada', vote_type=models.AnswerVote.UPVOTE,
+        )
+        models.ArchivedAnswer.objects.archive([answer.pk])
+        view = admin_views.AttributionAnalysis()
+        form_data = dict(assignment=assignment, question=question, include_archived=False)
+        self.assertEqual(view.get_aggregates(form_data), ([], []))
+        form_data.update(include_archived=True)
+        username_data, country_data = view.get_aggregates(form_data)
+        self.assertEqual([row[:3] for row in username_data], [('Alice', 1, 1)])
+        self.assertEqual([row[:3] for row in country_data], [('Canada', 1, 1)])
+
+    def test_get_assignment_stats_archived(self):
+        assignment = models.Assignment.objects.get(identifier='Assignment1')
+        # The statistics of the fixtures have to be computed first.
+        sums, unused_question_data = admin_views.get_assignment_stats(assignment)
+        self.assertEqual(sums['total_answers'], 0)
+        expected_sums, expected_question_data = self.get_assignment_stats()
+        models.ArchivedAnswer.objects.archive(
+            models.Answer.objects.filter(assignment=assignment, question_id=30)
+            .values_list('pk', flat=True)
+        )
+        sums, question_data = admin_views.get_assignment_stats(assignment, include_archived=True)
+        self.assertDictEqual(dict(sums), dict(expected_sums))
+        self.assertEqual(
+            [(question, dict(q_sums)) for question, q_sums in question_data],
+            [(question, dict(q_sums)) for question, q_sums in expected_question_data],
+        )
+        sums, question_data = admin_views.get_assignment_stats(assignment)
+        self.assertEqual(sums['total_answers'], 14)
+        self.assertEqual(sums['total_students'], 14)
+        self.assertEqual(question_data[1][1]['total_students'], 0)
+
+        # Changing the answer key changes the correct answers in the statistics as well.
+        choice = models.AnswerChoice.objects.filter(question_id=30).first()
+        choice.correct = not choice.correct
+        choice.save()
+        sums, unused_question_data = admin_views.get_assignment_stats(
+            assignment, include_archived=True
+        )
+        self.assertNotEqual(sums['correct_first_answers'], expected_sums['correct_first_answers'])
+        self.assertEqual(sums['total_students'], expected_sums['total_students'])
+
+    def test_transition_matrix(self):
+        question = factories.QuestionFactory(choices=3, choices__correct=[2])
+        matrix = aggregates.TransitionMatrix({(1, 2): 3, (2, 2): 4, (2, 1): 1, (3, None): 2})
+        self.assertDictEqual(dict(matrix.get_sums(question)), {
+            'total_answers': 10,
+            'correct_first_answers': 5,
+            'correct_second_answers': 7,
+            'switches': 6,
+            ('switches', 1): 1,
+            ('switches', 2): 3,
+        })
+        self.assertEqual(matrix.first_choice_count(2), 5)
+        self.assertEqual(matrix.second_choice_count(2), 7)
+        self.assertEqual(matrix[3, 1], 0)
+
+
+@skipUnless(
+    'tenant' in settings.DATABASES,
+    'Needs a second database with the alias "tenant", e.g. another SQLite database.'
+)
+@override_settings(TENANT_DATABASES={'course-v1:Big+B1+now': 'tenant'})
+class TenantReportsTestCase(TestCase):
+    multi_db = True
+
+    def test_reports(self):
+        question = factories.QuestionFactory(choices=2, choices__correct=[1])
+        assignment = factories.AssignmentFactory()
+        assignment.questions.add(question)
+        for database, user_token in [('default', 'a'), ('tenant', 'b')]:
+            with routers.use_database(database):
+                answer = factories.AnswerFactory(
+                    question=question, assignment=assignment, first_answer_choice=1,
+                    second_answer_choice=1, user_token=user_token,
+                )
+                models.AssignmentQuestionStats.objects.record_answer(answer)
+                models.AnswerVote.objects.create(
+                    answer=answer, assignment=assignment, user_token='other',
+                    fake_username='Alice', fake_country='Canada',
+                    vote_type=models.AnswerVote.UPVOTE,
+                )
+
+        sums, unused_question_data = admin_views.get_assignment_stats(assignment)
+        self.assertEqual((sums['total_answers'], sums['total_students']), (2, 2))
+        sums, rationales = admin_views.get_question_rationale_aggregates(
+            assignment, question, None, include_own_rationales=True
+        )
+        self.assertEqual(sums['chosen'], 2)
+        self.assertEqual(
+            sorted(item['rationale'].user_token for item in rationales['chosen']), ['a', 'b']
+        )
+        username_data, unused_country_data = admin_views.AttributionAnalysis().get_aggregates(
+            dict(assignment=assignment, question=question, include_archived=False)
+        )
+        self.assertEqual([row[:3] for row in username_data], [('Alice', 2, 2)])
+
 
 class TopRationalesTestData(object):
 
@@ -92,7 +249,7 @@ class TopRationalesTestData(object):
                     question=question,
                     first_answer_choice=first_answer,
                     second_answer_choice=second_answer,
-                    user_token='etfge',
+                    user_token='etfge{}'.format(idx),
                     upvotes=upvotes,
                     chosen_rationale=chosen_rationale,
                     rationale=rationale,
@@ -129,7 +286,9 @@ class TopRationalesTestCase(TestCase):
 
     @ddt.data(0, 100, 2, 1500)
     def test_large_data(self, perpage):
-        with self.assertNumQueries(6 if perpage else 5):
+        # The upvoted rationales and their count, the three lists of chosen rationales, the chosen
+        # rationales and the rationale texts of all lists
+        with self.assertNumQueries(7 if perpage else 4):
             sums, rationales = admin_views.get_question_rationale_aggregates(self.assignment, self.question, perpage)
         self.assertEquals(sums['upvoted'], 4500)
         self.assertEquals(len(rationales['upvoted']), perpage if perpage < 4500 else 4500)
@@ -188,3 +347,29 @@ class TopRationalesTestCase(TestCase):
 
         self.assertEquals(rationale_data[3]['heading'], 'Top rationales chosen for wrong to right answer switches')
         self.assertEquals(len(rationale_data[3]['rows']), perpage if perpage < 50 else 50)
+
+
+class ResendGradesTestCase(TestCase):
+
+    @mock.patch('peerinst.grade_passback.send_grade')
+    def test_resend_grades(self, send_grade):
+        user = factories.UserFactory()
+        assignment = factories.AssignmentFactory()
+        question = factories.QuestionFactory(choices=2, choices__correct=[1])
+        factories.AnswerFactory(
+            assignment=assignment,
+            question=question,
+            user_token=user.username,
+            first_answer_choice=2,
+            second_answer_choice=1,
+        )
+        custom_key = '{}:{}'.format(assignment.pk, question.pk)
+        lti_parameters = {'lis_outcome_service_url': 'http://lms.example.com/grade_handler'}
+        LtiUserData.objects.create(
+            user=user, custom_key=custom_key, edx_lti_parameters=lti_parameters
+        )
+        models.SentGrade.objects.record(user.pk, custom_key, 1.0)
+
+        admin.resend_grades(mock.Mock(), mock.Mock(), models.SentGrade.objects.all())
+        # The grade is sent again even though it didn't change.
+        send_grade.assert_called_once_with(lti_parameters, 1.0)
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import glob
+import gzip
+import io
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+import mock
+from django.test import SimpleTestCase
+
+from peerinst.log_handlers import BufferedEventLogHandler
+
+
+class BufferedEventLogHandlerTest(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.filename = os.path.join(self.directory, 'student.log')
+
+    def make_handler(self, **kwargs):
+        handler = BufferedEventLogHandler(self.filename, flush_interval=0.01, **kwargs)
+        self.addCleanup(handler.close)
+        return handler
+
+    @staticmethod
+    def make_record(message):
+        return logging.LogRecord('test', logging.INFO, __file__, 1, message, None, None)
+
+    def read_lines(self, filename):
+        opener = gzip.open if filename.endswith('.gz') else io.open
+        with opener(filename, 'rb') as f:
+            return f.read().decode('utf-8').splitlines()
+
+    def test_write(self):
+        handler = self.make_handler()
+        for i in range(100):
+            handler.handle(self.make_record('event {} é'.format(i)))
+        handler.flush()
+        self.assertEqual(
+            self.read_lines(self.filename), ['event {} é'.format(i) for i in range(100)]
+        )
+
+    def test_rotate_by_size(self):
+        handler = self.make_handler(max_bytes=100, backup_count=3, batch_size=1)
+        lines = ['event {:02}'.format(i) + 'x' * 40 for i in range(10)]
+        for line in lines:
+            handler.handle(self.make_record(line))
+        handler.flush()
+        rotated = sorted(glob.glob(self.filename + '.*'))
+        self.assertEqual(len(rotated), 3)
+        self.assertTrue(all(name.endswith('.gz') for name in rotated))
+        self.assertEqual(
+            sum((self.read_lines(name) for name in rotated), []) + self.read_lines(self.filename),
+            lines[2:],
+        )
+
+    def test_compress_in_background(self):
+        handler = self.make_handler(max_bytes=10, batch_size=1)
+        # Block the compression of the first rotated file.
+        compressing = threading.Event()
+        proceed = threading.Event()
+        compress_file = handler.compress_file
+
+        def blocking_compress_file(rotated):
+            compressing.set()
+            proceed.wait()
+            compress_file(rotated)
+
+        handler.compress_file = blocking_compress_file
+        handler.handle(self.make_record('first event'))
+        handler.handle(self.make_record('second event'))
+        compressing.wait()
+        handler.handle(self.make_record('third event'))
+        handler.queue.join()
+        self.assertEqual(self.read_lines(self.filename), ['third event'])
+        proceed.set()
+        handler.flush()
+        rotated = sorted(glob.glob(self.filename + '.*'))
+        self.assertEqual(len(rotated), 2)
+        self.assertTrue(all(name.endswith('.gz') for name in rotated))
+        self.assertEqual(
+            sum((self.read_lines(name) for name in rotated), []),
+            ['first event', 'second event'],
+        )
+        self.assertEqual(len(os.listdir(self.directory)), 3)
+
+    def test_rotate_by_time(self):
+        handler = self.make_handler(rotate_interval=60, compress=False)
+        with mock.patch('time.time', return_value=1000):
+            handler.handle(self.make_record('first'))
+            handler.flush()
+        with mock.patch('time.time', return_value=1060):
+            handler.handle(self.make_record('second'))
+            handler.flush()
+        rotated = glob.glob(self.filename + '.*')
+        self.assertEqual(len(rotated), 1)
+        self.assertEqual(self.read_lines(rotated[0]), ['first'])
+        self.assertEqual(self.read_lines(self.filename), ['second'])
+
+    def check_overflow(self, policy, expected_lines):
+        handler = self.make_handler(queue_size=2, overflow=policy)
+        # Block the writer thread while it writes the first record.
+        writing = threading.Event()
+        proceed = threading.Event()
+        write = handler.write
+
+        def blocking_write(lines):
+            writing.set()
+            proceed.wait()
+            write(lines)
+
+        handler.write = blocking_write
+        handler.handle(self.make_record('0'))
+        writing.wait()
+        for i in range(1, 5):
+            handler.handle(self.make_record(str(i)))
+        self.assertEqual(handler.dropped, 2)
+        proceed.set()
+        handler.flush()
+        self.assertEqual(self.read_lines(self.filename), expected_lines)
+
+    def test_overflow_drop(self):
+        self.check_overflow('drop', ['0', '1', '2'])
+
+    def test_overflow_drop_oldest(self):
+        self.check_overflow('drop_oldest', ['0', '3', '4'])
+
+    def test_fork(self):
+        handler = self.make_handler()
+        handler.handle(self.make_record('parent'))
+        handler.flush()
+        parent_thread, parent_stopping = handler.thread, handler.stopping
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            handler.handle(self.make_record('child'))
+            self.assertIsNot(handler.thread, parent_thread)
+            handler.close()
+        parent_stopping.set()
+        parent_thread.join()
+        self.assertEqual(self.read_lines(self.filename), ['parent', 'child'])
+
+    def test_shard_by_pid(self):
+        handler = self.make_handler(shard_by_pid=True)
+        handler.handle(self.make_record('event'))
+        handler.flush()
+        self.assertFalse(os.path.exists(self.filename))
+        shard = os.path.join(self.directory, 'student-{}.log'.format(os.getpid()))
+        self.assertEqual(self.read_lines(shard), ['event'])
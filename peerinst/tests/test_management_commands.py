@@ -1,10 +1,29 @@
 
+import csv
+import datetime
+import gzip
+import io
+import itertools
+import json
 import os
+import shutil
+import StringIO
+import tempfile
+from unittest import skipUnless
 import mock
 
+from django.conf import settings
 from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
 from django.db.utils import DatabaseError
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from django_lti_tool_provider.models import LtiUserData
+
+from . import factories
+from .fake_outcome_service import FakeOutcomeService
+from .. import admin, backfill, bulk_jobs, models, routers
 
 
 devnull = open(os.devnull, 'w')
@@ -22,3 +41,796 @@ class SanityCheckTest(TestCase):
         with mock.patch("django.db.connection.cursor", side_effect=DatabaseError()):
             with self.assertRaises(Exception):
                 call_command("sanity_check")
+
+
+@mock.patch("sys.stdout", devnull)
+class FlushVotesTest(TestCase):
+
+    def test_flush_votes(self):
+        question = factories.QuestionFactory(choices=2, choices__correct=[1])
+        answer = factories.AnswerFactory(question=question, first_answer_choice=1, upvotes=2)
+        other = factories.AnswerFactory(question=question, first_answer_choice=2)
+        models.BufferedVote.objects.bulk_create([
+            models.BufferedVote(answer_id=answer.id, upvotes=1),
+            models.BufferedVote(answer_id=answer.id, upvotes=1),
+            models.BufferedVote(answer_id=answer.id, downvotes=1),
+            models.BufferedVote(answer_id=other.id, downvotes=1, times_shown=1, times_chosen=1),
+            models.BufferedVote(answer_id=other.id, times_shown=1),
+        ])
+        call_command("flush_votes", batch_size=3)
+        answer.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual((answer.upvotes, answer.downvotes), (4, 1))
+        self.assertEqual((other.upvotes, other.downvotes), (0, 1))
+        self.assertEqual((other.times_shown, other.times_chosen), (2, 1))
+        self.assertFalse(models.BufferedVote.objects.exists())
+
+
+@mock.patch("sys.stdout", devnull)
+class RebuildAssignmentStatsTest(TestCase):
+
+    def test_rebuild_assignment_stats(self):
+        assignment = factories.AssignmentFactory()
+        question = factories.QuestionFactory(choices=2, choices__correct=[1])
+        other_question = factories.QuestionFactory(choices=2, choices__correct=[1])
+        for user_token in ['a', 'b', 'c']:
+            factories.AnswerFactory(
+                assignment=assignment, question=question, user_token=user_token,
+                first_answer_choice=1, second_answer_choice=2,
+            )
+        stale = models.AssignmentQuestionStats.objects.create(
+            assignment=assignment, question=other_question, first_answer_choice=1, count=5
+        )
+        call_command("rebuild_assignment_stats")
+        stats = models.AssignmentQuestionStats.objects.get()
+        self.assertEqual(stats.question, question)
+        self.assertEqual(
+            (stats.first_answer_choice, stats.second_answer_choice, stats.count), (1, 2, 3)
+        )
+        self.assertFalse(models.AssignmentQuestionStats.objects.filter(pk=stale.pk).exists())
+
+        call_command("rebuild_assignment_stats", assignment.pk)
+        self.assertEqual(models.AssignmentQuestionStats.objects.get().count, 3)
+        with self.assertRaises(CommandError):
+            call_command("rebuild_assignment_stats", "unknown")
+
+
+@mock.patch("sys.stdout", devnull)
+@override_settings(LTI_CLIENT_KEY='key', LTI_CLIENT_SECRET='secret')
+class SendGradesTest(TestCase):
+
+    def setUp(self):
+        super(SendGradesTest, self).setUp()
+        self.user = factories.UserFactory()
+        self.custom_key = 'Assignment1:1'
+
+    def start_outcome_service(self, accept=True):
+        service = FakeOutcomeService(accept=accept)
+        service.start()
+        self.addCleanup(service.stop)
+        LtiUserData.objects.create(
+            user=self.user,
+            custom_key=self.custom_key,
+            edx_lti_parameters={
+                'lis_outcome_service_url': service.url,
+                'lis_result_sourcedid': 'sourcedid',
+            },
+        )
+        return service
+
+    def test_send_grades(self):
+        service = self.start_outcome_service()
+        models.GradePassback.objects.enqueue(self.user, self.custom_key, 0.5)
+        # A grade enqueued again before it was sent replaces the previous one.
+        models.GradePassback.objects.enqueue(self.user, self.custom_key, 1.0)
+        call_command("send_grades")
+        self.assertEqual(service.grades, [1.0])
+        self.assertFalse(models.GradePassback.objects.exists())
+
+    def test_send_grades_superseded(self):
+        service = self.start_outcome_service()
+        # A grade that has failed for good is replaced by a new one.
+        models.GradePassback.objects.create(
+            user=self.user, custom_key=self.custom_key, grade=0.0,
+            status=models.GradePassback.FAILED,
+        )
+        models.GradePassback.objects.enqueue(self.user, self.custom_key, 0.5)
+        self.assertEqual(models.GradePassback.objects.get().grade, 0.5)
+
+        # A grade enqueued while the previous one is being sent waits for it.
+        sending = models.GradePassback.objects.get()
+        sending.status = models.GradePassback.SENDING
+        sending.next_attempt = timezone.now() + datetime.timedelta(seconds=60)
+        sending.save()
+        models.GradePassback.objects.enqueue(self.user, self.custom_key, 1.0)
+        self.assertEqual(models.GradePassback.objects.count(), 2)
+        call_command("send_grades")
+        self.assertEqual(service.grades, [])
+        self.assertEqual(
+            models.GradePassback.objects.get(grade=1.0).next_attempt, sending.next_attempt
+        )
+
+        # Once both are due, e.g. because the worker sending the first one died, only the newest
+        # grade is sent.
+        models.GradePassback.objects.update(next_attempt=timezone.now())
+        call_command("send_grades")
+        self.assertEqual(service.grades, [1.0])
+        self.assertFalse(models.GradePassback.objects.exists())
+
+    def test_send_grades_retry(self):
+        service = self.start_outcome_service(accept=False)
+        models.GradePassback.objects.enqueue(self.user, self.custom_key, 0.5)
+        call_command("send_grades", retry_delay=60)
+        grade = models.GradePassback.objects.get()
+        self.assertEqual(grade.status, models.GradePassback.PENDING)
+        self.assertEqual(grade.attempts, 1)
+        self.assertGreater(grade.next_attempt, timezone.now() + datetime.timedelta(seconds=50))
+        self.assertTrue(grade.last_error)
+
+        # The grade is sent on the next attempt once the outcome service is back.
+        service.accept = True
+        models.GradePassback.objects.update(next_attempt=timezone.now())
+        call_command("send_grades")
+        self.assertEqual(service.grades, [0.5])
+        self.assertFalse(models.GradePassback.objects.exists())
+
+    def test_send_grades_dead_letter(self):
+        self.start_outcome_service(accept=False)
+        models.GradePassback.objects.enqueue(self.user, self.custom_key, 0.5)
+        call_command("send_grades", max_attempts=1)
+        grade = models.GradePassback.objects.get()
+        self.assertEqual(grade.status, models.GradePassback.FAILED)
+        # Failed grades are left alone by later runs.
+        call_command("send_grades")
+        self.assertEqual(models.GradePassback.objects.get().attempts, 1)
+
+
+@mock.patch("sys.stdout", devnull)
+@override_settings(LTI_CLIENT_KEY='key', LTI_CLIENT_SECRET='secret')
+class RegradeAnswersTest(TestCase):
+
+    def test_regrade_answers(self):
+        service = FakeOutcomeService()
+        service.start()
+        self.addCleanup(service.stop)
+        assignment = factories.AssignmentFactory()
+        question = factories.QuestionFactory(choices=2, choices__correct=[1])
+        custom_key = '{}:{}'.format(assignment.pk, question.pk)
+        # First choice, second choice and the grade sent with the standard grading scheme.
+        answers = [(1, 1, 1.0), (1, 2, 0.0), (2, 1, 1.0), (2, 2, 0.0)]
+        for first_answer_choice, second_answer_choice, grade in answers:
+            user = factories.UserFactory()
+            factories.AnswerFactory(
+                assignment=assignment,
+                question=question,
+                user_token=user.username,
+                first_answer_choice=first_answer_choice,
+                second_answer_choice=second_answer_choice,
+            )
+            LtiUserData.objects.create(
+                user=user,
+                custom_key=custom_key,
+                edx_lti_parameters={
+                    'lis_outcome_service_url': service.url,
+                    'lis_result_sourcedid': user.username,
+                },
+            )
+            models.SentGrade.objects.record(user.pk, custom_key, grade)
+
+        # Nothing changed, so no grades are sent.
+        call_command("regrade_answers", question=question.pk)
+        self.assertEqual(service.grades, [])
+
+        # With the advanced grading scheme, only the two grades for switched answers change.
+        question.grading_scheme = models.GradingScheme.ADVANCED
+        question.save()
+        call_command("regrade_answers", assignment=assignment.pk, concurrency=2)
+        self.assertItemsEqual(service.grades, [0.5, 0.5])
+        self.assertItemsEqual(
+            models.SentGrade.objects.values_list('grade', flat=True), [1.0, 0.5, 0.5, 0.0]
+        )
+
+        call_command("regrade_answers", question=question.pk, force=True)
+        self.assertItemsEqual(service.grades[2:], [1.0, 0.5, 0.5, 0.0])
+
+        # In asynchronous mode, the grades are only queued.
+        output = StringIO.StringIO()
+        with override_settings(LTI_GRADE_PASSBACK_ASYNC=True):
+            call_command("regrade_answers", question=question.pk, force=True, stdout=output)
+        self.assertIn('0 sent, 4 queued', output.getvalue())
+        self.assertEqual(models.GradePassback.objects.count(), 4)
+        self.assertEqual(len(service.grades), 6)
+
+
+@mock.patch("sys.stdout", devnull)
+class ExportAnswersTest(TestCase):
+
+    def setUp(self):
+        super(ExportAnswersTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'answers.csv')
+
+    def export(self, since=None):
+        output = StringIO.StringIO()
+        call_command("export_answers", self.path, since=since, stdout=output)
+        return output.getvalue().split('Watermark: ')[-1].strip()
+
+    def test_export_answers(self):
+        question = factories.QuestionFactory(choices=2, choices__correct=[1])
+        created = timezone.now() - datetime.timedelta(minutes=10)
+        answers = [
+            factories.AnswerFactory(
+                question=question, first_answer_choice=1, rationale='Rationale {}'.format(i),
+                created=created + datetime.timedelta(seconds=i),
+            )
+            for i in range(2)
+        ]
+        watermark = self.export()
+        self.assertEqual(watermark, '{},{}'.format(answers[1].created.isoformat(), answers[1].pk))
+
+        # Only the new answers are appended on the next run.
+        answers.append(factories.AnswerFactory(
+            question=question, first_answer_choice=1,
+            created=created + datetime.timedelta(days=-1),
+        ))
+        answers.append(factories.AnswerFactory(
+            question=question, first_answer_choice=1,
+            created=created + datetime.timedelta(seconds=5),
+        ))
+        self.export(since=watermark)
+        with open(self.path, 'rb') as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(
+            [int(row['id']) for row in rows], [answers[0].pk, answers[1].pk, answers[3].pk]
+        )
+        self.assertEqual(rows[1]['rationale'], 'Rationale 1')
+
+        with self.assertRaises(CommandError):
+            self.export(since='yesterday')
+
+
+@mock.patch("sys.stdout", devnull)
+class BackfillCreatedTimestampsTest(TestCase):
+
+    def test_backfill_created_timestamps(self):
+        question = factories.QuestionFactory(choices=2, choices__correct=[1])
+        answers = [
+            factories.AnswerFactory(question=question, first_answer_choice=1) for _ in range(5)
+        ]
+        models.Answer.objects.filter(pk__in=[a.pk for a in answers[:3]]).update(created=None)
+
+        call_command("backfill_created_timestamps", batch_size=2)
+        self.assertFalse(models.Answer.objects.filter(created__isnull=True).exists())
+        self.assertEqual(
+            models.Answer.objects.filter(created=backfill.UNKNOWN_CREATED).count(), 3
+        )
+
+        models.Answer.objects.update(created=None)
+        call_command("backfill_created_timestamps", timestamp="2016-01-01 12:00Z")
+        self.assertEqual(
+            set(models.Answer.objects.values_list('created', flat=True)),
+            {datetime.datetime(2016, 1, 1, 12, tzinfo=timezone.utc)},
+        )
+
+
+@mock.patch("sys.stdout", devnull)
+class InternRationalesTest(TestCase):
+
+    def test_intern_rationales(self):
+        question = factories.QuestionFactory(choices=2, choices__correct=[1])
+        answers = [
+            factories.AnswerFactory(question=question, first_answer_choice=1) for _ in range(5)
+        ]
+        for answer, text in zip(answers, ['A', 'B', 'A', 'C', 'A']):
+            models.Answer.objects.filter(pk=answer.pk).update(
+                rationale_text=None, legacy_rationale=text
+            )
+        models.RationaleText.objects.all().delete()
+        models.RationaleText.objects.intern('C')
+
+        call_command("intern_rationales", batch_size=2)
+        self.assertEqual(models.RationaleText.objects.count(), 3)
+        self.assertFalse(models.Answer.objects.filter(rationale_text__isnull=True).exists())
+        self.assertFalse(models.Answer.objects.exclude(legacy_rationale='').exists())
+        self.assertEqual(
+            [models.Answer.objects.get(pk=answer.pk).rationale for answer in answers],
+            ['A', 'B', 'A', 'C', 'A'],
+        )
+
+
+@mock.patch("sys.stdout", devnull)
+class ArchiveAnswersTest(TestCase):
+
+    def test_archive_answers(self):
+        question = factories.QuestionFactory(choices=2, choices__correct=[1])
+        old, current = factories.AssignmentFactory.create_batch(2)
+
+        students = ('student{}'.format(i) for i in itertools.count())
+
+        def answer(assignment, **kwargs):
+            return factories.AnswerFactory(
+                question=question, assignment=assignment, first_answer_choice=1,
+                second_answer_choice=1, user_token=next(students), **kwargs
+            )
+
+        expert = factories.AnswerFactory(question=question, first_answer_choice=1, expert=True)
+        first = answer(old, chosen_rationale=expert)
+        still_chosen = answer(old)
+        chooses_archived = answer(old, chosen_rationale=first)
+        live = answer(current, chosen_rationale=still_chosen)
+        models.AnswerVote.objects.create(
+            answer=first, assignment=current, user_token='student', fake_username='fake',
+            fake_country='fake', vote_type=models.AnswerVote.UPVOTE,
+        )
+
+        call_command("archive_answers", old.pk, chunk_size=1)
+        self.assertItemsEqual(
+            models.Answer.objects.values_list('pk', flat=True), [expert.pk, still_chosen.pk, live.pk]
+        )
+        self.assertItemsEqual(
+            models.ArchivedAnswer.objects.values_list('pk', flat=True),
+            [first.pk, chooses_archived.pk],
+        )
+        self.assertFalse(models.AnswerVote.objects.exists())
+        self.assertEqual(models.ArchivedAnswerVote.objects.get().answer_id, first.pk)
+        archived = models.ArchivedAnswer.objects.get(pk=chooses_archived.pk)
+        self.assertEqual(archived.rationale, chooses_archived.rationale)
+        self.assertEqual(archived.chosen_rationale.pk, first.pk)
+        self.assertEqual(models.ArchivedAnswer.objects.get(pk=first.pk).chosen_rationale, expert)
+
+
+@mock.patch("sys.stdout", devnull)
+@skipUnless(
+    'tenant' in settings.DATABASES,
+    'Needs a second database with the alias "tenant", e.g. another SQLite database.'
+)
+class MoveTenantTest(TestCase):
+    multi_db = True
+
+    def test_move_tenant(self):
+        question = factories.QuestionFactory(choices=2, choices__correct=[1])
+        assignment = factories.AssignmentFactory()
+        assignment.questions.add(question)
+        custom_key = '{}:{}'.format(assignment.pk, question.pk)
+
+        def student(course_id):
+            user = factories.UserFactory()
+            LtiUserData.objects.create(
+                user=user, custom_key=custom_key, edx_lti_parameters={'context_id': course_id}
+            )
+            return user
+
+        def answer(user, **kwargs):
+            return factories.AnswerFactory(
+                question=question, assignment=assignment, first_answer_choice=1,
+                second_answer_choice=1, user_token=user.username, **kwargs
+            )
+
+        expert = factories.AnswerFactory(question=question, first_answer_choice=1, expert=True)
+        small = answer(student('course-v1:Small+S1+now'))
+        moved = answer(student('course-v1:Big+B1+now'), chosen_rationale=small)
+        still_chosen = answer(student('course-v1:Big+B1+now'))
+        other_small = answer(student('course-v1:Small+S1+now'), chosen_rationale=still_chosen)
+        models.AnswerVote.objects.create(
+            answer=moved, assignment=assignment, user_token='student', fake_username='fake',
+            fake_country='fake', vote_type=models.AnswerVote.UPVOTE,
+        )
+        models.BufferedVote.objects.create(answer_id=moved.pk, upvotes=1)
+        models.RationaleExposure.objects.create(answer_id=moved.pk, rationale_id=small.pk)
+
+        for unused_run in range(2):
+            # Moving again doesn't change anything.
+            call_command(
+                "move_tenant", 'tenant', course='course-v1:Big+B1+now', chunk_size=1
+            )
+            self.assertItemsEqual(
+                models.Answer.objects.values_list('pk', flat=True),
+                [expert.pk, small.pk, still_chosen.pk, other_small.pk],
+            )
+            self.assertItemsEqual(
+                models.Answer.objects.using('tenant').values_list('pk', flat=True),
+                [expert.pk, small.pk, moved.pk, still_chosen.pk],
+            )
+            self.assertEqual(LtiUserData.objects.count(), 2)
+            self.assertEqual(LtiUserData.objects.using('tenant').count(), 2)
+            for model in [models.AnswerVote, models.BufferedVote, models.RationaleExposure]:
+                self.assertFalse(model.objects.exists())
+                self.assertEqual(model.objects.using('tenant').get().answer_id, moved.pk)
+        tenant_answer = models.Answer.objects.using('tenant').get(pk=moved.pk)
+        self.assertEqual(tenant_answer.rationale, moved.rationale)
+        self.assertEqual(tenant_answer.chosen_rationale.pk, small.pk)
+
+    def test_move_tenant_conflict(self):
+        question = factories.QuestionFactory(choices=2, choices__correct=[1])
+        assignment = factories.AssignmentFactory()
+        assignment.questions.add(question)
+        user = factories.UserFactory()
+        answer = factories.AnswerFactory(
+            question=question, assignment=assignment, first_answer_choice=1,
+            user_token=user.username,
+        )
+        LtiUserData.objects.create(
+            user=user, custom_key='{}:{}'.format(assignment.pk, question.pk),
+            edx_lti_parameters={'context_id': 'course-v1:Big+B1+now'},
+        )
+        # Another answer already uses the id in the target database.
+        models.Answer.objects.using('tenant').create(
+            pk=answer.pk, question=question, first_answer_choice=2, rationale='Other'
+        )
+        with self.assertRaises(CommandError):
+            call_command("move_tenant", 'tenant', course='course-v1:Big+B1+now')
+        self.assertTrue(models.Answer.objects.filter(pk=answer.pk).exists())
+        self.assertEqual(LtiUserData.objects.count(), 1)
+
+
+@mock.patch("sys.stdout", devnull)
+@skipUnless(
+    'tenant' in settings.DATABASES,
+    'Needs a second database with the alias "tenant", e.g. another SQLite database.'
+)
+@override_settings(TENANT_DATABASES={'course-v1:Big+B1+now': 'tenant'})
+class TenantDatabasesTest(TestCase):
+    multi_db = True
+
+    def test_delete_question(self):
+        question = factories.QuestionFactory(choices=2, choices__correct=[1])
+        assignment = factories.AssignmentFactory()
+        factories.AnswerFactory(
+            question=question, assignment=assignment, first_answer_choice=1, user_token='default'
+        )
+        with routers.use_database('tenant'):
+            answer = factories.AnswerFactory(
+                question=question, assignment=assignment, first_answer_choice=1,
+                user_token='tenant',
+            )
+            models.AssignmentQuestionStats.objects.record_answer(answer)
+            models.AnswerVote.objects.create(
+                answer=answer, assignment=assignment, user_token='other', fake_username='fake',
+                fake_country='fake', vote_type=models.AnswerVote.UPVOTE,
+            )
+        job = bulk_jobs.enqueue_delete(question)
+        call_command("run_bulk_jobs")
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.processed, job.total), (models.BulkJob.DONE, 3, 3))
+        self.assertFalse(models.Question.objects.filter(pk=question.pk).exists())
+        for database in ['default', 'tenant']:
+            self.assertFalse(models.Answer.objects.using(database).exists())
+            self.assertFalse(models.AnswerVote.objects.using(database).exists())
+            self.assertFalse(models.AssignmentQuestionStats.objects.using(database).exists())
+
+    def test_run_backfill(self):
+        question = factories.QuestionFactory(choices=2, choices__correct=[1])
+        with routers.use_database('tenant'):
+            factories.AnswerFactory(question=question, first_answer_choice=1)
+        models.Answer.objects.using('tenant').update(created=None)
+        models.BackfillCheckpoint.objects.update(done=False)
+        self.assertIn('answer_created', backfill.get_pending('tenant'))
+
+        call_command("run_backfill")
+        self.assertFalse(models.Answer.objects.using('tenant').filter(created=None).exists())
+        self.assertTrue(models.BackfillCheckpoint.objects.get(name='answer_created@tenant').done)
+        self.assertEqual(backfill.get_pending('tenant'), [])
+
+    def test_intern_rationales(self):
+        question = factories.QuestionFactory(choices=2, choices__correct=[1])
+        with routers.use_database('tenant'):
+            answer = factories.AnswerFactory(question=question, first_answer_choice=1)
+        models.Answer.objects.using('tenant').update(rationale_text=None, legacy_rationale='T')
+        call_command("intern_rationales")
+        self.assertEqual(models.Answer.objects.using('tenant').get(pk=answer.pk).rationale, 'T')
+        self.assertFalse(models.Answer.objects.using('tenant').exclude(legacy_rationale='').exists())
+
+    @override_settings(LTI_CLIENT_KEY='key', LTI_CLIENT_SECRET='secret')
+    def test_send_grades(self):
+        service = FakeOutcomeService()
+        service.start()
+        self.addCleanup(service.stop)
+        user = factories.UserFactory()
+        LtiUserData.objects.using('tenant').create(
+            user=user,
+            custom_key='Assignment1:1',
+            edx_lti_parameters={
+                'lis_outcome_service_url': service.url,
+                'lis_result_sourcedid': 'sourcedid',
+            },
+        )
+        models.GradePassback.objects.enqueue(user, 'Assignment1:1', 1.0)
+        call_command("send_grades")
+        self.assertEqual(service.grades, [1.0])
+        self.assertFalse(models.GradePassback.objects.exists())
+
+
+@mock.patch("sys.stdout", devnull)
+class RunBulkJobsTest(TestCase):
+
+    def setUp(self):
+        super(RunBulkJobsTest, self).setUp()
+        self.question = factories.QuestionFactory(choices=2, choices__correct=[1])
+        self.assignment = factories.AssignmentFactory()
+        self.other_assignment = factories.AssignmentFactory()
+        self.expert = factories.AnswerFactory(question=self.question, first_answer_choice=1)
+        previous = self.expert
+        self.answers = []
+        for i in range(5):
+            previous = factories.AnswerFactory(
+                question=self.question, assignment=self.assignment, first_answer_choice=1,
+                chosen_rationale=previous, user_token='student{}'.format(i),
+            )
+            self.answers.append(previous)
+            models.AnswerVote.objects.create(
+                answer=self.expert, assignment=self.assignment, user_token=previous.user_token,
+                fake_username='fake', fake_country='fake', vote_type=models.AnswerVote.UPVOTE,
+            )
+        self.other = factories.AnswerFactory(
+            question=self.question, assignment=self.other_assignment, first_answer_choice=1,
+            chosen_rationale=self.answers[0],
+        )
+
+    def test_delete_assignment(self):
+        job = bulk_jobs.enqueue_delete(self.assignment)
+        call_command("run_bulk_jobs", chunk_size=2)
+        job.refresh_from_db()
+        self.assertEqual(job.status, models.BulkJob.DONE)
+        self.assertEqual((job.processed, job.total), (10, 10))
+        self.assertFalse(models.Assignment.objects.filter(pk=self.assignment.pk).exists())
+        self.assertItemsEqual(
+            models.Answer.objects.values_list('pk', flat=True), [self.expert.pk, self.other.pk]
+        )
+        self.assertFalse(models.AnswerVote.objects.exists())
+        self.assertIsNone(models.Answer.objects.get(pk=self.other.pk).chosen_rationale)
+
+    def test_delete_answers_queries(self):
+        # The answers aren't loaded to send the post_delete signal.
+        for answers in [self.answers[:1], self.answers[1:]]:
+            with self.assertNumQueries(7):
+                bulk_jobs.delete_answers([answer.pk for answer in answers])
+        self.assertItemsEqual(
+            models.Answer.objects.values_list('pk', flat=True), [self.expert.pk, self.other.pk]
+        )
+
+    def test_delete_assignment_stats(self):
+        models.AssignmentQuestionStats.objects.rebuild(self.assignment.pk)
+        self.assertTrue(models.AssignmentQuestionStats.objects.exists())
+        bulk_jobs.enqueue_delete(self.assignment)
+        call_command("run_bulk_jobs", chunk_size=2)
+        self.assertFalse(models.AssignmentQuestionStats.objects.exists())
+
+    def test_retry_failed_job(self):
+        job = bulk_jobs.enqueue_delete(self.assignment)
+        delete_answers = bulk_jobs.delete_answers
+        calls = []
+
+        def failing_delete_answers(ids):
+            calls.append(ids)
+            if len(calls) == 2:
+                raise DatabaseError('Lock wait timeout exceeded')
+            delete_answers(ids)
+
+        with mock.patch('peerinst.bulk_jobs.delete_answers', failing_delete_answers), \
+                mock.patch('peerinst.bulk_jobs.LOGGER'):
+            call_command("run_bulk_jobs", chunk_size=2)
+        job.refresh_from_db()
+        self.assertEqual(job.status, models.BulkJob.FAILED)
+        processed = job.processed
+
+        admin.retry_bulk_jobs(mock.Mock(), mock.Mock(), models.BulkJob.objects.all())
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.processed), (models.BulkJob.PENDING, processed))
+        call_command("run_bulk_jobs", chunk_size=2)
+        job.refresh_from_db()
+        self.assertEqual(job.status, models.BulkJob.DONE)
+        self.assertEqual((job.processed, job.total), (10, 10))
+        self.assertFalse(models.Assignment.objects.filter(pk=self.assignment.pk).exists())
+
+    def test_delete_question(self):
+        bulk_jobs.enqueue_delete(self.question)
+        call_command("run_bulk_jobs", chunk_size=2)
+        self.assertFalse(models.Question.objects.exists())
+        self.assertFalse(models.Answer.objects.exists())
+        self.assertEqual(models.BulkJob.objects.get().status, models.BulkJob.DONE)
+
+    def test_publish_answers_resume(self):
+        models.Answer.objects.update(show_to_others=False)
+        answer_ids = [answer.pk for answer in self.answers]
+        job = bulk_jobs.enqueue_publish_answers(answer_ids)
+        # Simulate an interrupted run that already processed the first two answers.
+        models.BulkJob.objects.filter(pk=job.pk).update(status=models.BulkJob.RUNNING, processed=2)
+        call_command("run_bulk_jobs", chunk_size=2)
+        self.assertItemsEqual(
+            models.Answer.objects.filter(show_to_others=True).values_list('pk', flat=True),
+            answer_ids[2:],
+        )
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.processed, job.total), (models.BulkJob.DONE, 5, 5))
+
+
+@mock.patch("sys.stdout", devnull)
+class DedupeAnswersTest(TransactionTestCase):
+    # Not a TestCase, since MySQL commits the transaction when altering tables.
+
+    def test_dedupe_answers(self):
+        question = factories.QuestionFactory(choices=2, choices__correct=[1])
+        assignment = factories.AssignmentFactory()
+        # Duplicates can only exist in databases that don't have the uniqueness constraint yet.
+        unique_together = models.Answer._meta.unique_together
+        with connection.schema_editor() as schema_editor:
+            schema_editor.alter_unique_together(models.Answer, unique_together, [])
+        answers = [
+            factories.AnswerFactory(
+                question=question, assignment=assignment, first_answer_choice=1,
+                second_answer_choice=second_answer_choice, user_token='student', upvotes=1,
+            )
+            for second_answer_choice in [1, 2, None]
+        ]
+        other = factories.AnswerFactory(
+            question=question, assignment=assignment, first_answer_choice=1,
+            chosen_rationale=answers[0], user_token='other',
+        )
+        models.AnswerVote.objects.create(
+            answer=answers[0], assignment=assignment, user_token='other', fake_username='fake',
+            fake_country='fake', vote_type=models.AnswerVote.UPVOTE,
+        )
+
+        call_command("dedupe_answers")
+        with connection.schema_editor() as schema_editor:
+            schema_editor.alter_unique_together(models.Answer, [], unique_together)
+        keeper = models.Answer.objects.get(
+            assignment=assignment, question=question, user_token='student'
+        )
+        self.assertEqual(keeper.pk, answers[1].pk)
+        self.assertEqual(keeper.upvotes, 3)
+        self.assertEqual(models.Answer.objects.get(pk=other.pk).chosen_rationale, keeper)
+        self.assertEqual(models.AnswerVote.objects.get().answer, keeper)
+
+
+@override_settings(LTI_CLIENT_KEY='key', LTI_CLIENT_SECRET='secret')
+class LtiLoadTestTest(TestCase):
+
+    def test_lti_load_test(self):
+        assignment = factories.AssignmentFactory()
+        assignment.questions.add(factories.QuestionFactory(), factories.QuestionFactory())
+        output = StringIO.StringIO()
+        call_command("lti_load_test", users=3, repeat=2, concurrency=1, stdout=output)
+        report = output.getvalue()
+        self.assertIn('6 launches (0 failed)', report)
+        self.assertIn('New users: 3 launches', report)
+        self.assertIn('Existing users: 3 launches', report)
+        self.assertIn('3 users created.', report)
+
+        # Users that already exist are not counted as new, and can be cleaned up.
+        output = StringIO.StringIO()
+        call_command("lti_load_test", users=4, repeat=1, concurrency=1, cleanup=True, stdout=output)
+        report = output.getvalue()
+        self.assertIn('New users: 1 launches', report)
+        self.assertIn('Deleted the 1 users created by the load test.', report)
+
+
+@mock.patch("sys.stdout", devnull)
+class RunBackfillTest(TestCase):
+
+    def test_run_backfill_resume(self):
+        question = factories.QuestionFactory(choices=2, choices__correct=[1])
+        answers = [
+            factories.AnswerFactory(question=question, first_answer_choice=1) for _ in range(5)
+        ]
+        models.Answer.objects.update(created=None)
+        # The backfills scheduled by the migrations have nothing to do in the test database.
+        models.BackfillCheckpoint.objects.update(done=False)
+
+        call_command("run_backfill", "answer_created", chunk_size=2, max_chunks=1)
+        checkpoint = models.BackfillCheckpoint.objects.get(name='answer_created')
+        self.assertEqual((checkpoint.done, checkpoint.processed), (False, 2))
+        self.assertEqual(checkpoint.last_pk, answers[1].pk)
+        self.assertEqual(models.Answer.objects.filter(created__isnull=True).count(), 3)
+
+        call_command("run_backfill", chunk_size=2)
+        self.assertFalse(models.Answer.objects.filter(created__isnull=True).exists())
+        self.assertFalse(models.BackfillCheckpoint.objects.filter(done=False).exists())
+        checkpoint.refresh_from_db()
+        self.assertEqual(checkpoint.processed, 5)
+        self.assertEqual(
+            set(models.Answer.objects.values_list('created', flat=True)),
+            {backfill.UNKNOWN_CREATED},
+        )
+
+    def test_run_backfill_exposure_counters(self):
+        question = factories.QuestionFactory(choices=2, choices__correct=[1])
+        answers = [
+            factories.AnswerFactory(question=question, first_answer_choice=1) for _ in range(3)
+        ]
+        models.Answer.objects.filter(pk=answers[0].pk).update(times_shown=4, times_chosen=None)
+        models.Answer.objects.filter(pk__gt=answers[0].pk).update(
+            times_shown=None, times_chosen=None
+        )
+
+        call_command("run_backfill", "answer_exposure_counters", chunk_size=2)
+        self.assertEqual(
+            list(models.Answer.objects.order_by('pk').values_list('times_shown', 'times_chosen')),
+            [(4, 0), (0, 0), (0, 0)],
+        )
+
+
+class MergeEventLogsTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.filename = os.path.join(self.directory, 'student.log')
+
+    def write_log(self, path, times):
+        opener = gzip.open if path.endswith('.gz') else io.open
+        with opener(os.path.join(self.directory, path), 'wb') as f:
+            for time in times:
+                f.write(json.dumps(dict(time=time, event_type='problem_check')) + '\n')
+
+    def test_merge_event_logs(self):
+        self.write_log('student-100.log.20160101-000000-000000.gz', [
+            '2016-01-01T10:00:00', '2016-01-01T10:00:02.500000',
+        ])
+        self.write_log('student-100.log', ['2016-01-01T10:00:03', '2016-01-01T10:00:06'])
+        self.write_log('student-200.log', [
+            '2016-01-01T10:00:01', '2016-01-01T10:00:02.250000', '2016-01-01T10:00:05',
+        ])
+        self.write_log('student.log', ['2016-01-01T10:00:04'])
+        self.write_log('other.log', ['2016-01-01T09:00:00'])
+        output = os.path.join(self.directory, 'merged.log')
+        with mock.patch('peerinst.event_log.get_default_filename', return_value=self.filename):
+            call_command("merge_event_logs", output=output)
+        with io.open(output, 'rb') as f:
+            times = [json.loads(line)['time'] for line in f]
+        self.assertEqual(times, [
+            '2016-01-01T10:00:00', '2016-01-01T10:00:01', '2016-01-01T10:00:02.250000',
+            '2016-01-01T10:00:02.500000', '2016-01-01T10:00:03', '2016-01-01T10:00:04',
+            '2016-01-01T10:00:05', '2016-01-01T10:00:06',
+        ])
+
+
+@mock.patch("sys.stdout", devnull)
+class EventLogStatsTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def make_event(self, question_id, first, second, shown, chosen,
+                   event_type='save_problem_success'):
+        return dict(
+            course_id='course-v1:org+course+run',
+            event_type=event_type,
+            event=dict(
+                assignment_id='assignment',
+                question_id=question_id,
+                first_answer_choice=first,
+                second_answer_choice=second,
+                rationales=[{'id': rationale_id, 'text': ''} for rationale_id in shown],
+                chosen_rationale_id=chosen,
+            ),
+        )
+
+    def read_csv(self, name):
+        with io.open(os.path.join(self.directory, name), 'rb') as f:
+            return [line.strip() for line in f][1:]
+
+    def test_event_log_stats(self):
+        events = [
+            self.make_event(1, 1, 2, [10, 11], 11),
+            self.make_event(1, 1, 2, [10, 11], 11, event_type='problem_check'),
+            self.make_event(1, 1, 1, [10, 12], None),
+            self.make_event(2, 2, 1, [20], 20),
+        ]
+        log_file = os.path.join(self.directory, 'student.log.20160101-000000-000000.gz')
+        with gzip.open(log_file, 'wb') as f:
+            f.write('not json\n')
+            for event in events:
+                f.write(json.dumps(event) + '\n')
+
+        call_command("event_log_stats", log_file, output_dir=self.directory)
+        self.assertEqual(self.read_csv('rationale_counts.csv'), [
+            '1,10,2,0', '1,11,1,1', '1,12,1,0', '2,20,1,1',
+        ])
+        self.assertEqual(self.read_csv('switch_matrices.csv'), ['1,1,1,1', '1,1,2,1', '2,2,1,1'])
+
+        call_command("event_log_stats", log_file, output_dir=self.directory, questions=[2])
+        self.assertEqual(self.read_csv('rationale_counts.csv'), ['2,20,1,1'])
+        self.assertEqual(self.read_csv('switch_matrices.csv'), ['2,2,1,1'])
@@ -1,9 +1,16 @@
 # -*- coding: utf-8 -*-
 
+import datetime
+
 from django.test import TestCase
+from django.utils import timezone
 
 from . import factories
-from ..models import GradingScheme
+from ..models import (
+    Answer, AnswerChoice, ArchivedAnswer, AssignmentQuestionStats, GradingScheme, Question,
+    RationaleText
+)
+from ..util import HyperLogLog, iterate_since
 
 
 class SelectedChoice(object):
@@ -65,3 +72,214 @@ class AnswerModelTestCase(TestCase):
         """
         self.question.grading_scheme = GradingScheme.ADVANCED
         self._assert_grades(expected_grades=[1.0, 0.5, 0.5, 0.0])
+
+
+class QuestionAnswerChoiceSummaryTestCase(TestCase):
+
+    def assert_summary(self, question, correct_choices, choice_count):
+        for question in [question, Question.objects.get(pk=question.pk)]:
+            self.assertEqual(question.get_correct_choices(), correct_choices)
+            self.assertEqual(question.choice_count, choice_count)
+
+    def test_summary_follows_answer_choices(self):
+        question = factories.QuestionFactory(choices=4, choices__correct=[2, 4])
+        self.assert_summary(question, [2, 4], 4)
+        self.assertFalse(question.is_correct(1))
+        self.assertTrue(question.is_correct(2))
+        self.assertFalse(question.is_correct(5))
+        self.assertFalse(question.is_correct(None))
+
+        choice = question.answerchoice_set.all()[0]
+        choice.correct = True
+        choice.save()
+        self.assert_summary(question, [1, 2, 4], 4)
+
+        question.answerchoice_set.all()[3].delete()
+        self.assert_summary(Question.objects.get(pk=question.pk), [1, 2], 3)
+
+        AnswerChoice.objects.create(question=question, text='New', correct=True)
+        self.assert_summary(question, [1, 2, 4], 4)
+
+
+class AnswerManagerTestCase(TestCase):
+
+    def test_add_to_counters(self):
+        question = factories.QuestionFactory(choices=2, choices__correct=[1])
+        answers = [
+            factories.AnswerFactory(question=question, first_answer_choice=1, upvotes=3)
+            for unused in range(3)
+        ]
+        with self.assertNumQueries(1):
+            updated = Answer.objects.add_to_counters({
+                'upvotes': {answers[0].id: 1, answers[1].id: 2},
+                'downvotes': {answers[1].id: 1},
+            })
+        self.assertEqual(updated, 2)
+        counters = dict(
+            (a.id, (a.upvotes, a.downvotes)) for a in Answer.objects.filter(question=question)
+        )
+        self.assertEqual(counters, {
+            answers[0].id: (4, 0),
+            answers[1].id: (5, 1),
+            answers[2].id: (3, 0),
+        })
+
+    def test_add_to_counters_not_backfilled(self):
+        question = factories.QuestionFactory(choices=2, choices__correct=[1])
+        answer = factories.AnswerFactory(question=question, first_answer_choice=1)
+        Answer.objects.filter(pk=answer.pk).update(times_shown=None, times_chosen=None)
+        Answer.objects.add_to_counters({'times_shown': {answer.id: 2}})
+        self.assertEqual(Answer.objects.get_conversion_rates(question.id), [(answer.id, 2, 0)])
+
+    def test_add_to_counters_nothing_to_do(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(Answer.objects.add_to_counters({'upvotes': {}}), 0)
+
+
+class IterateSinceTestCase(TestCase):
+
+    def test_iterate_since(self):
+        question = factories.QuestionFactory(choices=2, choices__correct=[1])
+        start = timezone.now() - datetime.timedelta(minutes=10)
+        created = [start, start, start + datetime.timedelta(seconds=1), None]
+        answers = [
+            factories.AnswerFactory(question=question, first_answer_choice=1, created=timestamp)
+            for timestamp in created
+        ]
+        # An answer created after the first one, but with an older timestamp.
+        answers.insert(0, factories.AnswerFactory(
+            question=question, first_answer_choice=1, created=start - datetime.timedelta(days=1)
+        ))
+        # Answers of the last minute are left for the next run.
+        factories.AnswerFactory(question=question, first_answer_choice=1, created=timezone.now())
+
+        result = list(iterate_since(Answer.objects.all(), batch_size=2))
+        self.assertEqual([obj for obj, unused_watermark in result], answers[:4])
+        watermark = result[1][1]
+        self.assertEqual(watermark, (start, answers[1].pk))
+
+        result = list(iterate_since(Answer.objects.all(), watermark))
+        self.assertEqual([obj for obj, unused_watermark in result], answers[2:4])
+        self.assertEqual(list(iterate_since(Answer.objects.all(), result[-1][1])), [])
+        result = list(iterate_since(Answer.objects.all(), until=start))
+        self.assertEqual([obj for obj, unused_watermark in result], answers[:3])
+
+
+class HyperLogLogTestCase(TestCase):
+
+    def test_count(self):
+        sketch = HyperLogLog()
+        self.assertEqual(len(sketch), 0)
+        for i in range(20):
+            sketch.add('student{}'.format(i))
+            sketch.add('student{}'.format(i))
+        self.assertEqual(len(sketch), 20)
+        for i in range(100000):
+            sketch.add('student{}'.format(i))
+        self.assertAlmostEqual(len(sketch), 100000, delta=5000)
+
+    def test_update(self):
+        first, second = HyperLogLog(), HyperLogLog()
+        for i in range(30000):
+            first.add('student{}'.format(i))
+            second.add('student{}'.format(i + 20000))
+        first.update(second)
+        self.assertAlmostEqual(len(first), 50000, delta=2500)
+        with self.assertRaises(ValueError):
+            first.update(HyperLogLog(precision=10))
+
+
+class AssignmentQuestionStatsTestCase(TestCase):
+
+    def test_record_answer(self):
+        assignment = factories.AssignmentFactory()
+        question = factories.QuestionFactory(choices=3, choices__correct=[2])
+        choices = [(1, 2), (2, 2), (1, 3), (3, 1), (2, 1), (2, 2)]
+        answers = []
+        for i, (first, second) in enumerate(choices):
+            answer = factories.AnswerFactory(
+                assignment=assignment, question=question, user_token='student{}'.format(i),
+                first_answer_choice=first, second_answer_choice=second,
+            )
+            AssignmentQuestionStats.objects.record_answer(answer)
+            answers.append(answer)
+        # Example answers aren't counted.
+        AssignmentQuestionStats.objects.record_answer(factories.AnswerFactory(
+            assignment=assignment, question=question, user_token='',
+            first_answer_choice=1, second_answer_choice=1,
+        ))
+        expected = {(1, 2): 1, (2, 2): 2, (1, 3): 1, (3, 1): 1, (2, 1): 1}
+        matrices, students = AssignmentQuestionStats.objects.get_stats(assignment.pk)
+        self.assertDictEqual(dict(matrices[question.pk]), expected)
+        self.assertEqual(len(students[question.pk]), 6)
+        self.assertEqual(AssignmentQuestionStats.objects.count(), 5)
+
+        AssignmentQuestionStats.objects.all().delete()
+        self.assertEqual(AssignmentQuestionStats.objects.rebuild(assignment.pk), 5)
+        matrices, students = AssignmentQuestionStats.objects.get_stats(assignment.pk)
+        self.assertDictEqual(dict(matrices[question.pk]), expected)
+        self.assertEqual(len(students[question.pk]), 6)
+
+        # Deleted answers are removed, and archived answers are moved to the archived cells.
+        answers[0].delete()
+        ArchivedAnswer.objects.archive([answers[1].pk])
+        del expected[1, 2]
+        expected[2, 2] = 1
+        matrices = AssignmentQuestionStats.objects.get_transition_matrices(assignment.pk)
+        self.assertDictEqual(dict(matrices[question.pk]), expected)
+        expected[2, 2] = 2
+        matrices = AssignmentQuestionStats.objects.get_transition_matrices(
+            assignment.pk, include_archived=True
+        )
+        self.assertDictEqual(dict(matrices[question.pk]), expected)
+        AssignmentQuestionStats.objects.rebuild(assignment.pk)
+        matrices, students = AssignmentQuestionStats.objects.get_stats(assignment.pk, True)
+        self.assertEqual(len(students[question.pk]), 5)
+        ArchivedAnswer.objects.get().delete()
+        matrices = AssignmentQuestionStats.objects.get_transition_matrices(
+            assignment.pk, include_archived=True
+        )
+        self.assertEqual(matrices[question.pk][2, 2], 1)
+
+
+class RationaleTextTestCase(TestCase):
+
+    def setUp(self):
+        super(RationaleTextTestCase, self).setUp()
+        self.question = factories.QuestionFactory(choices=2, choices__correct=[1])
+
+    def test_rationale_texts_are_shared(self):
+        answers = [
+            factories.AnswerFactory(question=self.question, first_answer_choice=1, rationale=text)
+            for text in ['I agree', 'Same as before', 'I agree']
+        ]
+        self.assertEqual(RationaleText.objects.count(), 2)
+        self.assertEqual(answers[0].rationale_text_id, answers[2].rationale_text_id)
+        answer = Answer.objects.get(pk=answers[1].pk)
+        self.assertEqual(answer.rationale, 'Same as before')
+        answer.rationale = 'Changed my mind'
+        self.assertEqual(answer.rationale, 'Changed my mind')
+        answer.save()
+        self.assertEqual(Answer.objects.get(pk=answer.pk).rationale, 'Changed my mind')
+        self.assertEqual(
+            RationaleText.objects.intern_many(['I agree', 'New text']),
+            {
+                'I agree': answers[0].rationale_text_id,
+                'New text': RationaleText.objects.get(text='New text').pk,
+            }
+        )
+
+    def test_legacy_rationale(self):
+        answer = factories.AnswerFactory(question=self.question, first_answer_choice=1)
+        Answer.objects.filter(pk=answer.pk).update(rationale_text=None, legacy_rationale='Old')
+        self.assertEqual(Answer.objects.get(pk=answer.pk).rationale, 'Old')
+
+    def test_resolve_rationales(self):
+        for i in range(3):
+            factories.AnswerFactory(question=self.question, first_answer_choice=1)
+        answers = list(Answer.objects.all())
+        texts = RationaleText.objects.values_list('text', flat=True)
+        with self.assertNumQueries(1):
+            Answer.objects.resolve_rationales(answers)
+            rationales = [answer.rationale for answer in answers]
+        self.assertItemsEqual(rationales, texts)
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+from unittest import skipUnless
+
+import mock
+from django.conf import settings
+from django.db import DatabaseError
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django_lti_tool_provider.models import LtiUserData
+
+from . import factories
+from .. import models, routers
+from ..middleware import TenantMiddleware
+
+
+@override_settings(TENANT_DATABASES={'course-v1:Big+B1+now': 'big', 'consumer': 'medium'})
+class TenantRouterTest(SimpleTestCase):
+    def setUp(self):
+        self.router = routers.TenantRouter()
+        self.addCleanup(routers.deactivate)
+
+    def test_get_tenant_database(self):
+        self.assertEqual(routers.get_tenant_database('consumer', 'course-v1:Big+B1+now'), 'big')
+        self.assertEqual(routers.get_tenant_database('consumer', 'course-v1:S+S1+now'), 'medium')
+        self.assertEqual(routers.get_tenant_database('other', 'course-v1:S+S1+now'), 'default')
+        self.assertEqual(routers.get_tenant_database(), 'default')
+        self.assertEqual(routers.get_tenant_databases(), ['default', 'big', 'medium'])
+
+    def test_db_for_read_and_write(self):
+        for method in [self.router.db_for_read, self.router.db_for_write]:
+            self.assertEqual(method(models.Answer), 'default')
+            with routers.use_database('big'):
+                self.assertEqual(method(models.Answer), 'big')
+                self.assertEqual(method(models.AnswerVote), 'big')
+                self.assertEqual(method(LtiUserData), 'big')
+                self.assertEqual(method(models.Question), 'default')
+                self.assertEqual(method(models.RationaleText), 'default')
+            self.assertEqual(method(models.Answer), 'default')
+
+    def test_related_objects(self):
+        answer = models.Answer()
+        answer._state.db = 'medium'
+        question = models.Question()
+        question._state.db = 'default'
+        with routers.use_database('big'):
+            # Lookups from a tenant object stay in its database, lookups of shared objects go to
+            # the default database.
+            self.assertEqual(self.router.db_for_read(models.Answer, instance=answer), 'medium')
+            self.assertEqual(self.router.db_for_read(models.Question, instance=answer), 'default')
+            self.assertEqual(self.router.db_for_read(models.Answer, instance=question), 'big')
+        self.assertTrue(self.router.allow_relation(answer, question))
+        other_answer = models.Answer()
+        other_answer._state.db = 'big'
+        self.assertFalse(self.router.allow_relation(answer, other_answer))
+
+    def test_allow_migrate(self):
+        self.assertIsNone(self.router.allow_migrate('default', 'peerinst', 'question'))
+        self.assertIsNone(self.router.allow_migrate('default', 'peerinst', 'answer'))
+        self.assertTrue(self.router.allow_migrate('big', 'peerinst', 'answer'))
+        self.assertTrue(self.router.allow_migrate('big', 'django_lti_tool_provider', 'ltiuserdata'))
+        self.assertFalse(self.router.allow_migrate('big', 'peerinst', 'question'))
+        self.assertFalse(self.router.allow_migrate('big', 'auth', 'user'))
+        self.assertFalse(self.router.allow_migrate('big', 'peerinst'))
+
+    def test_session_tenant(self):
+        request = mock.Mock(session={})
+        routers.set_session_tenant(request, 'a:1', 'consumer', 'course-v1:Big+B1+now')
+        self.assertEqual(routers.get_active_database(), 'big')
+        routers.set_session_tenant(request, 'a:2', 'other', 'course-v1:Small+S1+now')
+        self.assertEqual(routers.get_active_database(), 'default')
+        self.assertEqual(routers.get_session_database(request.session, 'a:1'), 'big')
+        self.assertEqual(routers.get_session_database(request.session, 'a:2'), 'default')
+        self.assertEqual(routers.get_session_database(request.session, 'a:3'), 'default')
+        self.assertEqual(routers.get_session_database({}, 'a:1'), 'default')
+
+    def test_middleware(self):
+        middleware = TenantMiddleware()
+        request = mock.Mock(session={})
+        routers.set_session_tenant(request, 'a:1', 'consumer', 'course-v1:Big+B1+now')
+        self.assertEqual(routers.get_active_database(), 'big')
+        middleware.process_response(request, HttpResponse())
+        self.assertEqual(routers.get_active_database(), 'default')
+
+        routers.activate('big')
+        middleware.process_request(request)
+        self.assertEqual(routers.get_active_database(), 'default')
+
+
+@override_settings(
+    TENANT_DATABASES={'course-v1:Big+B1+now': 'big'},
+    DATABASE_REPLICAS={'default': 'default_replica', 'big': 'big_replica'},
+    DATABASE_REPLICA_MAX_LAG=60,
+)
+class ReplicaRouterTest(SimpleTestCase):
+    def setUp(self):
+        self.router = routers.ReplicaRouter()
+        self.addCleanup(routers._replica_checks.clear)
+        lag_patcher = mock.patch('peerinst.routers.get_replica_lag', return_value=0)
+        self.get_replica_lag = lag_patcher.start()
+        self.addCleanup(lag_patcher.stop)
+
+    def test_replica_reads(self):
+        self.assertEqual(self.router.db_for_read(models.Answer), 'default')
+        with routers.replica_reads():
+            self.assertEqual(self.router.db_for_read(models.Answer), 'default_replica')
+            self.assertEqual(self.router.db_for_read(models.Question), 'default_replica')
+            self.assertEqual(self.router.db_for_write(models.Answer), 'default')
+            with routers.use_database('big'):
+                self.assertEqual(self.router.db_for_read(models.Answer), 'big_replica')
+                self.assertEqual(self.router.db_for_read(models.Question), 'default_replica')
+        self.assertEqual(self.router.db_for_read(models.Question), 'default')
+        # The lag is only checked once per replica.
+        self.assertEqual(self.get_replica_lag.call_count, 2)
+
+    def test_objects_read_from_replica(self):
+        answer = models.Answer()
+        answer._state.db = 'default_replica'
+        self.assertEqual(self.router.db_for_write(models.Answer, instance=answer), 'default')
+        other_answer = models.Answer()
+        other_answer._state.db = 'default'
+        self.assertTrue(self.router.allow_relation(answer, other_answer))
+        self.assertFalse(self.router.allow_migrate('default_replica', 'peerinst', 'answer'))
+
+    def test_fallback_to_primary(self):
+        self.get_replica_lag.return_value = 61
+        with routers.replica_reads():
+            self.assertEqual(self.router.db_for_read(models.Answer), 'default')
+        routers._replica_checks.clear()
+        self.get_replica_lag.side_effect = DatabaseError()
+        with routers.replica_reads():
+            self.assertEqual(self.router.db_for_read(models.Answer), 'default')
+
+    def test_use_replica(self):
+        view = routers.use_replica(
+            lambda request: HttpResponse(self.router.db_for_read(models.Answer))
+        )
+        self.assertEqual(view(RequestFactory().get('/')).content, 'default_replica')
+        self.assertEqual(view(RequestFactory().post('/')).content, 'default')
+
+
+@skipUnless(
+    'replica' in settings.DATABASES,
+    'Needs a second database with the alias "replica", e.g. another SQLite database.'
+)
+@override_settings(DATABASE_REPLICAS={'default': 'replica'}, DATABASE_REPLICA_MAX_LAG=60)
+class ReplicaReadsTest(TestCase):
+    multi_db = True
+
+    def test_replica_reads(self):
+        self.addCleanup(routers._replica_checks.clear)
+        view = routers.use_replica(lambda request: HttpResponse(models.Answer.objects.count()))
+        question = factories.QuestionFactory(choices=2, choices__correct=[1])
+        answer = factories.AnswerFactory(question=question, first_answer_choice=1)
+
+        # The replica doesn't have the answer yet.
+        self.assertEqual(view(RequestFactory().get('/')).content, '1')
+
+        models.Answer.objects.using('replica').bulk_create([
+            answer,
+            models.Answer(
+                question=question, first_answer_choice=2,
+                created=answer.created - datetime.timedelta(minutes=1),
+            ),
+        ])
+        routers._replica_checks.clear()
+        self.assertEqual(view(RequestFactory().get('/')).content, '2')
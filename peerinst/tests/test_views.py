@@ -3,16 +3,23 @@ from __future__ import unicode_literals
 
 import json
 import random
+from unittest import skipUnless
 
+from django.conf import settings
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.db import IntegrityError
+from django.test import TestCase, override_settings
 from django_lti_tool_provider.models import LtiUserData
 from django_lti_tool_provider.views import LTIView
 
 import ddt
 import mock
 
-from ..models import Question
+from ..models import (
+    Answer, AnswerVote, AssignmentQuestionStats, BufferedVote, FakeCountry, FakeUsername,
+    GradePassback, Question, RationaleExposure, SentGrade,
+)
+from .. import grade_passback, routers, views
 from ..util import SessionStageData
 from . import factories
 
@@ -56,8 +63,8 @@ class QuestionViewTestCase(TestCase):
             choices=5, choices__correct=[2, 4], choices__rationales=4,
         ))
         self.addCleanup(mock.patch.stopall)
-        signal_patcher = mock.patch('django_lti_tool_provider.signals.Signals.Grade.updated.send')
-        self.mock_send_grade_signal = signal_patcher.start()
+        send_grade_patcher = mock.patch('peerinst.grade_passback.send_grade')
+        self.mock_send_grade = send_grade_patcher.start()
         grade_patcher = mock.patch('peerinst.models.Answer.get_grade')
         self.mock_get_grade = grade_patcher.start()
         self.mock_get_grade.return_value = Grade.CORRECT
@@ -118,9 +125,15 @@ class QuestionViewTestCase(TestCase):
 
 class QuestionViewTest(QuestionViewTestCase):
 
-    def assert_grade_signal(self, grade=Grade.INCORRECT):
-        send = mock.call('peerinst.views', user=self.user, custom_key=self.custom_key, grade=grade)
-        self.assertEqual(self.mock_send_grade_signal.call_args_list, [send] * 2)
+    def assert_grade_sent(self, grade=Grade.INCORRECT):
+        lti_parameters = LtiUserData.objects.get(
+            user=self.user, custom_key=self.custom_key
+        ).edx_lti_parameters
+        # The grade is sent when submitting the answer.  Showing the summary afterwards doesn't
+        # send the unchanged grade again.
+        self.assertEqual(
+            self.mock_send_grade.call_args_list, [mock.call(lti_parameters, grade)]
+        )
 
     def run_standard_review_mode(self):
         """Test answering questions in default mode."""
@@ -171,8 +184,10 @@ class QuestionViewTest(QuestionViewTestCase):
         response = self.get_results_view()
         self.assertTemplateUsed(response, 'peerinst/question_answers_summary.html')
         self.assertEqual(response.context['question'], self.question)
-        first_choice_row = next(row for row in response.context['answer_rows'] if first_choice_label in row[0])
-        second_choice_row = next(row for row in response.context['answer_rows'] if second_choice_label in row[0])
+        first_choice_row = next(row for row in response.context['answer_rows']
+                                if row[0].startswith('Answer {}:'.format(first_choice_label)))
+        second_choice_row = next(row for row in response.context['answer_rows']
+                                 if row[0].startswith('Answer {}:'.format(second_choice_label)))
         self.assertEqual(first_choice_row[1], 1)
         self.assertEqual(first_choice_row[2], 0)
         self.assertEqual(second_choice_row[2], 1)
@@ -182,9 +197,126 @@ class QuestionViewTest(QuestionViewTestCase):
         """Test answering questions in default mode, with scoring enabled."""
         self.mock_get_grade.return_value = Grade.INCORRECT
         self.run_standard_review_mode()
-        self.assert_grade_signal()
+        self.assert_grade_sent()
         self.assertTrue(self.mock_get_grade.called)
 
+    def test_rationale_exposures(self):
+        """Test that the rationales shown during the review are recorded at submission."""
+        self.run_standard_review_mode()
+        answer = Answer.objects.get(user_token=self.user.username)
+        exposures = RationaleExposure.objects.filter(answer_id=answer.pk)
+        shown_ids = set(exposures.values_list('rationale_id', flat=True))
+        self.assertTrue(shown_ids)
+        self.assertEqual(
+            list(exposures.filter(chosen=True).values_list('rationale_id', flat=True)),
+            [answer.chosen_rationale_id],
+        )
+        self.assertItemsEqual(Answer.objects.get_conversion_rates(self.question.pk), [
+            (rationale_id, 1, int(rationale_id == answer.chosen_rationale_id))
+            for rationale_id in shown_ids
+        ])
+
+    def test_assignment_stats(self):
+        """Test that the statistics of the question are updated when submitting the answer."""
+        self.run_standard_review_mode()
+        answer = Answer.objects.get(user_token=self.user.username)
+        stats = AssignmentQuestionStats.objects.get(
+            assignment=self.assignment, question=self.question, archived=False
+        )
+        self.assertEqual(
+            (stats.first_answer_choice, stats.second_answer_choice, stats.count),
+            (answer.first_answer_choice, answer.second_answer_choice, 1),
+        )
+
+    def test_summary_reload_grade_passback(self):
+        """Test that reloading the summary only sends the grade again if it has changed."""
+        self.run_standard_review_mode()
+        self.assertEqual(self.mock_send_grade.call_count, 1)
+        self.question_get()
+        self.assertEqual(self.mock_send_grade.call_count, 1)
+        self.assertEqual(
+            SentGrade.objects.get(user=self.user, custom_key=self.custom_key).grade, Grade.CORRECT
+        )
+
+        # After a change of the grade, e.g. because of a new grading scheme, the new grade is sent.
+        self.mock_get_grade.return_value = Grade.PARTIAL
+        self.question_get()
+        self.assertEqual(self.mock_send_grade.call_count, 2)
+        self.assertEqual(
+            SentGrade.objects.get(user=self.user, custom_key=self.custom_key).grade, Grade.PARTIAL
+        )
+
+    def test_summary_failed_grade_passback(self):
+        """Test that a grade the LMS didn't accept is sent again when reloading the summary."""
+        self.mock_send_grade.side_effect = grade_passback.GradePassbackError
+        with mock.patch('peerinst.grade_passback.LOGGER') as logger:
+            self.run_standard_review_mode()
+        self.assertTrue(logger.exception.called)
+        self.assertFalse(SentGrade.objects.exists())
+
+        attempts = self.mock_send_grade.call_count
+        self.mock_send_grade.side_effect = None
+        self.question_get()
+        self.assertEqual(self.mock_send_grade.call_count, attempts + 1)
+        self.assertEqual(
+            SentGrade.objects.get(user=self.user, custom_key=self.custom_key).grade, Grade.CORRECT
+        )
+
+    def submit_answer_concurrently(self, concurrent_answer=True):
+        """Submit the review form while another request stores the same answer."""
+        self.question_get()
+        self.question_post(first_answer_choice=2, rationale='my rationale text')
+        rationale_choices = SessionStageData(self.client.session, self.custom_key).get(
+            'rationale_choices'
+        )
+        if concurrent_answer:
+            factories.AnswerFactory(
+                assignment=self.assignment, question=self.question, user_token=self.user.username,
+                first_answer_choice=1, second_answer_choice=1,
+            )
+        # The answer didn't exist yet when the submission was dispatched.
+        get_object_or_none = views.get_object_or_none
+        hidden = []
+
+        def hide_answer_once(model_class, *args, **kwargs):
+            if model_class is Answer and not hidden:
+                hidden.append(model_class)
+                return None
+            return get_object_or_none(model_class, *args, **kwargs)
+
+        with mock.patch('peerinst.views.get_object_or_none', hide_answer_once):
+            return self.question_post(
+                second_answer_choice=rationale_choices[0][0],
+                rationale_choice_0=rationale_choices[0][2][0][0],
+            )
+
+    def test_double_submission(self):
+        """Test that a concurrent submission of the same answer shows the stored answer."""
+        response = self.submit_answer_concurrently()
+        self.assertTemplateUsed(response, 'peerinst/question_summary.html')
+        self.assertEqual(Answer.objects.filter(user_token=self.user.username).count(), 1)
+        self.assertEqual(
+            response.context['first_choice_label'], self.question.get_choice_label(1)
+        )
+
+    def test_integrity_error(self):
+        """Test that integrity errors without a concurrent submission aren't hidden."""
+        with mock.patch(
+                'peerinst.views.QuestionReviewView.save_answer', side_effect=IntegrityError):
+            with self.assertRaises(IntegrityError):
+                self.submit_answer_concurrently(concurrent_answer=False)
+
+    @override_settings(LTI_GRADE_PASSBACK_ASYNC=True)
+    def test_standard_review_mode_async_grade_passback(self):
+        """Test that grades are only queued when asynchronous grade passback is enabled."""
+        self.mock_get_grade.return_value = Grade.PARTIAL
+        self.run_standard_review_mode()
+        self.assertFalse(self.mock_send_grade.called)
+        grade = GradePassback.objects.get()
+        self.assertEqual(
+            (grade.user, grade.custom_key, grade.grade), (self.user, self.custom_key, Grade.PARTIAL)
+        )
+
     def test_numeric_answer_labels(self):
         """Test answering questions in default mode, using numerical labels."""
         self.set_question(factories.QuestionFactory(
@@ -207,7 +339,7 @@ class QuestionViewTest(QuestionViewTestCase):
         """Test answering questions in default mode, with scoring disabled."""
         self.log_in_with_scoring_disabled()
         self.run_standard_review_mode()
-        self.assertFalse(self.mock_send_grade_signal.called)
+        self.assertFalse(self.mock_send_grade.called)
         self.assertTrue(self.mock_get_grade.called)  # "emit_check_events" still uses "get_grade" to obtain grade data
 
     def test_sequential_review_mode(self):
@@ -277,9 +409,87 @@ class QuestionViewTest(QuestionViewTestCase):
         self.assertEqual(response.context['rationale'], rationale)
         self.assertEqual(response.context['chosen_rationale'].id, chosen_rationale)
 
-        self.assert_grade_signal()
+        self.assert_grade_sent()
         self.assertTrue(self.mock_get_grade.called)
 
+    def upvote_all_rationales_in_sequential_review(self):
+        """Answer a question with sequential review, upvoting all rationales shown.
+
+        Returns the ids of the upvoted rationales.
+        """
+        FakeUsername.objects.create(name='Robot')
+        FakeCountry.objects.create(name='Canada')
+        self.set_question(factories.QuestionFactory(
+            sequential_review=True, fake_attributions=True,
+            choices=5, choices__correct=[2, 4], choices__rationales=4,
+        ))
+        self.question_get()
+        response = self.question_post(first_answer_choice=2, rationale='my rationale text')
+
+        # Upvote all rationales.
+        upvoted = []
+        while 'peerinst/question_sequential_review.html' in (
+                template.name for template in response.templates
+            ):
+            upvoted.append(response.context['current_rationale'][0])
+            response = self.question_post(upvote=1)
+        self.assertTemplateUsed(response, 'peerinst/question_review.html')
+
+        # Stick with our own rationale.
+        response = self.question_post(second_answer_choice=2, rationale_choice_0=None)
+        self.assertTemplateUsed(response, 'peerinst/question_summary.html')
+        return upvoted
+
+    def test_sequential_review_votes(self):
+        """Test that votes from the sequential review are saved together with the answer."""
+        upvoted = self.upvote_all_rationales_in_sequential_review()
+        for rationale in Answer.objects.filter(id__in=upvoted):
+            self.assertEqual(rationale.upvotes, 1)
+            self.assertEqual(rationale.downvotes, 0)
+        votes = AnswerVote.objects.filter(assignment=self.assignment, user_token=self.user.username)
+        self.assertItemsEqual(votes.values_list('answer_id', flat=True), upvoted)
+        self.assertEqual(set(votes.values_list('vote_type', flat=True)), {AnswerVote.UPVOTE})
+        self.assertEqual(set(votes.values_list('fake_username', 'fake_country')), {('Robot', 'Canada')})
+
+    @override_settings(VOTE_COUNTERS_WRITE_BEHIND=True)
+    def test_sequential_review_votes_write_behind(self):
+        """Test that votes are buffered instead of updating the counters in write-behind mode."""
+        upvoted = self.upvote_all_rationales_in_sequential_review()
+        self.assertFalse(Answer.objects.filter(id__in=upvoted, upvotes__gt=0).exists())
+        self.assertItemsEqual(BufferedVote.objects.values_list('answer_id', flat=True), upvoted)
+        BufferedVote.objects.flush()
+        self.assertEqual(Answer.objects.filter(id__in=upvoted, upvotes=1).count(), len(upvoted))
+
+
+@skipUnless(
+    'tenant' in settings.DATABASES,
+    'Needs a second database with the alias "tenant", e.g. another SQLite database.'
+)
+@override_settings(TENANT_DATABASES={'course-v1:Big+B1+now': 'tenant'})
+class TenantQuestionViewTest(QuestionViewTestCase):
+    multi_db = True
+
+    def test_tenant_database(self):
+        """Test that each question reads the answers from the database of its own tenant."""
+        session = self.client.session
+        session[routers.TENANT_SESSION_KEY] = {
+            self.custom_key: {'consumer_key': 'key', 'course_id': 'course-v1:Big+B1+now'},
+        }
+        session.save()
+        Answer(
+            question=self.question, assignment=self.assignment, first_answer_choice=1,
+            rationale='Tenant', user_token=self.user.username,
+        ).save(using='tenant')
+
+        response = self.question_get()
+        self.assertTemplateUsed(response, 'peerinst/question_summary.html')
+        self.assertEqual(routers.get_active_database(), 'default')
+
+        # Another question of the same session uses the default database.
+        self.set_question(factories.QuestionFactory(choices=5, choices__correct=[2, 4]))
+        response = self.question_get()
+        self.assertTemplateUsed(response, 'peerinst/question_start.html')
+
 
 @ddt.ddt
 class EventLogTest(QuestionViewTestCase):
@@ -322,6 +532,9 @@ class EventLogTest(QuestionViewTestCase):
         event = self.verify_event(logger, scoring_disabled=scoring_disabled, is_edx_course_id=is_edx_course_id)
         self.assertEqual(logger.info.call_count, 2)
         self.assertEqual(event['event_type'], 'save_problem_success')
+        self.assertEqual(
+            (event['event']['first_answer_choice'], event['event']['second_answer_choice']), (2, 2)
+        )
         self.assertEqual(event['event']['success'], 'correct' if grade == Grade.CORRECT else 'incorrect')
 
         if not scoring_disabled:
@@ -339,6 +552,18 @@ class EventLogTest(QuestionViewTestCase):
         self.log_in_with_scoring_disabled()
         self._test_events(logger, scoring_disabled=True)
 
+    @override_settings(STUDENT_LOG_COMPACT_EVENTS=True)
+    @mock.patch('peerinst.views.LOGGER')
+    def test_events_compact(self, logger):
+        self._test_events(logger)
+        event = json.loads(logger.info.call_args[0][0])
+        self.assertNotIn('question_text', event['event'])
+        self.assertEqual(len(event['event']['question_text_digest']), 64)
+        self.assertNotIn('rationales', event['event'])
+        self.assertTrue(event['event']['rationale_ids'])
+        self.assertTrue(Answer.objects.filter(id__in=event['event']['rationale_ids']).exists())
+        self.assertNotIn('description', event['event']['rationale_algorithm'])
+
     @mock.patch('peerinst.views.LOGGER')
     def test_events_arbitrary_course_id(self, logger):
         # Try using a non-edX compatible number as the course_id (just like Moodle does).
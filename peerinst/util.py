@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
 from __future__ import division, unicode_literals
 
+import datetime
+import hashlib
 import itertools
+import math
 
+from django.db.models import Q
+from django.utils import timezone
 from django.utils.safestring import mark_safe
 
 
@@ -44,6 +49,91 @@ def make_percent_function(total):
     return percent
 
 
+# Rows get their creation timestamp before their transaction commits, so a row can become
+# visible after rows with later timestamps.  iterate_since() leaves the rows of the last minute
+# for the next run, which is much longer than any transaction saving answers or votes.
+ITERATE_SINCE_LAG = datetime.timedelta(minutes=1)
+
+
+def iterate_since(queryset, watermark=None, batch_size=1000, until=None):
+    """Iterate over the objects in queryset created after the given high-water mark.
+
+    Objects are returned in creation order, i.e. ordered by (created, pk).  The watermark is the
+    (created, pk) pair of the last object handled by a previous run, or None to start from the
+    beginning.  Yields pairs (obj, watermark), where watermark is the value to store once obj has
+    been processed.  Objects created after `until` are left for the next run.  It defaults to one
+    minute ago (ITERATE_SINCE_LAG), so rows committed shortly after the run aren't skipped.
+    Objects without a creation timestamp are skipped, so existing rows must be backfilled with
+    the backfill_created_timestamps management command first.
+    """
+    if until is None:
+        until = timezone.now() - ITERATE_SINCE_LAG
+    queryset = queryset.filter(created__isnull=False, created__lte=until).order_by('created', 'pk')
+    while True:
+        batch = queryset
+        if watermark is not None:
+            created, pk = watermark
+            batch = batch.filter(Q(created__gt=created) | Q(created=created, pk__gt=pk))
+        batch = list(batch[:batch_size])
+        if not batch:
+            return
+        for obj in batch:
+            watermark = obj.created, obj.pk
+            yield obj, watermark
+
+
+class HyperLogLog(object):
+    """Estimate the number of distinct strings in constant memory.
+
+    This is a HyperLogLog sketch with 2 ** precision one-byte registers.  The standard error of
+    the estimate is about 1.04 / sqrt(2 ** precision), i.e. 1.6 % with the default precision, and
+    small counts are almost exact.  Sketches with the same precision can be merged with update(),
+    so the estimate for a union of sets doesn't need the values again.  Like a set, the sketch
+    supports add(), update() and len().
+    """
+
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Load a sketch saved with to_bytes()."""
+        sketch = cls(len(data).bit_length() - 1)
+        sketch.registers = bytearray(data)
+        return sketch
+
+    def to_bytes(self):
+        return bytes(self.registers)
+
+    def add(self, value):
+        # Use 64 bits of the hash:  the first bits select the register, and the position of the
+        # first set bit in the others is the rank.
+        hash_value = int(hashlib.sha1(value.encode('utf-8')).hexdigest()[:16], 16)
+        remaining_bits = 64 - self.precision
+        index = hash_value >> remaining_bits
+        rest = hash_value & ((1 << remaining_bits) - 1)
+        rank = remaining_bits - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, other):
+        """Merge another sketch into this one."""
+        if other.precision != self.precision:
+            raise ValueError('Only sketches with the same precision can be merged.')
+        self.registers = bytearray(itertools.imap(max, self.registers, other.registers))
+
+    def __len__(self):
+        count = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / count)
+        estimate = alpha * count * count / sum(2.0 ** -rank for rank in self.registers)
+        empty = self.registers.count(b'\0')
+        if estimate <= 2.5 * count and empty:
+            # Linear counting is more accurate for small numbers.
+            estimate = count * math.log(count / empty)
+        return int(round(estimate))
+
+
 class SessionStageData(object):
     """Manages the data to be kept in the session between different question stages."""
 
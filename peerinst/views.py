@@ -11,6 +11,7 @@ from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.views import redirect_to_login
+from django.db import IntegrityError, router, transaction
 from django.shortcuts import get_object_or_404, render_to_response, redirect
 from django.template.response import TemplateResponse
 from django.utils.html import escape, format_html
@@ -19,15 +20,18 @@ from django.utils.translation import ugettext_lazy as _
 from django.views.generic.base import TemplateView, View
 from django.views.generic.edit import FormView
 from django.views.generic.list import ListView
-from django_lti_tool_provider.signals import Signals
 from django_lti_tool_provider.models import LtiUserData
 from opaque_keys import InvalidKeyError
 from opaque_keys.edx.keys import CourseKey
 
+from . import aggregates
 from . import heartbeat_checks
 from . import forms
+from . import grade_passback
 from . import models
 from . import rationale_choice
+from . import routers
+from .routers import UseReplicaMixin
 from .util import SessionStageData, get_object_or_none, int_or_none, roundrobin
 from .admin_views import get_question_rationale_aggregates
 
@@ -77,13 +81,41 @@ class QuestionMixin(object):
         if not self.lti_data.edx_lti_parameters.get('lis_outcome_service_url'):
             # edX didn't provide a callback URL for grading, so this is an unscored problem.
             return
+        grade_passback.pass_back_grade(
+            self.request.user, self.custom_key, self.answer.get_grade(),
+            lti_parameters=self.lti_data.edx_lti_parameters,
+        )
+
+
+# Maps course ids to the org and grade handler regex used when logging events.
+COURSE_LOG_INFO_CACHE = {}
+COURSE_LOG_INFO_CACHE_SIZE = 1000
 
-        Signals.Grade.updated.send(
-            __name__,
-            user=self.request.user,
-            custom_key=self.custom_key,
-            grade=self.answer.get_grade(),
+
+def get_course_log_info(course_id):
+    """Return the edX org of a course, or None, and the regex matching its grade handler URLs.
+
+    The results are cached per process, since parsing the course key and compiling the regex on
+    every event is comparatively expensive.
+    """
+    try:
+        return COURSE_LOG_INFO_CACHE[course_id]
+    except KeyError:
+        pass
+    try:
+        edx_org = CourseKey.from_string(course_id).org
+    except InvalidKeyError:
+        # The course_id is not from edX. Don't place the org in the logs.
+        edx_org = None
+    grade_handler_re = re.compile(
+        'https?://[^/]+/courses/{course_id}/xblock/(?P<usage_key>[^/]+)/'.format(
+            course_id=re.escape(course_id)
         )
+    )
+    if len(COURSE_LOG_INFO_CACHE) >= COURSE_LOG_INFO_CACHE_SIZE:
+        COURSE_LOG_INFO_CACHE.clear()
+    COURSE_LOG_INFO_CACHE[course_id] = edx_org, grade_handler_re
+    return edx_org, grade_handler_re
 
 
 class QuestionReload(Exception):
@@ -95,25 +127,17 @@ class QuestionFormView(QuestionMixin, FormView):
 
     def emit_event(self, name, **data):
         """Log an event in a JSON format similar to the edx-platform tracking logs.
+
+        With the STUDENT_LOG_COMPACT_EVENTS setting, the question text is replaced by its digest.
         """
-        if not self.lti_data:
-            # Only log when running within an LTI context.
+        if not self.lti_data or not LOGGER.isEnabledFor(logging.INFO):
+            # Only log when running within an LTI context and the student log is enabled.
             return
 
         # Extract information from LTI parameters.
         course_id = self.lti_data.edx_lti_parameters.get('context_id')
+        edx_org, grade_handler_re = get_course_log_info(course_id)
 
-        try:
-            edx_org = CourseKey.from_string(course_id).org
-        except InvalidKeyError:
-            # The course_id is not from edX. Don't place the org in the logs.
-            edx_org = None
-
-        grade_handler_re = re.compile(
-            'https?://[^/]+/courses/{course_id}/xblock/(?P<usage_key>[^/]+)/'.format(
-                course_id=re.escape(course_id)
-            )
-        )
         usage_key = None
         outcome_service_url = self.lti_data.edx_lti_parameters.get('lis_outcome_service_url')
         if outcome_service_url:
@@ -133,8 +157,13 @@ class QuestionFormView(QuestionMixin, FormView):
             assignment_title=self.assignment.title,
             problem=usage_key,
             question_id=self.question.pk,
-            question_text=self.question.text,
         )
+        if settings.STUDENT_LOG_COMPACT_EVENTS:
+            data.update(
+                question_text_digest=models.RationaleText.objects.get_digest(self.question.text)
+            )
+        else:
+            data.update(question_text=self.question.text)
 
         # Build event dictionary.
         META = self.request.META
@@ -163,7 +192,10 @@ class QuestionFormView(QuestionMixin, FormView):
             event['context']['org_id'] = edx_org
 
         # Write JSON to log file
-        LOGGER.info(json.dumps(event))
+        if settings.STUDENT_LOG_COMPACT_EVENTS:
+            LOGGER.info(json.dumps(event, separators=(',', ':')))
+        else:
+            LOGGER.info(json.dumps(event))
 
     def submission_error(self):
         messages.error(self.request, format_html(
@@ -372,9 +404,22 @@ class QuestionReviewView(QuestionReviewBaseView):
     def form_valid(self, form):
         self.second_answer_choice = int(form.cleaned_data['second_answer_choice'])
         self.chosen_rationale_id = int_or_none(form.cleaned_data['chosen_rationale_id'])
-        self.save_answer()
+        database = router.db_for_write(models.Answer)
+        try:
+            with transaction.atomic(using=database):
+                self.save_answer()
+        except IntegrityError:
+            # The answer may have been saved by a concurrent submission of the same form, e.g.
+            # after a double click.  The events and the grade have been taken care of by that
+            # request, so we only need to show the summary of the stored answer.  Any other
+            # integrity error is a bug.
+            if not models.Answer.objects.using(database).filter(
+                    assignment=self.assignment, question=self.question, user_token=self.user_token
+            ).exists():
+                raise
+            self.stage_data.clear()
+            return super(QuestionReviewView, self).form_valid(form)
         self.emit_check_events()
-        self.save_votes()
         self.stage_data.clear()
         self.send_grade()
         return super(QuestionReviewView, self).form_valid(form)
@@ -382,90 +427,173 @@ class QuestionReviewView(QuestionReviewBaseView):
     def emit_check_events(self):
         grade = self.answer.get_grade()
         event_data = dict(
+            first_answer_choice=self.first_answer_choice,
             second_answer_choice=self.second_answer_choice,
             switch=self.first_answer_choice != self.second_answer_choice,
             rationale_algorithm=dict(
                 name=self.question.rationale_selection_algorithm,
                 version=self.choose_rationales.version,
-                description=unicode(self.choose_rationales.description),
             ),
-            rationales=[
-                {'id': id, 'text': rationale}
-                for choice, label, rationales in self.rationale_choices
-                for id, rationale in rationales
-                if id is not None
-            ],
             chosen_rationale_id=self.chosen_rationale_id,
             success='correct' if grade == 1.0 else 'incorrect',
             grade=grade,
         )
+        shown_rationales = [
+            (id, rationale)
+            for choice, label, rationales in self.rationale_choices
+            for id, rationale in rationales
+            if id is not None
+        ]
+        if settings.STUDENT_LOG_COMPACT_EVENTS:
+            # The rationale texts can be looked up by answer id, and the algorithm description
+            # by name and version.
+            event_data.update(rationale_ids=[id for id, rationale in shown_rationales])
+        else:
+            event_data['rationale_algorithm'].update(
+                description=unicode(self.choose_rationales.description)
+            )
+            event_data.update(
+                rationales=[{'id': id, 'text': rationale} for id, rationale in shown_rationales]
+            )
         self.emit_event('problem_check', **event_data)
         self.emit_event('save_problem_success', **event_data)
 
     def save_answer(self):
-        """Validate and save the answer defined by the arguments to the database."""
+        """Validate and save the answer together with the votes cast during the review.
+
+        This must be called inside a transaction.  The number of statements is fixed:  one query
+        to look up the chosen, voted and shown rationales, one insert for the answer, one
+        statement to update the vote and exposure counters, and bulk inserts of the rationale
+        exposures and the fake attribution votes, and one query to lock the cell of the transition
+        matrix of the question and one statement to update it (or an insert for the first answer
+        with the same choices).
+        """
+        # The session serializes the rationale ids to strings.
+        rationale_votes = {
+            int(rationale_id): vote
+            for rationale_id, vote in (self.stage_data.get('rationale_votes') or {}).iteritems()
+        }
+        shown_ids = {
+            id
+            for choice, label, rationales in self.rationale_choices
+            for id, rationale in rationales
+            if id is not None
+        }
+        referenced_ids = set(rationale_votes) | shown_ids
         if self.chosen_rationale_id is not None:
-            try:
-                chosen_rationale = models.Answer.objects.get(id=self.chosen_rationale_id)
-            except models.Answer.DoesNotExist:
+            referenced_ids.add(self.chosen_rationale_id)
+        if referenced_ids:
+            existing_rationales = dict(
+                models.Answer.objects.filter(id__in=referenced_ids)
+                .values_list('id', 'first_answer_choice')
+            )
+        else:
+            existing_rationales = {}
+        if self.chosen_rationale_id is not None:
+            if self.chosen_rationale_id not in existing_rationales:
                 # Raises exception.
                 self.start_over(_(
                     'The rationale you chose does not exist anymore.  '
                     'This should not happen.  Please start over with the question.'
                 ))
-            if chosen_rationale.first_answer_choice != self.second_answer_choice:
+            if existing_rationales[self.chosen_rationale_id] != self.second_answer_choice:
                 self.start_over(_(
                     'The rationale you chose does not match your second answer choice.  '
                     'This should not happen.  Please start over with the question.'
                 ))
-        else:
-            # We stuck with our own rationale.
-            chosen_rationale = None
         self.answer = models.Answer(
             question=self.question,
             assignment=self.assignment,
             first_answer_choice=self.first_answer_choice,
             rationale=self.rationale,
             second_answer_choice=self.second_answer_choice,
-            chosen_rationale=chosen_rationale,
+            chosen_rationale_id=self.chosen_rationale_id,
             user_token=self.user_token,
         )
         self.answer.save()
-        if chosen_rationale is not None:
-            self.record_fake_attribution_vote(chosen_rationale, models.AnswerVote.FINAL_CHOICE)
+        fake_attribution_votes = []
+        if self.chosen_rationale_id is not None:
+            fake_attribution_votes.append(
+                (self.chosen_rationale_id, models.AnswerVote.FINAL_CHOICE)
+            )
+        # Votes on rationales that were deleted while the student was answering the question are
+        # simply ignored.
+        votes = [
+            (rationale_id, vote) for rationale_id, vote in rationale_votes.iteritems()
+            if rationale_id in existing_rationales
+        ]
+        shown_ids = sorted(shown_ids.intersection(existing_rationales))
+        self.save_counters(votes, shown_ids)
+        self.record_exposures(shown_ids)
+        fake_attribution_votes.extend(
+            (rationale_id, self.VOTE_TYPES[vote]) for rationale_id, vote in votes
+        )
+        self.record_fake_attribution_votes(fake_attribution_votes)
+        # The cell of the transition matrix is shared by all students with the same answer
+        # choices, so it is updated last to hold its lock as briefly as possible.
+        models.AssignmentQuestionStats.objects.record_answer(self.answer)
 
-    def save_votes(self):
-        rationale_votes = self.stage_data.get('rationale_votes')
-        if rationale_votes is None:
+    VOTE_TYPES = {
+        'up': models.AnswerVote.UPVOTE,
+        'down': models.AnswerVote.DOWNVOTE,
+    }
+
+    def save_counters(self, votes, shown_ids):
+        """Increment the vote and exposure counters of the rationales with a single statement.
+
+        In write-behind mode, the increments are only appended to the vote buffer, which is folded
+        into the counters periodically by the "flush_votes" management command.
+        """
+        deltas = {
+            'upvotes': {rationale_id: 1 for rationale_id, vote in votes if vote == 'up'},
+            'downvotes': {rationale_id: 1 for rationale_id, vote in votes if vote == 'down'},
+            'times_shown': {rationale_id: 1 for rationale_id in shown_ids},
+            'times_chosen': {
+                rationale_id: 1 for rationale_id in shown_ids
+                if rationale_id == self.chosen_rationale_id
+            },
+        }
+        if not any(deltas.itervalues()):
             return
-        for rationale_id, vote in rationale_votes.iteritems():
-            try:
-                rationale = models.Answer.objects.get(id=rationale_id)
-            except models.Answer.DoesNotExist:
-                # This corner case can only happen if an answer was deleted while the student was
-                # answering the question.  Simply ignore these votes.
-                continue
-            if vote == 'up':
-                rationale.upvotes += 1
-                self.record_fake_attribution_vote(rationale, models.AnswerVote.UPVOTE)
-            elif vote == 'down':
-                rationale.downvotes += 1
-                self.record_fake_attribution_vote(rationale, models.AnswerVote.DOWNVOTE)
-            rationale.save()
-
-    def record_fake_attribution_vote(self, answer, vote_type):
+        if settings.VOTE_COUNTERS_WRITE_BEHIND:
+            rationale_ids = set().union(*deltas.itervalues())
+            models.BufferedVote.objects.bulk_create([
+                models.BufferedVote(answer_id=rationale_id, **{
+                    field: amounts.get(rationale_id, 0) for field, amounts in deltas.iteritems()
+                })
+                for rationale_id in sorted(rationale_ids)
+            ])
+            return
+        models.Answer.objects.add_to_counters(deltas)
+
+    def record_exposures(self, shown_ids):
+        """Bulk-insert the rationales shown to the student."""
+        models.RationaleExposure.objects.bulk_create([
+            models.RationaleExposure(
+                answer_id=self.answer.pk,
+                rationale_id=rationale_id,
+                chosen=rationale_id == self.chosen_rationale_id,
+            )
+            for rationale_id in shown_ids
+        ])
+
+    def record_fake_attribution_votes(self, votes):
+        """Bulk-insert the votes given as pairs (rationale_id, vote_type) with fake attributions."""
         fake_attributions = self.stage_data.get('fake_attributions')
-        if fake_attributions is None:
+        if fake_attributions is None or not votes:
             return
-        fake_username, fake_country = fake_attributions[unicode(answer.id)]
-        models.AnswerVote(
-            answer=answer,
-            assignment=self.assignment,
-            user_token=self.user_token,
-            fake_username=fake_username,
-            fake_country=fake_country,
-            vote_type=vote_type,
-        ).save()
+        answer_votes = []
+        for rationale_id, vote_type in votes:
+            fake_username, fake_country = fake_attributions[unicode(rationale_id)]
+            answer_votes.append(models.AnswerVote(
+                answer_id=rationale_id,
+                assignment=self.assignment,
+                user_token=self.user_token,
+                fake_username=fake_username,
+                fake_country=fake_country,
+                vote_type=vote_type,
+            ))
+        models.AnswerVote.objects.bulk_create(answer_votes)
 
 
 class QuestionSummaryView(QuestionMixin, TemplateView):
@@ -505,7 +633,7 @@ class HeartBeatUrl(View):
             status=status)
 
 
-class AnswerSummaryChartView(View):
+class AnswerSummaryChartView(UseReplicaMixin, View):
     """
     This view draws a chart showing analytics about the answers
     that students chose for a question, and the rationales
@@ -538,8 +666,12 @@ class AnswerSummaryChartView(View):
             (
                 "to_{}".format(question.get_choice_label(i)),
                 "To {}".format(question.get_choice_label(i)),
-            ) for i in range(1, question.answerchoice_set.count()+1)
+            ) for i in range(1, question.choice_count+1)
         ]
+        # Count the answers by first and second answer choice with a single query
+        matrix = aggregates.get_transition_matrices([
+            models.Answer.objects.filter(question=question, assignment=assignment)
+        ]).get(question.pk, aggregates.TransitionMatrix())
         # Initialize a list of answers that we can add details to
         answers = []
         for i, answer in enumerate(question.answerchoice_set.all(), start=1):
@@ -547,26 +679,13 @@ class AnswerSummaryChartView(View):
             # this answer the first time, and the second time.
             answer_row = {
                 "label": "Answer {}: {}".format(question.get_choice_label(i), answer.text),
-                "before": models.Answer.objects.filter(
-                    question=question,
-                    first_answer_choice=i,
-                    assignment=assignment,
-                ).count(),
-                "after": models.Answer.objects.filter(
-                    question=question,
-                    second_answer_choice=i,
-                    assignment=assignment,
-                ).count(),
+                "before": matrix.first_choice_count(i),
+                "after": matrix.second_choice_count(i),
             }
             for j, column in enumerate(to_columns, start=1):
                 # For every other answer, determine the count of students who chose
                 # this answer the first time, but the other answer the second time.
-                answer_row[column[0]] = models.Answer.objects.filter(
-                    question=question,
-                    first_answer_choice=i,
-                    second_answer_choice=j,
-                    assignment=assignment,
-                ).count()
+                answer_row[column[0]] = matrix[i, j]
             # Get the top five rationales for this answer to display underneath the chart
             _, rationales = get_question_rationale_aggregates(
                 assignment,
@@ -639,6 +758,8 @@ def question(request, assignment_id, question_id):
     assignment = get_object_or_404(models.Assignment, pk=assignment_id)
     question = get_object_or_404(models.Question, pk=question_id)
     custom_key = unicode(assignment.pk) + ':' + unicode(question.pk)
+    # The answers are stored in the database of the tenant the question was launched from.
+    routers.activate(routers.get_session_database(request.session, custom_key))
     stage_data = SessionStageData(request.session, custom_key)
     user_token = request.user.username
     view_data = dict(